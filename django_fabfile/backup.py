@@ -1,32 +1,42 @@
 """Check :doc:`README` or :class:`django_fabfile.utils.Config` docstring
 for setup instructions."""
 
+from collections import defaultdict
 from contextlib import contextmanager
 import logging
 import os
 import re
 from datetime import timedelta, datetime
+from bisect import bisect_right
 from contextlib import nested
-from itertools import groupby
-from json import dumps
+from json import dumps, loads
+from pipes import quote
+from threading import RLock
+from time import sleep, time
 
 from boto.exception import EC2ResponseError
 from dateutil.parser import parse
 from dateutil.relativedelta import relativedelta
 from dateutil.tz import tzutc
-from fabric.api import env, local, put, settings, sudo, task, run
-from fabric.contrib.files import append
+from fabric.api import local, task
 
 from django_fabfile.instances import (attach_snapshot, create_temp_inst,
                                       get_avail_dev, get_vol_dev, mount_volume)
+from django_fabfile.remote import (ExecutionContext, instance_context,
+                                   with_session_pool)
+from django_fabfile.snapshot_store import (PRESERVED, SnapshotStore,
+                                           from_epoch, to_epoch)
 from django_fabfile.utils import (
-    StateNotChangedError, add_tags, config, config_temp_ssh,
-    get_descr_attr, get_inst_by_id, get_region_conn, get_snap_device,
-    get_snap_time, get_snap_vol, timestamp, wait_for, wait_for_sudo)
+    METADATA_TAG, StateNotChangedError, add_tags, config, config_temp_ssh,
+    create_instance_snapshots, describe_planning, get_inst_by_id,
+    get_metadata_tags, get_region_conn, get_snap_by_id, get_snap_device,
+    get_snap_time, get_snap_vol, get_vol_by_id, get_volume_description,
+    instances_batcher, iter_snapshots, log_throttling_stats, parallel_map,
+    snapshots_batcher, timestamp, volumes_batcher, wait_for,
+    with_metadata_tags)
 
 
 USERNAME = config.get('DEFAULT', 'USERNAME')
-env.update({'user': USERNAME, 'disable_known_hosts': True})
 
 logger = logging.getLogger(__name__)
 
@@ -34,20 +44,327 @@ logger = logging.getLogger(__name__)
 DEFAULT_TAG_NAME = config.get('DEFAULT', 'TAG_NAME')
 DEFAULT_TAG_VALUE = config.get('DEFAULT', 'TAG_VALUE')
 DESCRIPTION_TAG = 'Description'
+MAX_DESCRIPTION_LENGTH = 255
 SNAP_STATUSES = ['pending', 'completed']    # All but "error".
 VOL_STATUSES = ['creating', 'available', 'in-use']
 DETACH_TIME = config.getint('DEFAULT', 'MINUTES_FOR_DETACH') * 60
 SNAP_TIME = config.getint('DEFAULT', 'MINUTES_FOR_SNAP') * 60
 REPLICATION_SPEED = config.getfloat('DEFAULT', 'REPLICATION_SPEED')
+FREEZE_BUDGET = config.getfloat('DEFAULT', 'FREEZE_BUDGET')
+
+freeze_durations = {}   # Instance ID to seconds of latest freeze.
 
 
 class ReplicationCollisionError(Exception):
     pass
 
 
+class PendingSnapshotsGovernor(object):
+
+    """Limit pending snapshots per volume and per region.
+
+    Pending snapshots of the account (including started by other
+    processes) are tracked in memory and refreshed with one Describe
+    per region at most every `refresh_period` seconds. Slots are
+    released when refresh finds snapshot not pending anymore. Snapshots
+    of one group are admitted together, see :meth:`acquire_all`.
+
+    :param max_per_region, max_per_volume, policy: fetched from config
+        by default, 0 `max_per_region` for no region limit;
+    :param policy: "queue" to wait for released slot or "skip" to
+        refuse new snapshot."""
+
+    def __init__(self, max_per_region=None, max_per_volume=None,
+                 policy=None, refresh_period=None):
+        if max_per_region is None:
+            max_per_region = config.getint(
+                'DEFAULT', 'MAX_PENDING_SNAPSHOTS_PER_REGION')
+        self.max_per_region = max_per_region
+        self.max_per_volume = max_per_volume or config.getint(
+            'DEFAULT', 'MAX_PENDING_SNAPSHOTS_PER_VOLUME')
+        self.policy = policy or config.get('DEFAULT', 'PENDING_POLICY')
+        self.refresh_period = refresh_period or config.getint(
+            'DEFAULT', 'PENDING_REFRESH_PERIOD')
+        self.pending = defaultdict(dict)    # Snapshot ID to volume ID.
+        self.refreshed_at = {}
+        self.registered_at = {}
+        self.skipped = 0
+        self._lock = RLock()
+
+    def refresh(self, region_name, force=False):
+        """Refetch pending snapshots of region if outdated."""
+        with self._lock:
+            if (not force and time() - self.refreshed_at.get(region_name, 0) <
+                    self.refresh_period):
+                return
+        started = time()
+        conn = get_region_conn(region_name)
+        pending = dict((snap.id, snap.volume_id) for snap in
+                       conn.get_all_snapshots(owner='self',
+                                              filters={'status': 'pending'}))
+        with self._lock:
+            # Keep snapshots registered during Describe call.
+            for snap_id, vol_id in self.pending[region_name].items():
+                if self.registered_at.get(snap_id, 0) >= started:
+                    pending[snap_id] = vol_id
+                else:   # Listed by Describe call if still pending.
+                    self.registered_at.pop(snap_id, None)
+            self.pending[region_name] = pending
+            self.refreshed_at[region_name] = time()
+
+    def can_start(self, region_name, vol_ids):
+        """Return True if snapshots of all `vol_ids` fit the limits.
+
+        More volumes than region limit fit only region without pending
+        snapshots, otherwise they would never start."""
+        with self._lock:
+            in_flight = self.pending[region_name].values()
+            if self.max_per_region and in_flight and (
+                    len(in_flight) + len(vol_ids) > self.max_per_region):
+                return False
+            return all(in_flight.count(vol_id) < self.max_per_volume for
+                       vol_id in vol_ids)
+
+    def acquire(self, vol, policy=None):
+        """Return True if snapshot of `vol` may be started.
+
+        Wait for released slot up to MINUTES_FOR_SNAP with "queue"
+        policy."""
+        return self.acquire_all([vol], policy)
+
+    def acquire_all(self, vols, policy=None):
+        """Return True if snapshots of all `vols` of one region may be
+        started together, see :meth:`acquire`."""
+        if not vols:
+            return True
+        region_name = vols[0].region.name
+        vol_ids = [vol.id for vol in vols]
+        self.refresh(region_name)
+        slept = 0
+        while not self.can_start(region_name, vol_ids):
+            if (policy or self.policy) == 'skip' or slept >= SNAP_TIME:
+                with self._lock:
+                    self.skipped += len(vols)
+                logger.warning('Snapshots of {0} in {1} skipped: too many '
+                               'pending snapshots'.format(
+                                   ', '.join(vol_ids), region_name))
+                return False
+            logger.info('Waiting for pending snapshots of {0} in {1} to '
+                        'complete'.format(', '.join(vol_ids), region_name))
+            sleep(self.refresh_period)
+            slept += self.refresh_period
+            self.refresh(region_name, force=True)
+        return True
+
+    def register(self, snapshot):
+        with self._lock:
+            self.pending[snapshot.region.name][snapshot.id] = (
+                snapshot.volume_id)
+            self.registered_at[snapshot.id] = time()
+
+    def release(self, snapshot):
+        with self._lock:
+            self.pending[snapshot.region.name].pop(snapshot.id, None)
+            self.registered_at.pop(snapshot.id, None)
+
+    def count(self):
+        """Return dict of pending snapshots number by region name."""
+        with self._lock:
+            return dict((region_name, len(snaps)) for region_name, snaps in
+                        self.pending.items())
+
+
+pending_snapshots = PendingSnapshotsGovernor()
+
+
+class RecentSnapshots(object):
+
+    """Track volumes with recently started snapshots.
+
+    Pending and completed snapshots started within `max_age` seconds are
+    fetched with one Describe per region filtered by start date and
+    reused for `refresh_period` seconds. Snapshots started by this
+    process are registered immediately.
+
+    :param max_age, refresh_period: fetched from config by default,
+        zero `max_age` disables checks."""
+
+    def __init__(self, max_age=None, refresh_period=None):
+        if max_age is None:
+            max_age = config.getint('DEFAULT', 'FRESH_SNAPSHOT_MINUTES') * 60
+        self.max_age = max_age
+        self.refresh_period = refresh_period or config.getint(
+            'DEFAULT', 'PENDING_REFRESH_PERIOD')
+        self.started = defaultdict(dict)    # Volume ID to epoch.
+        self.refreshed_at = {}
+        self.skipped = 0
+        self._lock = RLock()
+
+    def refresh(self, region_name):
+        """Refetch recent snapshots of region if outdated."""
+        with self._lock:
+            if (time() - self.refreshed_at.get(region_name, 0) <
+                    self.refresh_period):
+                return
+        now = datetime.utcnow()
+        day = (now - timedelta(seconds=self.max_age)).date()
+        days = []
+        while day <= now.date():
+            days.append('{0}T*'.format(day.isoformat()))
+            day += timedelta(days=1)
+        conn = get_region_conn(region_name)
+        started = {}
+        for snap in conn.get_all_snapshots(owner='self', filters={
+                'status': SNAP_STATUSES, 'start-time': days}):
+            start = to_epoch(datetime.strptime(snap.start_time[:19],
+                                               '%Y-%m-%dT%H:%M:%S'))
+            started[snap.volume_id] = max(start, started.get(snap.volume_id,
+                                                             start))
+        with self._lock:
+            for vol_id, start in self.started[region_name].items():
+                if start > started.get(vol_id, 0):
+                    started[vol_id] = start
+            self.started[region_name] = started
+            self.refreshed_at[region_name] = time()
+
+    def is_fresh(self, vol):
+        if not self.max_age:
+            return False
+        self.refresh(vol.region.name)
+        with self._lock:
+            start = self.started[vol.region.name].get(vol.id)
+        return start is not None and time() - start < self.max_age
+
+    def filter(self, vols):
+        """Return `vols` without recent snapshots, count skipped ones."""
+        fresh = [vol for vol in vols if self.is_fresh(vol)]
+        if fresh:
+            logger.info('Skipping {0}: snapshots are started within {1} sec'
+                        .format(', '.join(vol.id for vol in fresh),
+                                self.max_age))
+            with self._lock:
+                self.skipped += len(fresh)
+        return [vol for vol in vols if vol not in fresh]
+
+    def register(self, snapshot):
+        with self._lock:
+            self.started[snapshot.region.name][snapshot.volume_id] = time()
+
+
+recent_snapshots = RecentSnapshots()
+
+
+def _get_snap_description(vol, inst):
+    return dumps({
+        'Volume': vol.id,
+        'Region': vol.region.name,
+        'Device': vol.attach_data.device,
+        'Instance': inst.id,
+        'Type': inst.instance_type,
+        'Arch': inst.architecture,
+        'Root_dev_name': inst.root_device_name,
+        'Time': timestamp(),
+        })
+
+
+def _tag_snapshot(snapshot, vol, inst, tags=None):
+    if not tags:
+        tags = dict(vol.tags)
+        if inst:
+            tags.update(inst.tags)
+    add_tags(snapshot, with_metadata_tags(tags, snapshot.description))
+    logger.info('{0} started from {1} in {0.region}'.format(snapshot, vol))
+
+
+def _get_sync_context(inst):
+    try:
+        _user = config.get('SYNC', 'USERNAME')
+    except:
+        _user = USERNAME
+    return ExecutionContext.for_instance(inst, _user or USERNAME)
+
+
+def _is_on_device(mount_dev, dev):
+    """Return True if `mount_dev` is `dev` or its partition."""
+    return (mount_dev == dev or
+            re.match(re.escape(dev) + r'p?\d+$', mount_dev) is not None)
+
+
+@contextmanager
+def freeze_instance(inst, vols, ctx=None):
+    """Keep filesystems of `vols` attached to `inst` flushed and frozen
+    within the block.
+
+    Buffers are flushed with single ``sync`` and filesystems mounted
+    from devices of `vols` (or their partitions) but root are frozen
+    with ``fsfreeze`` in the same SSH command. They are thawed on exit
+    even if block failed. Root filesystem is only flushed: frozen root
+    would block the SSH session used for thawing.
+
+    Seconds between freeze and thaw are stored in
+    :data:`freeze_durations` and logged with warning if they exceed
+    ``FREEZE_BUDGET`` option. Nothing is recorded if freeze failed.
+
+    :param ctx: :class:`django_fabfile.remote.ExecutionContext` of
+        `inst`, one of ``[SYNC]`` ``USERNAME`` by default. Thawing reuses
+        connection of freezing."""
+    if inst.state != 'running':
+        yield
+        return
+    mountpoints = []
+    frozen = False
+    ctx = ctx or _get_sync_context(inst)
+    try:
+        devs = [get_vol_dev(vol, ctx) for vol in vols]
+        mounts = [line.split()[:2] for line in
+                  ctx.run('cat /proc/mounts').splitlines()]
+        mountpoints = [mpoint for mount_dev, mpoint in mounts if
+                       mpoint != '/' and
+                       any(_is_on_device(mount_dev, dev) for dev in devs)]
+        started = time()
+        ctx.sudo(' && '.join(['sync'] + ['fsfreeze -f {0}'.format(mpoint)
+                                         for mpoint in mountpoints]))
+        frozen = bool(mountpoints)
+    except:
+        logger.info('FS NOT FREEZED! Do you have access to this server?')
+    try:
+        yield
+    finally:
+        if mountpoints:
+            ctx.sudo('; '.join('fsfreeze -u {0}'.format(mpoint) for
+                               mpoint in mountpoints), warn_only=True)
+        if frozen:
+            duration = freeze_durations[inst.id] = time() - started
+            if duration > FREEZE_BUDGET:
+                logger.warning('{0} was frozen for {1:.1f} sec, budget is '
+                               '{2} sec'.format(inst, duration,
+                                                FREEZE_BUDGET))
+            else:
+                logger.info('{0} was frozen for {1:.1f} sec'.format(
+                    inst, duration))
+
+
+def _wait_for_snapshot(snapshot):
+    """Return True if `snapshot` completed, delete it otherwise."""
+    try:
+        wait_for(snapshot, '100%', limit=SNAP_TIME)
+        assert snapshot.status == 'completed', (
+            'completed with wrong status {0}'.format(snapshot.status))
+    except (StateNotChangedError, AssertionError) as err:
+        logger.error(str(err) + ' - deleting')
+        snapshot.delete()
+        return False
+    return True
+
+
 def create_snapshot(vol, description='', tags=None, synchronously=True,
-                    consistent=False):
-    """Return new snapshot for the volume.
+                    consistent=False, governor=pending_snapshots,
+                    on_limit=None):
+    """Return new snapshot for the volume or None if it was skipped.
+
+    Snapshot is skipped if `governor` doesn't admit it: at once with
+    "skip" policy (default ``PENDING_POLICY``), after MINUTES_FOR_SNAP
+    with "queue" one.
 
     vol
         volume to snapshot;
@@ -61,73 +378,158 @@ def create_snapshot(vol, description='', tags=None, synchronously=True,
         instance by default.
     consistent
         if consistent True, script will try to freeze fs mountpoint and create
-        snapshot while it's freezed with all buffers dumped to disk.
+        snapshot while it's freezed with all buffers dumped to disk, see
+        :func:`freeze_instance`;
+    governor
+        :class:`PendingSnapshotsGovernor` limiting pending snapshots,
+        may be None;
+    on_limit
+        overrides governor policy: "queue" or "skip".
     """
+    if governor and not governor.acquire(vol, on_limit):
+        return
     if vol.attach_data:
         inst = get_inst_by_id(vol.region.name, vol.attach_data.instance_id)
     else:
         inst = None
     if not description and inst:
-        description = dumps({
-            'Volume': vol.id,
-            'Region': vol.region.name,
-            'Device': vol.attach_data.device,
-            'Instance': inst.id,
-            'Type': inst.instance_type,
-            'Arch': inst.architecture,
-            'Root_dev_name': inst.root_device_name,
-            'Time': timestamp(),
-            })
-
-    def freeze_volume():
-        key_filename = config.get(inst.region.name, 'KEY_FILENAME')
-        try:
-            _user = config.get('SYNC', 'USERNAME')
-        except:
-            _user = USERNAME
-        with settings(host_string=inst.public_dns_name,
-                      key_filename=key_filename, user=_user):
-            run('sync', shell=False)
-            run('for i in {1..20}; do sync; sleep 1; done &')
+        description = _get_snap_description(vol, inst)
 
     def initiate_snapshot():
-        if consistent:
-            if inst.state == 'running':
-                try:
-                    freeze_volume()
-                except:
-                    logger.info('FS NOT FREEZED! '
-                                'Do you have access to this server?')
-        snapshot = vol.create_snapshot(description)
-        if tags:
-            add_tags(snapshot, tags)
+        if consistent and inst:
+            with freeze_instance(inst, [vol]):
+                snapshot = vol.create_snapshot(description)
         else:
-            add_tags(snapshot, vol.tags)
-            if inst:
-                add_tags(snapshot, inst.tags)
-        logger.info('{0} started from {1} in {0.region}'.format(snapshot, vol))
+            snapshot = vol.create_snapshot(description)
+        if governor:
+            governor.register(snapshot)
+        _tag_snapshot(snapshot, vol, inst, tags)
         return snapshot
 
     if synchronously:
         while True:     # Iterate unless success and delete failed snapshots.
             snapshot = initiate_snapshot()
             try:
-                wait_for(snapshot, '100%', limit=SNAP_TIME)
-                assert snapshot.status == 'completed', (
-                    'completed with wrong status {0}'.format(snapshot.status))
-            except (StateNotChangedError, AssertionError) as err:
-                logger.error(str(err) + ' - deleting')
-                snapshot.delete()
-            else:
-                break
+                if _wait_for_snapshot(snapshot):
+                    break
+            finally:
+                if governor:
+                    governor.release(snapshot)
     else:
         snapshot = initiate_snapshot()
     return snapshot
 
 
+def create_consistent_snapshots(inst, vols, synchronously=False,
+                                governor=pending_snapshots):
+    """Return snapshots of `vols` started within single freeze of `inst`.
+
+    CreateSnapshot calls are issued concurrently and filesystems are
+    thawed as soon as the last of them returned, see
+    :func:`freeze_instance`. Snapshots are tagged and awaited after
+    thawing. Failed snapshots are deleted and not retried, because
+    retry would not be consistent with other volumes. Empty list is
+    returned if `governor` doesn't admit all snapshots together."""
+    if governor and not governor.acquire_all(vols):
+        return []
+    descriptions = dict((vol.id, _get_snap_description(vol, inst)) for
+                        vol in vols)
+
+    def initiate_snapshot(vol):
+        try:
+            snapshot = vol.create_snapshot(descriptions[vol.id])
+        except EC2ResponseError as err:
+            logger.error('Snapshot of {0} failed: {1}'.format(vol, err))
+            return
+        if governor:
+            governor.register(snapshot)
+        return snapshot
+
+    with freeze_instance(inst, vols):
+        snapshots = parallel_map(initiate_snapshot, vols)
+    started = []
+    for vol, snapshot in zip(vols, snapshots):
+        if snapshot:
+            _tag_snapshot(snapshot, vol, inst)
+            started.append(snapshot)
+    if synchronously:
+        return _wait_for_snapshots(started, governor)
+    return started
+
+
+def _wait_for_snapshots(snapshots, governor):
+    completed = []
+    for snapshot in snapshots:
+        try:
+            if _wait_for_snapshot(snapshot):
+                completed.append(snapshot)
+        finally:
+            if governor:
+                governor.release(snapshot)
+    return completed
+
+
+def _get_group_description(inst, vols):
+    return dumps({
+        'Devices': dict((vol.id, vol.attach_data.device) for vol in vols),
+        'Region': inst.region.name,
+        'Instance': inst.id,
+        'Type': inst.instance_type,
+        'Arch': inst.architecture,
+        'Root_dev_name': inst.root_device_name,
+        'Time': timestamp(),
+        }, separators=(',', ':'))
+
+
+def create_group_snapshots(inst, vols, synchronously=False, consistent=False,
+                           governor=pending_snapshots):
+    """Return snapshots of all `vols` of `inst` started with one call.
+
+    Snapshots share JSON description with the same fields as from
+    :func:`create_snapshot`, but with ``Devices`` map of volume IDs to
+    devices instead of ``Volume`` and ``Device`` fields. Tags shared by
+    all volumes, instance tags and metadata tags are applied at
+    creation, ``Volume`` and ``Device`` metadata tags of every snapshot
+    are added after it. Return None if description doesn't fit into snapshot
+    description limit.
+
+    consistent
+        freeze filesystems for the time of the call, see
+        :func:`freeze_instance`."""
+    if not vols:
+        return []
+    description = _get_group_description(inst, vols)
+    if len(description) > MAX_DESCRIPTION_LENGTH:
+        logger.warning('{0} has too many volumes to snapshot them with one '
+                       'call'.format(inst))
+        return
+    if governor and not governor.acquire_all(vols):
+        return []
+    tags = dict(item for item in vols[0].tags.items() if
+                all(item in vol.tags.items() for vol in vols))
+    tags.update(inst.tags)
+    tags = with_metadata_tags(tags, description)
+    with freeze_instance(inst, vols) if consistent else nested():
+        snapshots = create_instance_snapshots(inst, description, tags)
+    for snapshot in snapshots:
+        if governor:
+            governor.register(snapshot)
+        snapshot.description = snapshot.description or description
+        add_tags(snapshot, dict(item for item in get_metadata_tags(
+            get_volume_description(snapshot)).items() if
+            snapshot.tags.get(item[0]) != item[1]))
+        logger.info('{0} started from {1} in {0.region}'.format(
+            snapshot, snapshot.volume_id))
+    if synchronously:
+        return _wait_for_snapshots(snapshots, governor)
+    return snapshots
+
+
 @task
+@with_session_pool
 def backup_instance(region_name, instance_id=None, instance=None,
-                    synchronously=False, consistent=False):
+                    synchronously=False, consistent=False,
+                    multi_volume=False):
     """
     Return list of created snapshots for specified instance.
 
@@ -138,27 +540,55 @@ def backup_instance(region_name, instance_id=None, instance=None,
     synchronously
         wait for successful completion. False by default.
     consistent
-        if True, then FS mountpoint will be frozen before snapshotting.
-        False by default.
+        if True, then all FS mountpoints will be frozen together for the
+        time of starting snapshots, see :func:`create_consistent_snapshots`.
+        False by default;
+    multi_volume
+        if True, then all volumes will be snapshotted with one call, see
+        :func:`create_group_snapshots`. False by default.
+
+    Volumes with snapshots started within ``FRESH_SNAPSHOT_MINUTES`` are
+    skipped, see :class:`RecentSnapshots`. Volumes skipped due to
+    pending snapshots limits are absent from the list, see
+    :func:`create_snapshot`.
     """
     assert bool(instance_id) ^ bool(instance), ('Either instance_id or '
         'instance should be specified')
     conn = get_region_conn(region_name)
-    if instance_id:
-        instance = get_inst_by_id(conn.region.name, instance_id)
-    snapshots = []
-    for dev in instance.block_device_mapping:
-        vol_id = instance.block_device_mapping[dev].volume_id
-        vol = conn.get_all_volumes([vol_id])[0]
-        snapshots.append(create_snapshot(vol, synchronously=synchronously,
-                         consistent=consistent))
+    with describe_planning():
+        if instance_id:
+            instance = get_inst_by_id(conn.region.name, instance_id)
+        bdm = instance.block_device_mapping
+        volumes_batcher.prime(conn.region.name,
+                              [bdm[dev].volume_id for dev in bdm])
+        all_vols = [get_vol_by_id(conn.region.name, bdm[dev].volume_id) for
+                    dev in bdm]
+        vols = recent_snapshots.filter(all_vols)
+        snapshots = None
+        if multi_volume and len(vols) == len(all_vols):
+            snapshots = create_group_snapshots(
+                instance, vols, synchronously=synchronously,
+                consistent=consistent)
+        if snapshots is None and consistent:
+            snapshots = create_consistent_snapshots(
+                instance, vols, synchronously=synchronously)
+        elif snapshots is None:
+            snapshots = []
+            for vol in vols:
+                snapshot = create_snapshot(vol, synchronously=synchronously)
+                if snapshot:
+                    snapshots.append(snapshot)
+    for snapshot in snapshots:
+        recent_snapshots.register(snapshot)
     return snapshots
 
 
 @task
+@with_session_pool
 def backup_instances_by_tag(
         region_name=None, tag_name=DEFAULT_TAG_NAME,
-        tag_value=DEFAULT_TAG_VALUE, synchronously=False, consistent=False):
+        tag_value=DEFAULT_TAG_VALUE, synchronously=False, consistent=False,
+        multi_volume=False):
     """Creates backup for all instances with given tag in region.
 
     region_name
@@ -169,7 +599,10 @@ def backup_instances_by_tag(
         will be accomplished with assuring successful result. False by
         default;
     consistent
-        if True, then FS mountpoint will be frozen before snapshotting.
+        if True, then FS mountpoint will be frozen before snapshotting;
+    multi_volume
+        if True, then all volumes of instance will be snapshotted with
+        one call.
 
     .. note:: when ``create_ami`` task compiles AMI from several
               snapshots it restricts snapshot start_time difference with
@@ -180,21 +613,39 @@ def backup_instances_by_tag(
         regions = [get_region_conn(region_name).region]
     else:
         regions = get_region_conn().get_all_regions()
+    skipped_pending = pending_snapshots.skipped
+    skipped_fresh = recent_snapshots.skipped
     for reg in regions:
         conn = get_region_conn(reg.name)
         filters = {'resource-type': 'instance', 'key': tag_name,
                    'tag-value': tag_value}
-        for tag in conn.get_all_tags(filters=filters):
-            backup_instance(reg.name, instance_id=tag.res_id,
-                            synchronously=synchronously, consistent=consistent)
-
-
-def _trim_snapshots(region, dry_run=False):
-
-    """Delete snapshots back in time in logarithmic manner.
-
-    dry_run
-        just print snapshot to be deleted.
+        tags = conn.get_all_tags(filters=filters)
+        with describe_planning():
+            instances_batcher.prime(reg.name, [tag.res_id for tag in tags])
+            for tag in tags:
+                backup_instance(reg.name, instance_id=tag.res_id,
+                                synchronously=synchronously,
+                                consistent=consistent,
+                                multi_volume=multi_volume)
+    if pending_snapshots.skipped > skipped_pending:
+        logger.warning('{0} snapshots skipped due to pending snapshots '
+                       'limits'.format(pending_snapshots.skipped -
+                                       skipped_pending))
+    logger.info('{0} snapshots skipped as fresh ones exist'.format(
+        recent_snapshots.skipped - skipped_fresh))
+    over_budget = [inst_id for inst_id, duration in freeze_durations.items()
+                   if duration > FREEZE_BUDGET]
+    if over_budget:
+        logger.warning('Freeze budget exceeded for {0}'.format(
+            ', '.join(sorted(over_budget))))
+    log_throttling_stats()
+
+
+def _get_target_backup_times(now=None):
+    """Return cutoff dates to keep snapshot for, oldest first.
+
+    All but hourly cutoffs are truncated to the day, so they don't change
+    between runs within a day, see :func:`_is_settled`.
 
     Modified version of the `boto.ec2.connection.trim_snapshots
     <http://pypi.python.org/pypi/boto/2.0>_`. Licensed under MIT license
@@ -207,14 +658,14 @@ def _trim_snapshots(region, dry_run=False):
     yearly_backups = config.getint('purge_backups', 'YEARLY_BACKUPS')
 
     # work with UTC time, which is what the snapshot start time is reported in
-    now = datetime.utcnow()
+    now = now or datetime.utcnow()
     last_hour = datetime(now.year, now.month, now.day, now.hour)
     last_midnight = datetime(now.year, now.month, now.day)
     last_sunday = datetime(now.year, now.month,
           now.day) - timedelta(days=(now.weekday() + 1) % 7)
-    last_month = datetime.now() - relativedelta(months=1)
-    last_year = datetime.now() - relativedelta(years=1)
-    other_years = datetime.now() - relativedelta(years=2)
+    last_month = last_midnight - relativedelta(months=1)
+    last_year = last_midnight - relativedelta(years=1)
+    other_years = last_midnight - relativedelta(years=2)
     start_of_month = datetime(now.year, now.month, 1)
 
     target_backup_times = []
@@ -259,82 +710,157 @@ def _trim_snapshots(region, dry_run=False):
 
     target_backup_times = temp
     target_backup_times.reverse()  # make the oldest date first
+    return target_backup_times
 
-    # get all the snapshots, sort them by date and time,
-    #and organize them into one array for each volume:
-    conn = get_region_conn(region.name)
-    all_snapshots = conn.get_all_snapshots(owner='self')
-    # oldest first
-    all_snapshots.sort(cmp=lambda x, y: cmp(x.start_time, y.start_time))
-
-    snaps_for_each_volume = {}
-    for snap in all_snapshots:
-        # the snapshot name and the volume name are the same.
-        # The snapshot name is set from the volume
-        # name at the time the snapshot is taken
-        volume_name = get_snap_vol(snap)
-
-        if volume_name:
-            # only examine snapshots that have a volume name
-            snaps_for_volume = snaps_for_each_volume.get(volume_name)
-
-            if not snaps_for_volume:
-                snaps_for_volume = []
-                snaps_for_each_volume[volume_name] = snaps_for_volume
-            snaps_for_volume.append(snap)
 
+def _plan_trim(snaps, target_backup_times):
+
+    """Return records of snapshots to be deleted.
+
+    snaps
+        records of single volume snapshots as ``(start_time, time, id,
+        preserved)`` tuples sorted oldest first;
+    target_backup_times
+        cutoff dates sorted oldest first.
+
+    Modified version of the `boto.ec2.connection.trim_snapshots
+    <http://pypi.python.org/pypi/boto/2.0>_`. Licensed under MIT license
+    by Mitch Garnaat, 2011."""
+
+    to_delete = []
     # Do a running comparison of snapshot dates to desired time periods,
     # keeping the oldest snapshot in each
     # time period and deleting the rest:
-    for volume_name in snaps_for_each_volume:
-        snaps = snaps_for_each_volume[volume_name]
-        snaps = snaps[:-1]
-        # never delete the newest snapshot, so remove it from consideration
-
-        time_period_num = 0
-        snap_found_for_this_time_period = False
-        for snap in snaps:
-            check_this_snap = True
-
-            while (check_this_snap and
-                   time_period_num < target_backup_times.__len__()):
-
-                if get_snap_time(snap) < target_backup_times[time_period_num]:
-                    # the snap date is before the cutoff date.
-                    # Figure out if it's the first snap in this
-                    # date range and act accordingly
-                    #(since both date the date ranges and the snapshots
-                    # are sorted chronologically, we know this
-                    #snapshot isn't in an earlier date range):
-                    if snap_found_for_this_time_period:
-                        if not snap.tags.get('preserve_snapshot'):
-                            if dry_run:
-                                logger.info('Dry-trimmed {0} {1} from {2}'
-                                    .format(snap, snap.description,
-                                    snap.start_time))
-                            else:
-                                # as long as the snapshot wasn't marked with
-                                # the 'preserve_snapshot' tag, delete it:
-                                try:
-                                    conn.delete_snapshot(snap.id)
-                                except EC2ResponseError as err:
-                                    logger.exception(str(err))
-                                else:
-                                    logger.info('Trimmed {0} {1} from {2}'
-                                        .format(snap, snap.description,
-                                        snap.start_time))
-                       # go on and look at the next snapshot,
-                       # leaving the time period alone
-                    else:
-                        # this was the first snapshot found for this time
-                        # period. Leave it alone and look at the next snapshot:
-                        snap_found_for_this_time_period = True
-                    check_this_snap = False
+    snaps = snaps[:-1]
+    # never delete the newest snapshot, so remove it from consideration
+
+    time_period_num = 0
+    snap_found_for_this_time_period = False
+    for snap in snaps:
+        snap_time, preserved = snap[1], snap[3]
+        while time_period_num < len(target_backup_times):
+            if snap_time < target_backup_times[time_period_num]:
+                # the snap date is before the cutoff date.
+                # Figure out if it's the first snap in this
+                # date range and act accordingly
+                #(since both date the date ranges and the snapshots
+                # are sorted chronologically, we know this
+                #snapshot isn't in an earlier date range):
+                if snap_found_for_this_time_period:
+                    # as long as the snapshot wasn't marked with
+                    # the 'preserve_snapshot' tag, delete it:
+                    if not preserved:
+                        to_delete.append(snap)
+                   # go on and look at the next snapshot,
+                   # leaving the time period alone
                 else:
-                    # the snap is after the cutoff date.
-                    # Check it against the next cutoff date
-                    time_period_num += 1
-                    snap_found_for_this_time_period = False
+                    # this was the first snapshot found for this time
+                    # period. Leave it alone and look at the next snapshot:
+                    snap_found_for_this_time_period = True
+                break
+            else:
+                # the snap is after the cutoff date.
+                # Check it against the next cutoff date
+                time_period_num += 1
+                snap_found_for_this_time_period = False
+    return to_delete
+
+
+def _get_bucket(time_, target_backup_times):
+    """Return cutoff date `time_` is compared with or None."""
+    idx = bisect_right(target_backup_times, time_)
+    if idx < len(target_backup_times):
+        return target_backup_times[idx]
+
+
+def _is_settled(vol_state, rows, store, target_backup_times):
+    """Return True if trimming decisions for volume can't change.
+
+    It is so unless volume got new snapshots or some of kept snapshots
+    moved to another period due to hour, day, week or month rollover."""
+    if not vol_state or store.start[rows[-1]] > vol_state['watermark']:
+        return False
+    return all(_get_bucket(time_, target_backup_times) == bucket for
+               _snap_id, time_, bucket in vol_state['kept'])
+
+
+def _load_trim_state():
+    path = config.get('purge_backups', 'STATE_FILE')
+    if path and os.path.exists(path):
+        with open(path) as state_file:
+            return loads(state_file.read())
+    return {}
+
+
+def _save_trim_state(state):
+    path = config.get('purge_backups', 'STATE_FILE')
+    if path:
+        with open(path + '.tmp', 'w') as state_file:
+            state_file.write(dumps(state))
+        os.rename(path + '.tmp', path)
+
+
+def _trim_snapshots(region, dry_run=False, state=None, now=None):
+
+    """Delete snapshots back in time in logarithmic manner.
+
+    dry_run
+        just print snapshot to be deleted;
+    state
+        dict with per-volume watermarks from previous runs, will be
+        updated in place. Volumes with settled decisions will be
+        skipped. All volumes are re-planned if None. Volumes with failed
+        deletions are re-planned next time, volumes without snapshots
+        are dropped;
+    now
+        UTC time to compute cutoff dates from, current by default.
+
+    Snapshots are streamed with :func:`django_fabfile.utils.iter_snapshots`
+    into :class:`django_fabfile.snapshot_store.SnapshotStore`. See
+    :func:`_plan_trim` for the deletion rules."""
+    target_backup_times = [to_epoch(t) for t in
+                           _get_target_backup_times(now)]
+    conn = get_region_conn(region.name)
+    # Only snapshots that have a volume name are examined.
+    store = SnapshotStore().extend(iter_snapshots(conn))
+    replanned = 0
+    for volume_name, rows in store.group_by_volume():
+        if state is not None and _is_settled(
+                state.get(volume_name), rows, store, target_backup_times):
+            continue
+        replanned += 1
+        snaps = [(store.start[idx], store.time[idx], store.snapshot_id(idx),
+                  store.flags[idx] & PRESERVED) for idx in rows]
+        deleted = set()
+        failed = False
+        for start, _time, snap_id, _preserved in _plan_trim(
+                snaps, target_backup_times):
+            if dry_run:
+                logger.info('Dry-trimmed {0} of {1} from {2}'.format(
+                    snap_id, volume_name, from_epoch(start)))
+                continue
+            try:
+                conn.delete_snapshot(snap_id)
+            except EC2ResponseError as err:
+                logger.exception(str(err))
+                failed = True
+            else:
+                deleted.add(snap_id)
+                logger.info('Trimmed {0} of {1} from {2}'.format(
+                    snap_id, volume_name, from_epoch(start)))
+        if state is not None and not dry_run:
+            if failed:
+                state.pop(volume_name, None)
+            else:
+                state[volume_name] = {'watermark': snaps[-1][0], 'kept': [
+                    (snap_id, time_, _get_bucket(time_, target_backup_times))
+                    for _start, time_, snap_id, _preserved in snaps[:-1]
+                    if snap_id not in deleted]}
+    if state is not None and not dry_run:
+        for volume_name in set(state) - set(store.volumes):
+            del state[volume_name]
+    logger.info('Re-planned {0} of {1} volumes in {2}'.format(
+        replanned, len(store.volumes), region))
 
 
 @task
@@ -350,26 +876,38 @@ def delete_broken_snapshots():
 
 
 @task
-def trim_snapshots(region_name=None, dry_run=False):
+def trim_snapshots(region_name=None, dry_run=False, full=False):
     """Delete old snapshots logarithmically back in time.
 
     region_name
         by default process all regions;
     dry_run
-        boolean, only print info about old snapshots to be deleted."""
+        boolean, only print info about old snapshots to be deleted;
+    full
+        re-plan all volumes instead of only volumes with new snapshots
+        or with snapshots moved to another period since previous run.
+        Per-volume watermarks are kept in ``STATE_FILE`` from
+        ``[purge_backups]`` section."""
     delete_broken_snapshots()
     if region_name:
         regions = [get_region_conn(region_name).region]
     else:
         regions = get_region_conn().get_all_regions()
+    state = _load_trim_state()
     for reg in regions:
         logger.info('Processing {0}'.format(reg))
-        _trim_snapshots(reg, dry_run=dry_run)
+        reg_state = {} if full else state.get(reg.name, {})
+        _trim_snapshots(reg, dry_run=dry_run, state=reg_state)
+        if not dry_run:
+            state[reg.name] = reg_state
+            _save_trim_state(state)
+    log_throttling_stats()
 
 
 @task
+@with_session_pool
 def rsync_mountpoints(src_inst, src_vol, src_mnt, dst_inst, dst_vol, dst_mnt,
-                      encr=False):
+                      encr=False, src_ctx=None, dst_ctx=None):
     """Run `rsync` against mountpoints, copy disk label.
 
     :param src_inst: source instance;
@@ -381,53 +919,56 @@ def rsync_mountpoints(src_inst, src_vol, src_mnt, dst_inst, dst_vol, dst_mnt,
                     from src_vol;
     :param dst_mnt: destination point where source hierarchy to place;
     :param encr: True if volume is encrypted;
-    :type encr: bool."""
-    src_key_filename = config.get(src_inst.region.name, 'KEY_FILENAME')
-    dst_key_filename = config.get(dst_inst.region.name, 'KEY_FILENAME')
-    with config_temp_ssh(dst_inst.connection) as key_file:
-        with settings(host_string=dst_inst.public_dns_name,
-                      key_filename=dst_key_filename):
-            wait_for_sudo('cp /root/.ssh/authorized_keys '
-                          '/root/.ssh/authorized_keys.bak')
-            pub_key = local('ssh-keygen -y -f {0}'.format(key_file), True)
-            append('/root/.ssh/authorized_keys', pub_key, use_sudo=True)
-            if encr:
-                sudo('screen -d -m sh -c "nc -l 60000 | gzip -dfc | '
-                     'sudo dd of={0} bs=16M"'
-                     .format(get_vol_dev(dst_vol)), pty=False)  # dirty magick
-                dst_ip = sudo(
-                    'curl http://169.254.169.254/latest/meta-data/public-ipv4')
-
-        with settings(host_string=src_inst.public_dns_name,
-                      key_filename=src_key_filename):
-            put(key_file, '.ssh/', mirror_local_mode=True)
-            dst_key_filename = os.path.split(key_file)[1]
-            if encr:
-                sudo('(dd if={0} bs=16M | gzip -cf --fast | nc -v {1} 60000)'
-                     .format(get_vol_dev(src_vol), dst_ip))
-            else:
-                cmd = (
-                    'rsync -e "ssh -i .ssh/{key_file} -o '
-                    'StrictHostKeyChecking=no" -cahHAX --delete --inplace '
-                    '--exclude /root/.bash_history '
-                    '--exclude /home/*/.bash_history '
-                    '--exclude /etc/ssh/moduli --exclude /etc/ssh/ssh_host_* '
-                    '--exclude /etc/udev/rules.d/*persistent-net.rules '
-                    '--exclude /var/lib/ec2/* --exclude=/mnt/* '
-                    '--exclude=/proc/* --exclude=/tmp/* '
-                    '{src_mnt}/ root@{rhost}:{dst_mnt}')
-                wait_for_sudo(cmd.format(
-                    rhost=dst_inst.public_dns_name, dst_mnt=dst_mnt,
-                    key_file=dst_key_filename, src_mnt=src_mnt))
-                label = sudo('e2label {0}'.format(get_vol_dev(src_vol)))
-        with settings(host_string=dst_inst.public_dns_name,
-                      key_filename=dst_key_filename):
-            if not encr:
-                sudo('e2label {0} {1}'.format(get_vol_dev(dst_vol), label))
-            wait_for_sudo('mv /root/.ssh/authorized_keys.bak '
-                          '/root/.ssh/authorized_keys')
-            run('sync', shell=False)
-            run('for i in {1..20}; do sync; sleep 1; done &')
+    :type encr: bool;
+    :param src_ctx: :class:`django_fabfile.remote.ExecutionContext` of
+                    src_inst, new one by default;
+    :param dst_ctx: context of dst_inst, new one by default."""
+    with nested(config_temp_ssh(dst_inst.connection),
+                instance_context(src_inst, src_ctx),
+                instance_context(dst_inst, dst_ctx)) as (key_file, src_ctx,
+                                                         dst_ctx):
+        dst_ctx.wait_for_sudo('cp /root/.ssh/authorized_keys '
+                              '/root/.ssh/authorized_keys.bak')
+        pub_key = quote(local('ssh-keygen -y -f {0}'.format(key_file), True))
+        dst_ctx.sudo('grep -qxF {0} /root/.ssh/authorized_keys || echo {0} '
+                     '>> /root/.ssh/authorized_keys'.format(pub_key))
+        if encr:
+            dst_ctx.sudo('screen -d -m sh -c "nc -l 60000 | gzip -dfc | '
+                         'sudo dd of={0} bs=16M"'
+                         .format(get_vol_dev(dst_vol, dst_ctx)))
+            dst_ip = dst_ctx.sudo(
+                'curl -s http://169.254.169.254/latest/meta-data/public-ipv4')
+
+        dst_key_filename = os.path.split(key_file)[1]
+        with open(key_file) as key:
+            src_ctx.put(key.read(), '.ssh/' + dst_key_filename, mode=0600)
+        if encr:
+            src_ctx.sudo('(dd if={0} bs=16M | gzip -cf --fast | nc -v {1} '
+                         '60000)'.format(get_vol_dev(src_vol, src_ctx),
+                                         dst_ip))
+        else:
+            cmd = (
+                'rsync -e "ssh -i .ssh/{key_file} -o '
+                'StrictHostKeyChecking=no" -cahHAX --delete --inplace '
+                '--exclude /root/.bash_history '
+                '--exclude /home/*/.bash_history '
+                '--exclude /etc/ssh/moduli --exclude /etc/ssh/ssh_host_* '
+                '--exclude /etc/udev/rules.d/*persistent-net.rules '
+                '--exclude /var/lib/ec2/* --exclude=/mnt/* '
+                '--exclude=/proc/* --exclude=/tmp/* '
+                '{src_mnt}/ root@{rhost}:{dst_mnt}')
+            src_ctx.wait_for_sudo(cmd.format(
+                rhost=dst_inst.public_dns_name, dst_mnt=dst_mnt,
+                key_file=dst_key_filename, src_mnt=src_mnt))
+            label = src_ctx.sudo('e2label {0}'.format(get_vol_dev(src_vol,
+                                                                  src_ctx)))
+            dst_ctx.sudo('e2label {0} {1}'.format(get_vol_dev(dst_vol,
+                                                              dst_ctx), label))
+        dst_ctx.wait_for_sudo('mv /root/.ssh/authorized_keys.bak '
+                              '/root/.ssh/authorized_keys')
+        dst_ctx.run('sync')
+        dst_ctx.run('(for i in {1..20}; do sync; sleep 1; done) '
+                    '>/dev/null 2>&1 &')
 
 
 def update_snap(src_vol, src_mnt, dst_vol, dst_mnt, encr, delete_old=False):
@@ -436,7 +977,7 @@ def update_snap(src_vol, src_mnt, dst_vol, dst_mnt, encr, delete_old=False):
 
     Create new snapshot with same description and tags. Delete previous
     snapshot (if exists) of the same volume in destination region if
-    ``delete_old`` is True."""
+    ``delete_old`` is True and new snapshot was started."""
 
     src_inst = get_inst_by_id(src_vol.region.name,
                               src_vol.attach_data.instance_id)
@@ -444,17 +985,58 @@ def update_snap(src_vol, src_mnt, dst_vol, dst_mnt, encr, delete_old=False):
                               dst_vol.attach_data.instance_id)
     rsync_mountpoints(src_inst, src_vol, src_mnt, dst_inst, dst_vol, dst_mnt,
                      encr)
-    src_snap = src_vol.connection.get_all_snapshots([src_vol.snapshot_id])[0]
-    create_snapshot(dst_vol, description=src_snap.description,
-                                    tags=src_snap.tags, synchronously=False)
+    src_snap = get_snap_by_id(src_vol.region.name, src_vol.snapshot_id)
+    snapshot = create_snapshot(
+        dst_vol, description=get_volume_description(src_snap),
+        tags=src_snap.tags, synchronously=False, on_limit='queue')
+    if not snapshot:
+        logger.error('Replica of {0} is not started in {1}'.format(
+            src_snap, dst_vol.region))
+        return
     if delete_old and dst_vol.snapshot_id:
-        old_snap = dst_vol.connection.get_all_snapshots(
-            [dst_vol.snapshot_id])[0]
+        old_snap = get_snap_by_id(dst_vol.region.name, dst_vol.snapshot_id)
         logger.info('Deleting previous {0} in {1}'.format(old_snap,
                                                           dst_vol.region))
         old_snap.delete()
 
 
+@task
+def tag_snapshots_metadata(region_name=None, dry_run=False):
+    """Mirror description attributes of existing snapshots to tags.
+
+    region_name
+        will be applied across all regions by default;
+    dry_run
+        only log number of requests.
+
+    Snapshots created by this module are tagged on creation, the task
+    is required once for older ones. Tags are added to many snapshots
+    with every request."""
+    if region_name:
+        regions = [get_region_conn(region_name).region]
+    else:
+        regions = get_region_conn().get_all_regions()
+    for reg in regions:
+        conn = get_region_conn(reg.name)
+        snap_ids = defaultdict(list)    # Tag to list of snapshots IDs.
+        tagged = 0
+        for snap in iter_snapshots(conn):
+            missing = [tag for tag in get_metadata_tags(
+                get_volume_description(snap)).items() if
+                snap.tags.get(tag[0]) != tag[1]]
+            for tag in missing:
+                snap_ids[tag].append(snap.id)
+            tagged += bool(missing)
+        requests = 0
+        for (key, val), ids in sorted(snap_ids.items()):
+            for i in xrange(0, len(ids), 500):
+                requests += 1
+                if not dry_run:
+                    conn.create_tags(ids[i:i + 500], {key: val})
+        logger.info('{0} snapshots tagged in {1} with {2} requests'.format(
+            tagged, reg, requests))
+
+
 @contextmanager
 def create_tmp_volume(region, size):
     """Format new filesystem."""
@@ -472,19 +1054,50 @@ def create_tmp_volume(region, size):
             vol.delete()
 
 
-def get_relevant_snapshots(
+def iter_relevant_snapshots(
         conn, tag_name=DEFAULT_TAG_NAME, tag_value=DEFAULT_TAG_VALUE,
-        native_only=True, filters={'status': SNAP_STATUSES}):
-    """Returns snapshots with proper description."""
+        native_only=True, filters=None):
+    """Yield snapshots with proper description.
+
+    Snapshots of native volumes are filtered by tag mirroring description
+    attribute, see :func:`tag_snapshots_metadata`."""
+    filters = dict(filters or {'status': SNAP_STATUSES})
     if tag_name and tag_value:
         filters.update({'tag:{0}'.format(tag_name): tag_value})
-    snaps = conn.get_all_snapshots(owner='self', filters=filters)
-    is_described = lambda snap: get_snap_vol(snap) and get_snap_time(snap)
-    snaps = [snp for snp in snaps if is_described(snp)]
     if native_only:
-        is_native = lambda snp, reg: get_descr_attr(snp, 'Region') == reg.name
-        snaps = [snp for snp in snaps if is_native(snp, conn.region)]
-    return snaps
+        filters['tag:' + METADATA_TAG.format('Region')] = conn.region.name
+    for snap in iter_snapshots(conn, filters=filters):
+        if not (get_snap_vol(snap) and get_snap_time(snap)):
+            continue
+        yield snap
+
+
+def get_relevant_snapshots(
+        conn, tag_name=DEFAULT_TAG_NAME, tag_value=DEFAULT_TAG_VALUE,
+        native_only=True, filters=None):
+    """Returns snapshots with proper description."""
+    return list(iter_relevant_snapshots(conn, tag_name, tag_value,
+                                        native_only, filters))
+
+
+def get_latest_snapshots(
+        conn, tag_name=DEFAULT_TAG_NAME, tag_value=DEFAULT_TAG_VALUE,
+        native_only=True):
+    """Return latest relevant snapshot for every volume.
+
+    Snapshots are streamed into
+    :class:`django_fabfile.snapshot_store.SnapshotStore`, then latest
+    ones are fetched again with coalesced requests."""
+    store = SnapshotStore().extend(iter_relevant_snapshots(
+        conn, tag_name, tag_value, native_only))
+    latest = store.latest_by_volume()
+    snap_ids = [store.snapshot_id(latest[vol_id]) for vol_id in
+                sorted(latest)]
+    with describe_planning():
+        snapshots_batcher.prime(conn.region.name, snap_ids)
+        snaps = [get_snap_by_id(conn.region.name, snap_id) for snap_id in
+                 snap_ids]
+    return [snap for snap in snaps if snap]     # Skip just deleted.
 
 
 def get_replicas(descriptions, dst_conn):
@@ -502,26 +1115,24 @@ def get_oldest_replica(
         src_conn, dst_conn, amount=1, native_only=True,
         tag_name=DEFAULT_TAG_NAME, tag_value=DEFAULT_TAG_VALUE):
     """Return list with (one by default) not yet replicated snapshots."""
-    snaps = get_relevant_snapshots(src_conn, tag_name, tag_value, native_only)
-    if not snaps:
+    latest_snaps = get_latest_snapshots(src_conn, tag_name, tag_value,
+                                        native_only)
+    if not latest_snaps:
         return []
-    # Separating out all but latest snapshots for every volume.
-    latest_snaps = []
-    snaps = sorted(snaps, key=get_snap_vol)
-    for vol_id, vol_snaps in groupby(snaps, key=get_snap_vol):
-        latest_snaps.append(sorted(vol_snaps, key=get_snap_time)[-1])
     # Seeking for latests replicas in dst region for every new snapshot.
-    latest_descriptions = [snp.description for snp in latest_snaps]
+    latest_descriptions = [get_volume_description(snp) for snp in
+                           latest_snaps]
     dst_snaps, dst_vols = get_replicas(latest_descriptions, dst_conn)
     snap_desc = [snp.description for snp in dst_snaps]
     vol_desc = [vol.tags[DESCRIPTION_TAG] for vol in dst_vols]
     # Seeking for snaps wihtout replicas.
     snaps_to_replicate = [snp for snp in latest_snaps if
-        snp.description not in set(snap_desc + vol_desc)]
+        get_volume_description(snp) not in set(snap_desc + vol_desc)]
     return sorted(snaps_to_replicate, key=get_snap_time)[:amount]
 
 
 @task
+@with_session_pool
 def rsync_snapshot(src_region_name, snapshot_id, dst_region_name,
                    src_inst=None, dst_inst=None, force=False):
 
@@ -540,7 +1151,7 @@ def rsync_snapshot(src_region_name, snapshot_id, dst_region_name,
 
     You'll need to open port 60000 for encrypted instances replication."""
     src_conn = get_region_conn(src_region_name)
-    src_snap = src_conn.get_all_snapshots([snapshot_id])[0]
+    src_snap = get_snap_by_id(src_conn.region.name, snapshot_id)
     dst_conn = get_region_conn(dst_region_name)
     _src_device = get_snap_device(src_snap)
     _src_dev = re.match(r'^/dev/sda$', _src_device)  # check for encryption
@@ -558,13 +1169,16 @@ def rsync_snapshot(src_region_name, snapshot_id, dst_region_name,
                             name=src_snap.tags.get('Name')))
 
     src_vol = get_snap_vol(src_snap)
-    dst_snaps = get_relevant_snapshots(dst_conn, native_only=False)
-    vol_snaps = [snp for snp in dst_snaps if get_snap_vol(snp) == src_vol]
+    vol_snaps = list(iter_relevant_snapshots(
+        dst_conn, native_only=False, filters={
+            'status': SNAP_STATUSES,
+            'tag:' + METADATA_TAG.format('Volume'): src_vol}))
 
     def sync_mountpoints(src_snap, src_vol, src_mnt, dst_vol, dst_mnt):
         # Marking temporary volume with snapshot's description.
-        dst_vol.add_tag(DESCRIPTION_TAG, src_snap.description)
-        snaps, vols = get_replicas(src_snap.description, dst_vol.connection)
+        description = get_volume_description(src_snap)
+        dst_vol.add_tag(DESCRIPTION_TAG, description)
+        snaps, vols = get_replicas(description, dst_vol.connection)
         if not force and snaps:
             raise ReplicationCollisionError(
                 'Stepping over {snap} - it\'s already replicated as {snaps} '
@@ -611,6 +1225,7 @@ def rsync_snapshot(src_region_name, snapshot_id, dst_region_name,
 
 
 @task
+@with_session_pool
 def rsync_region(
         src_region_name, dst_region_name, tag_name=DEFAULT_TAG_NAME,
         tag_value=DEFAULT_TAG_VALUE, native_only=True):
@@ -627,14 +1242,13 @@ def rsync_region(
         default."""
     src_conn = get_region_conn(src_region_name)
     dst_conn = get_region_conn(dst_region_name)
-    snaps = get_relevant_snapshots(src_conn, tag_name, tag_value, native_only)
-    if not snaps:
+    latest_snaps = get_latest_snapshots(src_conn, tag_name, tag_value,
+                                        native_only)
+    if not latest_snaps:
         return
     with nested(create_temp_inst(src_conn.region),
                 create_temp_inst(dst_conn.region)) as (src_inst, dst_inst):
-        snaps = sorted(snaps, key=get_snap_vol)    # Prepare for grouping.
-        for vol, vol_snaps in groupby(snaps, get_snap_vol):
-            latest_snap = sorted(vol_snaps, key=get_snap_time)[-1]
+        for latest_snap in latest_snaps:
             for inst in src_inst, dst_inst:
                 logger.debug('Rebooting {0} in {0.region} '
                              'to refresh attachments'.format(inst))
@@ -646,9 +1260,11 @@ def rsync_region(
             except:
                 logger.exception('rsync of {1} from {0} to {2} failed'.format(
                     *args))
+    log_throttling_stats()
 
 
 @task
+@with_session_pool
 def rsync_all_regions(primary_backup_region, secondary_backup_region):
     """
     Replicates snapshots across all regions.
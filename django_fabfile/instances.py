@@ -8,31 +8,42 @@ import logging
 import os
 import re
 from string import lowercase
-from time import sleep
+from threading import Lock
+from time import sleep, time
 from traceback import format_exc
 
 from boto.ec2.blockdevicemapping import BlockDeviceMapping, EBSBlockDeviceType, BlockDeviceType
 from boto.exception import BotoServerError
-from fabric.api import env, output, prompt, put, settings, sudo, task
+from fabric.api import prompt, put, settings, sudo, task
 from fabric.context_managers import hide
 from pkg_resources import resource_stream
 
 from django_fabfile import __name__ as pkg_name
-from django_fabfile.security_groups import new_security_group
+from django_fabfile.remote import (ExecutionContext, instance_context,
+                                   retried, with_session_pool)
+from django_fabfile.security_groups import (get_pool_security_group,
+                                            new_security_group)
 from django_fabfile.utils import (
-    StateNotChangedError, add_tags, config, config_temp_ssh, get_descr_attr,
-    get_inst_by_id, get_region_conn, get_snap_device, get_snap_instance,
-    get_snap_time, timestamp, wait_for, wait_for_exists, wait_for_sudo)
+    METADATA_TAG, StateNotChangedError, add_tags, config, config_temp_ssh,
+    get_descr_attr, get_inst_by_id, get_region_conn, get_snap_by_id,
+    get_snap_device, get_snap_instance, get_snap_time, iter_snapshots,
+    timestamp, wait_for, wait_for_sudo)
 
 
 USERNAME = config.get('DEFAULT', 'USERNAME')
-env.update({'user': USERNAME, 'disable_known_hosts': True})
 
 logger = logging.getLogger(__name__)
 
 
 DETACH_TIME = config.getint('DEFAULT', 'MINUTES_FOR_DETACH') * 60
 SNAP_TIME = config.getint('DEFAULT', 'MINUTES_FOR_SNAP') * 60
+# Names and serial numbers (NVMe only) of block devices and partitions.
+LIST_DEVICES = ('for dev in /sys/class/block/*; do echo "${dev##*/}" '
+                '$(cat "$dev/device/serial" 2>/dev/null); done')
+
+# (volume ID, instance ID, attach time) to device, see `get_vol_dev`.
+_vol_devs = {}
+_vol_devs_lock = Lock()
 
 
 @task
@@ -152,47 +163,83 @@ class NoDevFoundError(Exception):
     pass
 
 
-def get_vol_dev(vol):
-    """Return OS-specific volume representation as attached device."""
-    assert vol.attach_data.instance_id
+def _get_vol_context(vol, ctx=None):
+    """Return `ctx` or context of the instance `vol` is attached to."""
+    if ctx:
+        return ctx
     inst = get_inst_by_id(vol.region.name, vol.attach_data.instance_id)
     assert inst.public_dns_name, 'Instance is down'
-    key_filename = config.get(vol.region.name, 'KEY_FILENAME')
-    attached_dev = vol.attach_data.device
-    natty_dev = attached_dev.replace('sd', 'xvd')
-    representations = [attached_dev, natty_dev]
-    with settings(host_string=inst.public_dns_name, key_filename=key_filename):
-        logger.debug(env, output)
-        for dev in representations:
-            if wait_for_exists(dev):
-                return dev
+    return ExecutionContext.for_instance(inst)
+
+
+def find_vol_dev(vol, listing):
+    """Return device of `vol` from `listing` of :data:`LIST_DEVICES`.
+
+    NVMe device is matched by serial number which is volume ID without
+    dash, others by attachment device name as is or with "xvd" instead
+    of "sd"."""
+    devices = dict((line.split() + [''])[:2] for line in
+                   listing.splitlines() if line.strip())
+    serial = vol.id.replace('-', '')
+    for name in sorted(devices):
+        if devices[name] == serial:
+            return '/dev/' + name
+    attached = vol.attach_data.device.replace('/dev/', '')
+    for name in attached, attached.replace('sd', 'xvd'):
+        if name in devices:
+            return '/dev/' + name
+
+
+def get_vol_dev(vol, ctx=None):
+    """Return OS-specific volume representation as attached device.
+
+    Devices of instance are listed with single command, result is cached
+    for the attachment, so repeated calls make no requests.
+
+    ctx
+        :class:`django_fabfile.remote.ExecutionContext` of the instance
+        `vol` is attached to, new one by default."""
+    assert vol.attach_data.instance_id
+    key = (vol.id, vol.attach_data.instance_id, vol.attach_data.attach_time)
+    with _vol_devs_lock:
+        if key in _vol_devs:
+            return _vol_devs[key]
+    ctx = _get_vol_context(vol, ctx)
+    listing = retried(ctx.run)(LIST_DEVICES, warn_only=False,
+                               label='list devices')
+    dev = find_vol_dev(vol, listing or '')
+    if not dev:
         raise NoDevFoundError(
-            'Nothing from {variants} was located at {host.state} {host} for '
-            '{vol} with {vol.attach_data.__dict__}'.format(
-                host=inst, vol=vol, variants=representations))
+            '{vol} with {vol.attach_data.__dict__} was not located at {host} '
+            'among:\n{listing}'.format(vol=vol, host=ctx.host,
+                                        listing=listing))
+    with _vol_devs_lock:
+        _vol_devs[key] = dev
+    return dev
 
 
-def mount_volume(vol, mkfs=False):
+def mount_volume(vol, mkfs=False, ctx=None):
 
     """Mount the device by SSH. Return mountpoint on success.
 
     vol
-        volume to be mounted on the instance it is attached to."""
+        volume to be mounted on the instance it is attached to;
+    ctx
+        execution context of the instance, see :func:`get_vol_dev`."""
 
     wait_for(vol, 'attached', ['attach_data', 'status'])
-    inst = get_inst_by_id(vol.region.name, vol.attach_data.instance_id)
-    key_filename = config.get(vol.region.name, 'KEY_FILENAME')
-    with settings(host_string=inst.public_dns_name, key_filename=key_filename):
-        dev = get_vol_dev(vol)
-        mountpoint = dev.replace('/dev/', '/media/')
-        wait_for_sudo('mkdir -p {0}'.format(mountpoint))
-        if mkfs:
-            sudo('mkfs.ext3 {dev}'.format(dev=dev))
-        sudo('mount {dev} {mnt}'.format(dev=dev, mnt=mountpoint))
-        if mkfs:
-            sudo('chown -R {user}:{user} {mnt}'.format(user=env.user,
+    ctx = _get_vol_context(vol, ctx)
+    dev = get_vol_dev(vol, ctx)
+    mountpoint = dev.replace('/dev/', '/media/')
+    ctx.wait_for_sudo('mkdir -p {0}'.format(mountpoint))
+    if mkfs:
+        ctx.sudo('mkfs.ext3 {dev}'.format(dev=dev))
+    ctx.sudo('mount {dev} {mnt}'.format(dev=dev, mnt=mountpoint))
+    if mkfs:
+        ctx.sudo('chown -R {user}:{user} {mnt}'.format(user=ctx.user,
                                                        mnt=mountpoint))
-    logger.debug('Mounted {0} to {1} at {2}'.format(vol, inst, mountpoint))
+    logger.debug('Mounted {0} to {1} at {2}'.format(vol, ctx.host,
+                                                    mountpoint))
     return mountpoint
 
 
@@ -239,25 +286,23 @@ def attach_snapshot(snap, key_pair=None, security_groups='', inst=None,
     def attach_snap_to_inst(inst, snap):
         """Cleanup volume(s)."""
         wait_for(inst, 'running')
+        ctx = ExecutionContext.for_instance(inst)
         try:
             vol, volumes = force_snap_attach(inst, snap)
             if encr:
                 mnt = None
             else:
-                mnt = mount_volume(vol)
+                mnt = mount_volume(vol, ctx=ctx)
             yield vol, mnt
         except BaseException as err:
             logger.exception(str(err))
             raise
         finally:
-            key_filename = config.get(inst.region.name, 'KEY_FILENAME')
-            with settings(host_string=inst.public_dns_name,
-                          key_filename=key_filename):
-                if not encr:
-                    try:
-                        wait_for_sudo('umount {0}'.format(mnt))
-                    except:
-                        pass
+            if not encr:
+                try:
+                    ctx.wait_for_sudo('umount {0}'.format(mnt))
+                except:
+                    pass
             for vol in volumes:
                 if vol.status != 'available':
                     vol.detach(force=True)
@@ -276,6 +321,7 @@ def attach_snapshot(snap, key_pair=None, security_groups='', inst=None,
 
 
 @task
+@with_session_pool
 def modify_kernel(region, instance_id):
     """
     Modify old kernel for stopped instance (needed for make pv-grub working)
@@ -295,16 +341,13 @@ def modify_kernel(region, instance_id):
         us-east-1       i386    aki-407d9529
         us-west-1       x86_64  aki-9ba0f1de
         us-west-1       i386    aki-99a0f1dc"""
-    key_filename = config.get(region, 'KEY_FILENAME')
     conn = get_region_conn(region)
     instance = get_inst_by_id(conn.region.name, instance_id)
-    env.update({
-        'host_string': instance.public_dns_name,
-        'key_filename': key_filename,
-    })
-    sudo('env DEBIAN_FRONTEND=noninteractive apt-get update && '
-         'env DEBIAN_FRONTEND=noninteractive apt-get dist-upgrade && '
-         'env DEBIAN_FRONTEND=noninteractive apt-get install grub-legacy-ec2')
+    with instance_context(instance) as ctx:
+        ctx.sudo('env DEBIAN_FRONTEND=noninteractive apt-get update && '
+                 'env DEBIAN_FRONTEND=noninteractive apt-get -y '
+                 'dist-upgrade && env DEBIAN_FRONTEND=noninteractive '
+                 'apt-get -y install grub-legacy-ec2')
     kernel = config.get(conn.region.name,
                         'KERNEL' + instance.architecture.upper())
     instance.stop()
@@ -316,7 +359,7 @@ def modify_kernel(region, instance_id):
 def make_encrypted_ubuntu(host_string, key_filename, user,
                           architecture, dev, name, release, pw1, pw2):
     with settings(host_string=host_string, user=user,
-                  key_filename=key_filename):
+                  key_filename=key_filename, disable_known_hosts=True):
         data = '/home/' + user + '/data'
         page = 'https://uec-images.ubuntu.com/releases/' \
                + release + '/release/'
@@ -540,6 +583,7 @@ def modify_instance_termination(region, instance_id):
 
 
 @task
+@with_session_pool
 def mount_snapshot(region_name, snap_id, inst_id=None):
 
     """Mount snapshot to temporary created instance or inst_id.
@@ -552,7 +596,7 @@ def mount_snapshot(region_name, snap_id, inst_id=None):
 
     conn = get_region_conn(region_name)
     inst = get_inst_by_id(conn.region.name, inst_id) if inst_id else None
-    snap = conn.get_all_snapshots(snapshot_ids=[snap_id, ])[0]
+    snap = get_snap_by_id(conn.region.name, snap_id)
 
     info = ('\nYou may now SSH into the {inst} server, using:'
             '\n ssh -i {key} {user}@{inst.public_dns_name}')
@@ -565,7 +609,7 @@ def mount_snapshot(region_name, snap_id, inst_id=None):
         key_file = config.get(conn.region.name, 'KEY_FILENAME')
         inst = get_inst_by_id(conn.region.name, vol.attach_data.instance_id)
         assert inst
-        logger.info(info.format(inst=inst, user=env.user, key=key_file,
+        logger.info(info.format(inst=inst, user=USERNAME, key=key_file,
             device=vol.attach_data.device, mountpoint=mountpoint))
 
         info = ('\nEnter FINISHED if you are finished looking at the '
@@ -577,7 +621,7 @@ def mount_snapshot(region_name, snap_id, inst_id=None):
 @task
 def launch_instance_from_ami(
     region_name, ami_id, inst_type=None, security_groups='', key_pair=None,
-    zone_name=None, user_data=None):
+    zone_name=None, user_data=None, own_security_group=False):
     """Create instance from specified AMI.
 
     region_name
@@ -596,12 +640,24 @@ def launch_instance_from_ami(
     zone_name
         in string format;
     user_data
-        string with OS configuration commands."""
+        string with OS configuration commands;
+    own_security_group
+        create new Security Group with SSH access for this instance
+        instead of shared one, see
+        :func:`django_fabfile.security_groups.get_pool_security_group`.
+
+    Time spent for Security Group and for launch is logged."""
+    started = time()
     conn = get_region_conn(region_name)
     image = conn.get_all_images([ami_id])[0]
     inst_type = inst_type or get_descr_attr(image, 'Type') or 't1.micro'
     security_groups = filter(None, security_groups.strip(';').split(';'))
-    security_groups.append(new_security_group(conn.region))
+    sg_started = time()
+    if own_security_group:
+        security_groups.append(new_security_group(conn.region))
+    else:
+        security_groups.append(get_pool_security_group(conn.region))
+    sg_time = time() - sg_started
     logger.info('Launching new instance in {reg} using {image}'
                 .format(reg=conn.region, image=image))
     inst = image.run(
@@ -615,11 +671,13 @@ def launch_instance_from_ami(
     inst.add_tag('Security Groups', dumps(groups, separators=(',', ':')))
     add_tags(inst, image.tags)
     modify_instance_termination(conn.region.name, inst.id)
-    logger.info('{inst} created in {inst.placement}'.format(inst=inst))
+    logger.info('{inst} created in {inst.placement} in {total:.1f} sec, '
+                'Security Group prepared in {sg:.1f} sec'.format(
+                    inst=inst, total=time() - started, sg=sg_time))
     info = ('\nYou may now SSH into the {inst} server, using:'
             '\n ssh -i {key} {user}@{inst.public_dns_name}')
     key_file = config.get(conn.region.name, 'KEY_FILENAME')
-    logger.info(info.format(inst=inst, user=env.user, key=key_file))
+    logger.info(info.format(inst=inst, user=USERNAME, key=key_file))
     return inst
 
 
@@ -637,7 +695,8 @@ def create_ami(region, snap_id, force=None, root_dev='/dev/sda1', zone_name=None
         format will be used to restore instance with same parameters.
         Will automaticaly process snapshots for same instance with near
         time (10 minutes or shorter), but for other devices (/dev/sdb,
-        /dev/sdc, etc);
+        /dev/sdc, etc). Snapshots started with multi-volume call are
+        found by the same description;
     force
         Run instance from ami after creation without confirmation. To
         enable set value to "RUN";
@@ -651,14 +710,21 @@ def create_ami(region, snap_id, force=None, root_dev='/dev/sda1', zone_name=None
         with semicolon ';'. Used only if ``force`` is "RUN".
     """
     conn = get_region_conn(region)
-    snap = conn.get_all_snapshots(snapshot_ids=[snap_id, ])[0]
+    snap = get_snap_by_id(conn.region.name, snap_id)
     instance_id = get_snap_instance(snap)
     _device = get_snap_device(snap)
-    snaps = conn.get_all_snapshots(owner='self')
-    snapshots = [snp for snp in snaps if
-        get_snap_instance(snp) == instance_id and
-        get_snap_device(snp) != _device and
-        abs(get_snap_time(snap) - get_snap_time(snp)) <= timedelta(minutes=10)]
+    if get_descr_attr(snap, 'Devices'):
+        # Started with multi-volume call and share description.
+        snapshots = [snp for snp in conn.get_all_snapshots(
+            owner='self', filters={'description': snap.description}) if
+            snp.id != snap.id]
+    else:
+        snapshots = [snp for snp in iter_snapshots(conn, filters={
+            'tag:' + METADATA_TAG.format('Instance'): instance_id}) if
+            get_snap_instance(snp) == instance_id and
+            get_snap_device(snp) != _device and
+            abs(get_snap_time(snap) - get_snap_time(snp)) <=
+            timedelta(minutes=10)]
     snapshot = sorted(snapshots, key=get_snap_time,
                       reverse=True) if snapshots else None
     # setup for building an EBS boot snapshot
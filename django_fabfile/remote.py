@@ -0,0 +1,526 @@
+"""Check :doc:`README` or :class:`django_fabfile.utils.Config` docstring
+for setup instructions."""
+
+from contextlib import contextmanager
+from functools import wraps
+import logging
+from pipes import quote
+from threading import Lock
+from time import time
+
+from fabric.api import env
+from fabric.network import normalize, prompt_for_password, ssh
+
+from django_fabfile.utils import (WaitForProper, config, parallel_map,
+                                  ssh_timeout_attempts, ssh_timeout_interval)
+
+
+logger = logging.getLogger(__name__)
+
+
+class RemoteCommandError(Exception):
+    pass
+
+
+class CommandResult(str):
+
+    """Output of remote command with `return_code`, `failed` and
+    `succeeded` attributes like Fabric ``run`` and ``sudo`` return."""
+
+    def __new__(cls, output, return_code):
+        result = super(CommandResult, cls).__new__(cls, output)
+        result.return_code = return_code
+        result.failed = bool(return_code)
+        result.succeeded = not return_code
+        return result
+
+
+class RemoteSession(object):
+
+    """SSH connection to one host opened once and reused by commands.
+
+    Every command is executed over its own channel of the connection
+    without changing Fabric ``env``, so sessions of different hosts may
+    be used from threads simultaneously. Durations of commands are
+    collected in `timings` list of ``(label, seconds)`` pairs, numbers
+    of connections, channels and reconnections in `connects`,
+    `channels` and `reconnects`.
+
+    :param host_string: as for Fabric, user and port are taken from
+        ``env`` if not mentioned;
+    :param user: overrides user of `host_string`;
+    :param key_filename: path or list of paths, ``env.key_filename``
+        by default;
+    :param password: used for connection and sudo, ``env.password``
+        by default. Without it sudo is run non-interactively
+        (``sudo -n``) and fails instead of prompting, so user needs
+        passwordless sudo or ``env.password`` set beforehand, e.g.
+        with Fabric ``--password`` option or by :func:`check_sudo`;
+    :param keepalive: seconds between keepalive packets, ``SSH_KEEPALIVE``
+        option by default.
+
+    Lost connection, e.g. after reboot, is reopened once on next
+    command. Host keys are not checked as with ``env.disable_known_hosts``
+    set by every module: host names of EC2 instances are reused."""
+
+    def __init__(self, host_string, user=None, key_filename=None,
+                 password=None,
+                 keepalive=config.getint('DEFAULT', 'SSH_KEEPALIVE')):
+        self.user, self.host, self.port = normalize(host_string)
+        self.user = user or self.user
+        self.host_string = host_string
+        self.key_filename = key_filename or env.key_filename
+        self.password = env.password if password is None else password
+        self.keepalive = keepalive
+        self.client = None
+        self.error = None
+        self.timings = []
+        self.connects = self.channels = self.reconnects = 0
+        self.active = 0     # Commands in progress.
+        self.last_used = time()
+        self._lock = Lock()
+
+    @property
+    def key(self):
+        """Tuple of user, host, port and key files identifying session."""
+        keys = self.key_filename or ()
+        if isinstance(keys, basestring):
+            keys = (keys,)
+        return self.user, self.host, str(self.port), tuple(sorted(keys))
+
+    def __repr__(self):
+        return '<RemoteSession {0}@{1}:{2}>'.format(self.user, self.host,
+                                                   self.port)
+
+    def open(self, retry=False):
+        """Connect if not connected yet and return the session.
+
+        Connection which is not active anymore is reopened. Failed
+        connection is not retried unless `retry`, its error is raised
+        again."""
+        with self._lock:
+            if self.error:
+                if not retry:
+                    raise self.error
+                self.error = None
+            if self.client is not None and not self.is_active():
+                logger.warning('[{0}] connection lost'.format(self.host))
+                self._reset()
+            if self.client is None:
+                started = time()
+                try:
+                    self.client = self._connect()
+                except Exception as err:
+                    self.error = err
+                    raise
+                self.connects += 1
+                self.timings.append(('connect', time() - started))
+        return self
+
+    def is_active(self):
+        transport = self.client and self.client.get_transport()
+        return bool(transport and transport.is_active())
+
+    def _reset(self):
+        self.client.close()
+        self.client = None
+        self.reconnects += 1
+
+    def _connect(self):
+        client = ssh.SSHClient()
+        client.set_missing_host_key_policy(ssh.AutoAddPolicy())
+        client.connect(hostname=self.host, port=int(self.port),
+                       username=self.user, password=self.password,
+                       key_filename=self.key_filename, timeout=env.timeout,
+                       allow_agent=not env.no_agent,
+                       look_for_keys=not env.no_keys)
+        if self.keepalive:
+            client.get_transport().set_keepalive(self.keepalive)
+        return client
+
+    def _open_channel(self):
+        """Return new channel, reconnect once if connection was lost."""
+        self.open()
+        try:
+            channel = self.client.get_transport().open_session()
+        except Exception as err:
+            logger.warning('[{0}] reconnecting: {1}'.format(self.host, err))
+            with self._lock:
+                if self.client is not None:
+                    self._reset()
+            channel = self.open().client.get_transport().open_session()
+        self.channels += 1
+        return channel
+
+    def _use(self, delta):
+        with self._lock:
+            self.active += delta
+            self.last_used = time()
+
+    def close(self):
+        with self._lock:
+            if self.client is not None:
+                self.client.close()
+                self.client = None
+
+    def run(self, command, use_sudo=False, warn_only=None, label=None):
+        """Execute `command` with login shell and return its output.
+
+        :param use_sudo: execute as root with `password` if set, with
+            passwordless sudo otherwise;
+        :param warn_only: log failure instead of raising
+            :class:`RemoteCommandError`, ``env.warn_only`` by default;
+        :param label: name of the step in `timings`, command itself by
+            default."""
+        command = '/bin/bash -l -c {0}'.format(quote(command))
+        if use_sudo:
+            command = ('sudo -S -p "" ' if self.password else
+                       'sudo -n ') + command
+        started = time()
+        self._use(1)
+        try:
+            channel = self._open_channel()
+            try:
+                channel.set_combine_stderr(True)
+                channel.exec_command(command)
+                if use_sudo and self.password:
+                    channel.sendall(self.password + '\n')
+                output = channel.makefile('rb', -1).read().strip()
+                return_code = channel.recv_exit_status()
+            finally:
+                channel.close()
+        finally:
+            self._use(-1)
+        duration = time() - started
+        self.timings.append((label or command, duration))
+        logger.debug('[{0}] {1} finished in {2:.2f} sec with {3}:\n{4}'
+                     .format(self.host, label or command, duration,
+                             return_code, output))
+        if return_code:
+            msg = '[{0}] {1} failed with {2}: {3}'.format(
+                self.host, label or command, return_code, output)
+            if warn_only is None:
+                warn_only = env.warn_only
+            if not warn_only:
+                raise RemoteCommandError(msg)
+            logger.warning(msg)
+        return CommandResult(output, return_code)
+
+    def sudo(self, command, **kwargs):
+        return self.run(command, use_sudo=True, **kwargs)
+
+    def put(self, contents, remote_path, mode=None):
+        """Upload string `contents` to `remote_path` over SFTP."""
+        started = time()
+        self._use(1)
+        try:
+            channel = self._open_channel()
+            channel.invoke_subsystem('sftp')
+            sftp = ssh.SFTPClient(channel)
+            try:
+                remote_file = sftp.open(remote_path, 'w')
+                try:
+                    remote_file.write(contents)
+                finally:
+                    remote_file.close()
+                if mode is not None:
+                    sftp.chmod(remote_path, mode)
+            finally:
+                sftp.close()
+        finally:
+            self._use(-1)
+        self.timings.append(('put ' + remote_path, time() - started))
+
+
+class SessionPool(object):
+
+    """Sessions shared by execution contexts within a task.
+
+    One :class:`RemoteSession` is kept per user, host, port and key
+    files, so all helpers of a task multiplex their commands over one
+    authenticated connection instead of connecting on their own.
+    Session which failed to connect is replaced on next request to retry
+    connection. Sessions idle for `idle` seconds are closed and
+    reconnected on demand.
+
+    :param idle: ``SSH_IDLE_TIMEOUT`` option by default."""
+
+    def __init__(self, idle=config.getint('DEFAULT', 'SSH_IDLE_TIMEOUT')):
+        self.idle = idle
+        self.depth = 0      # Nesting of tasks using the pool.
+        self._sessions = {}
+        self._retired = []  # Replaced sessions kept for statistics.
+        self._lock = Lock()
+
+    def get(self, host_string, user=None, key_filename=None, password=None):
+        """Return pooled session, see :class:`RemoteSession` for params."""
+        session = RemoteSession(host_string, user, key_filename, password)
+        with self._lock:
+            self._close_idle()
+            pooled = self._sessions.get(session.key)
+            if pooled is None or pooled.error:
+                if pooled is not None:
+                    self._retired.append(pooled)
+                pooled = self._sessions[session.key] = session
+        return pooled
+
+    def _close_idle(self):
+        for session in self._sessions.values():
+            if (session.client and not session.active and
+                    time() - session.last_used > self.idle):
+                logger.debug('{0} closed as idle'.format(session))
+                session.close()
+
+    def stats(self):
+        """Return dict with numbers of hosts, connections, commands,
+        commands over reused connections and reconnections."""
+        with self._lock:
+            sessions = self._sessions.values() + self._retired
+        connections = sum(session.connects for session in sessions)
+        commands = sum(session.channels for session in sessions)
+        return {'hosts': len(set(session.host for session in sessions)),
+                'connections': connections, 'commands': commands,
+                'reused': max(commands - connections, 0),
+                'reconnects': sum(session.reconnects for session in
+                                  sessions)}
+
+    def report(self, title):
+        logger.info('{title}: {connections} SSH connections to {hosts} '
+                    'hosts for {commands} commands, {reused} over reused '
+                    'connections, {reconnects} reconnected'.format(
+                        title=title, **self.stats()))
+
+    def close(self):
+        with self._lock:
+            sessions = self._sessions.values()
+            self._sessions, self._retired = {}, []
+        for session in sessions:
+            session.close()
+
+
+session_pool = SessionPool()
+
+
+def with_session_pool(func):
+    """Decorate task to report and close :data:`session_pool` on exit.
+
+    Pool is kept while nested decorated tasks are called."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with session_pool._lock:
+            session_pool.depth += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with session_pool._lock:
+                session_pool.depth -= 1
+                outermost = not session_pool.depth
+            if outermost:
+                session_pool.report(func.__name__)
+                session_pool.close()
+    return wrapper
+
+
+retried = WaitForProper(attempts=ssh_timeout_attempts,
+                        pause=ssh_timeout_interval)
+
+
+class ExecutionContext(object):
+
+    """Host, user, key and sudo policy of one remote operation.
+
+    Context is passed to helpers explicitly instead of changing Fabric
+    ``env`` or entering ``settings(host_string=...)``, so operations on
+    different hosts may run in worker threads. Commands are executed by
+    session of `pool` (:data:`session_pool` by default), so contexts of
+    the same host, user and key share one connection.
+
+    :param use_sudo: False to run commands given to :meth:`sudo` as is,
+        e.g. if `user` is root;
+    :param password: sudo password, see :class:`RemoteSession`;
+    :param warn_only: default of commands, see :meth:`RemoteSession.run`."""
+
+    def __init__(self, host, user=None, key_filename=None, use_sudo=True,
+                 password=None, warn_only=False, pool=None):
+        self.user, self.host, port = normalize(host)
+        self.user = user or self.user
+        self.host_string = host
+        self.key_filename = key_filename or env.key_filename
+        self.password = password
+        self.use_sudo = use_sudo
+        self.warn_only = warn_only
+        self.pool = pool or session_pool
+
+    @property
+    def session(self):
+        """Pooled session, requested for every command to get healthy one.
+        """
+        return self.pool.get(self.host_string, self.user, self.key_filename,
+                             self.password)
+
+    @classmethod
+    def for_instance(cls, inst, user=None, key_filename=None, **kwargs):
+        """Return context of `inst`.
+
+        :param user: ``USERNAME`` option by default;
+        :param key_filename: ``KEY_FILENAME`` option of `inst` region by
+            default."""
+        return cls(inst.public_dns_name,
+                   user or config.get('DEFAULT', 'USERNAME'),
+                   key_filename or config.get(inst.region.name,
+                                              'KEY_FILENAME'), **kwargs)
+
+    def __repr__(self):
+        return '<ExecutionContext {0}@{1}>'.format(self.user, self.host)
+
+    def run(self, command, warn_only=None, label=None):
+        if warn_only is None:
+            warn_only = self.warn_only
+        return self.session.run(command, warn_only=warn_only, label=label)
+
+    def sudo(self, command, warn_only=None, label=None):
+        if warn_only is None:
+            warn_only = self.warn_only
+        return self.session.run(command, use_sudo=self.use_sudo,
+                                warn_only=warn_only, label=label)
+
+    def exists(self, path):
+        return self.run('test -e {0}'.format(quote(path)),
+                        warn_only=True).succeeded
+
+    def put(self, contents, remote_path, mode=None):
+        self.session.put(contents, remote_path, mode)
+
+    def _retried(self, method, *args, **kwargs):
+        """Call `method` with retries, reconnecting session which failed
+        to connect before every attempt."""
+        def attempt():
+            self.session.open(retry=True)
+            return method(*args, **kwargs)
+        return retried(attempt)()
+
+    def wait_for_sudo(self, command, **kwargs):
+        """Retry :meth:`sudo` on errors like
+        :data:`django_fabfile.utils.wait_for_sudo`."""
+        return self._retried(self.sudo, command, **kwargs)
+
+    def wait_for_exists(self, path):
+        return self._retried(self.exists, path)
+
+    def close(self):
+        """Close connection before the end of the task, e.g. if host is
+        not needed anymore."""
+        self.session.close()
+
+
+@contextmanager
+def instance_context(inst, ctx=None, **kwargs):
+    """Yield `ctx` or new context of `inst`.
+
+    Helpers accepting optional context use this to reuse caller's one.
+    Connection of new context is kept in the pool for the rest of task.
+    """
+    yield ctx or ExecutionContext.for_instance(inst, **kwargs)
+
+
+def open_sessions(host_strings, lazy=()):
+    """Return dict of host string to connected :class:`RemoteSession`.
+
+    Hosts are connected in parallel. Unreachable hosts are logged and
+    their sessions are left unconnected.
+
+    :param lazy: hosts connected on first command only, e.g. probably
+        unreachable ones."""
+    sessions = dict((host_string, RemoteSession(host_string)) for
+                    host_string in set(host_strings) | set(lazy))
+
+    def open_(session):
+        try:
+            session.open()
+        except Exception as err:
+            logger.error('{0} not connected: {1}'.format(session, err))
+    parallel_map(open_, [sessions[host_string] for host_string in
+                         set(host_strings) - set(lazy)])
+    return sessions
+
+
+@contextmanager
+def opened_sessions(host_strings, lazy=()):
+    """Yield sessions as from :func:`open_sessions` closing them on exit."""
+    sessions = open_sessions(host_strings, lazy)
+    try:
+        yield sessions
+    finally:
+        for session in sessions.values():
+            session.close()
+
+
+def run_chains(sessions, chains, warn_only=None):
+    """Run chains of commands in parallel with each other.
+
+    :param sessions: as from :func:`open_sessions`;
+    :param chains: list of ``(host string, commands)`` pairs, commands
+        of one chain are executed with sudo one after another, every
+        command may be ``(label, command)`` pair;
+    :param warn_only: continue chain after failed command, see
+        :meth:`RemoteSession.run`;
+    :returns: list of True or False for succeeded or failed chains."""
+    def run_chain(chain):
+        host_string, commands = chain
+        session = sessions[host_string]
+        try:
+            session.open()
+        except Exception as err:
+            logger.error('[{0}] skipped as not connected: {1}'.format(
+                session.host, err))
+            return False
+        succeeded = True
+        try:
+            for command in commands:
+                label, command = (command if isinstance(command, tuple)
+                                  else (None, command))
+                succeeded &= session.sudo(command, warn_only=warn_only,
+                                          label=label).succeeded
+        except Exception as err:
+            logger.error('[{0}] stopped: {1}'.format(session.host, err))
+            return False
+        return succeeded
+    return parallel_map(run_chain, chains)
+
+
+def check_sudo(sessions):
+    """Check sudo on all connected `sessions` before the first step.
+
+    ``true`` is run with sudo on every host in parallel. If it failed
+    and ``env.password`` is not set, password is prompted once and used
+    by all sessions, see :class:`RemoteSession`.
+
+    :raises RemoteCommandError: if sudo still fails on some host."""
+    connected = [session for session in sessions.values() if session.client]
+
+    def get_failed():
+        return [session.host for session, result in zip(
+            connected, parallel_map(lambda session: session.sudo(
+                'true', warn_only=True, label='check sudo'), connected))
+            if not result.succeeded]
+    failed = get_failed()
+    if failed and not env.password:
+        env.password = prompt_for_password('Sudo password for {0}'.format(
+            ', '.join(sorted(failed))))
+        for session in sessions.values():
+            session.password = env.password
+        failed = get_failed()
+    if failed:
+        raise RemoteCommandError('Sudo failed on {0}'.format(
+            ', '.join(sorted(failed))))
+
+
+def log_timings(sessions, started, title):
+    """Log durations of all steps and total time since `started`."""
+    for session in sorted(sessions.values(), key=lambda ses: ses.host):
+        for label, duration in session.timings:
+            logger.info('[{0}] {1}: {2:.2f} sec'.format(session.host, label,
+                                                        duration))
+    total = time() - started
+    logger.info('{0} finished in {1:.1f} sec'.format(title, total))
+    return total
@@ -0,0 +1,191 @@
+"""Check :doc:`README` or :class:`django_fabfile.utils.Config` docstring
+for setup instructions."""
+
+from hashlib import sha1
+from heapq import heappop, heappush
+from json import dumps
+import logging
+import os
+from time import sleep, time
+
+from fabric.api import task
+
+from django_fabfile.backup import (DEFAULT_TAG_NAME, DEFAULT_TAG_VALUE,
+                                   backup_instance, pending_snapshots,
+                                   recent_snapshots)
+from django_fabfile.utils import config, get_inst_by_id, get_region_conn
+
+
+logger = logging.getLogger(__name__)
+
+
+DISCOVERY_PERIOD = 15 * 60  # Seconds between listings of tagged instances.
+RETRY_DELAY = 10 * 60   # Seconds before retrying failed backup.
+
+
+def get_offset(instance_id, interval):
+    """Return deterministic offset of instance backup within interval."""
+    return int(sha1(instance_id).hexdigest(), 16) % interval
+
+
+class BackupScheduler(object):
+
+    """Spread instances backups across the interval.
+
+    Every instance is backed up once per `interval` seconds at its own
+    offset from the interval start, see :func:`get_offset`. Instances
+    whose offset is already past when they are discovered are first due
+    in the next interval, so start of scheduler doesn't start everything
+    at once. Due backups are deferred while region or any of instance
+    volumes have too many pending snapshots, see
+    :class:`django_fabfile.backup.PendingSnapshotsGovernor`. Instance
+    with more volumes than region limit waits for region without pending
+    snapshots.
+
+    :param regions: list of region names;
+    :param governor: pending snapshots governor shared with
+        :func:`django_fabfile.backup.create_snapshot`."""
+
+    def __init__(self, interval, regions, tag_name=DEFAULT_TAG_NAME,
+                 tag_value=DEFAULT_TAG_VALUE, consistent=False,
+                 governor=pending_snapshots):
+        self.interval = interval
+        self.regions = regions
+        self.tag_name, self.tag_value = tag_name, tag_value
+        self.consistent = consistent
+        self.governor = governor
+        self.queue = []     # Heap of (due, region name, instance ID).
+        self.scheduled = set()
+        self.oversized = set()  # Instances warned about volumes number.
+        self.discovered_at = 0
+        self.started = self.deferred = self.failed = 0
+
+    def discover(self, now):
+        """Schedule newly tagged instances."""
+        cycle_start = now - now % self.interval
+        filters = {'resource-type': 'instance', 'key': self.tag_name,
+                   'tag-value': self.tag_value}
+        for reg_name in self.regions:
+            conn = get_region_conn(reg_name)
+            for tag in conn.get_all_tags(filters=filters):
+                if (reg_name, tag.res_id) in self.scheduled:
+                    continue
+                due = cycle_start + get_offset(tag.res_id, self.interval)
+                if due < now:
+                    due += self.interval
+                heappush(self.queue, (due, reg_name, tag.res_id))
+                self.scheduled.add((reg_name, tag.res_id))
+                logger.info('{0} in {1} scheduled at {2} sec of every {3} '
+                            'sec'.format(tag.res_id, reg_name,
+                                         due % self.interval, self.interval))
+        self.discovered_at = now
+
+    def refresh(self):
+        """Release slots of completed snapshots with one call per region."""
+        for reg_name in self.regions:
+            self.governor.refresh(reg_name)
+
+    def dispatch(self, now):
+        """Start due backups which are within pending snapshots limits."""
+        deferred = []
+        while self.queue and self.queue[0][0] <= now:
+            due, reg_name, inst_id = heappop(self.queue)
+            inst = get_inst_by_id(reg_name, inst_id)
+            if not inst or inst.tags.get(self.tag_name) != self.tag_value:
+                logger.info('{0} in {1} unscheduled'.format(inst_id, reg_name))
+                self.scheduled.discard((reg_name, inst_id))
+                continue
+            bdm = inst.block_device_mapping
+            vol_ids = [bdm[dev].volume_id for dev in bdm]
+            if (self.governor.max_per_region and
+                    len(vol_ids) > self.governor.max_per_region and
+                    inst_id not in self.oversized):
+                self.oversized.add(inst_id)
+                logger.warning(
+                    '{0} in {1} has {2} volumes, more than {3} pending '
+                    'snapshots allowed per region: waiting for region '
+                    'without pending snapshots'.format(
+                        inst_id, reg_name, len(vol_ids),
+                        self.governor.max_per_region))
+            if not self.governor.can_start(reg_name, vol_ids):
+                self.deferred += 1
+                deferred.append((due, reg_name, inst_id))
+                continue
+            try:
+                backup_instance(reg_name, instance=inst,
+                                consistent=self.consistent)
+            except Exception:
+                logger.exception('Backup of {0} in {1} failed'.format(
+                    inst_id, reg_name))
+                self.failed += 1
+                heappush(self.queue, (now + RETRY_DELAY, reg_name, inst_id))
+                continue
+            self.started += 1
+            heappush(self.queue, (due + self.interval, reg_name, inst_id))
+        for item in deferred:
+            heappush(self.queue, item)
+
+    def status(self, now):
+        """Return dict with queue depth, lag and counters."""
+        due = [item[0] for item in self.queue if item[0] <= now]
+        return {
+            'queue_depth': len(due),
+            'lag': now - min(due) if due else 0,
+            'in_flight': self.governor.count(),
+            'scheduled': len(self.scheduled),
+            'started': self.started,
+            'deferred': self.deferred,
+            'skipped_fresh': recent_snapshots.skipped,
+            'failed': self.failed,
+        }
+
+    def tick(self, now=None):
+        now = now or time()
+        if now - self.discovered_at >= DISCOVERY_PERIOD:
+            self.discover(now)
+        self.refresh()
+        self.dispatch(now)
+        return self.status(now)
+
+
+@task
+def run_backup_scheduler(interval_hours=24, region_name=None,
+                         tag_name=DEFAULT_TAG_NAME,
+                         tag_value=DEFAULT_TAG_VALUE, consistent=False):
+    """Backup tagged instances continuously instead of cron waves.
+
+    interval_hours
+        every instance is backed up once per interval at deterministic
+        offset, so backups are spread evenly;
+    region_name
+        will be applied across all regions by default;
+    tag_name, tag_value
+        will be fetched from config by default;
+    consistent
+        if True, then FS mountpoint will be frozen before snapshotting.
+
+    Pending snapshots are limited with MAX_PENDING_SNAPSHOTS_PER_REGION
+    and MAX_PENDING_SNAPSHOTS_PER_VOLUME options. Queue depth and lag
+    are logged and written to SCHEDULER_STATUS_FILE every
+    SCHEDULER_TICK seconds."""
+    if region_name:
+        regions = [get_region_conn(region_name).region.name]
+    else:
+        regions = [reg.name for reg in get_region_conn().get_all_regions()]
+    scheduler = BackupScheduler(int(float(interval_hours) * 60 * 60),
+                                regions, tag_name, tag_value, consistent)
+    tick = config.getint('DEFAULT', 'SCHEDULER_TICK')
+    status_file = config.get('DEFAULT', 'SCHEDULER_STATUS_FILE')
+    while True:
+        try:
+            status = scheduler.tick()
+        except Exception:
+            logger.exception('Scheduler tick failed')
+        else:
+            logger.info('Backup queue depth {queue_depth}, lag {lag:.0f} '
+                        'sec, in flight {in_flight}'.format(**status))
+            if status_file:
+                with open(status_file + '.tmp', 'w') as status_fp:
+                    status_fp.write(dumps(status))
+                os.rename(status_file + '.tmp', status_file)
+        sleep(tick)
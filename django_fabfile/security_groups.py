@@ -1,21 +1,27 @@
 from collections import defaultdict
-from contextlib import contextmanager
 from itertools import chain, groupby
 from hashlib import sha256
+from json import dumps, loads
 import logging
 from operator import attrgetter
+import os
+from threading import RLock
 from warnings import warn
 
 from boto.exception import EC2ResponseError
 from fabric.api import task
 
-from django_fabfile.utils import config, get_region_conn, timestamp
+from django_fabfile.utils import (config, get_region_conn, parallel_map,
+                                  timestamp)
 
 
 logger = logging.getLogger(__name__)
 
 
 INST_SPECIFIC_SG_PREFIX = 'Created on '
+POOL_SG_PREFIX = 'Pooled '
+# Canonical rules of groups created with `new_security_group`.
+SSH_ONLY_RULES = ((('tcp', '22', '22'), ('0.0.0.0/0', )), )
 
 
 def new_security_group(region, name=None, description=None):
@@ -27,6 +33,114 @@ def new_security_group(region, name=None, description=None):
     return s_g
 
 
+_pool = {}  # Region name and fingerprint to pooled Security Group.
+_pool_lock = RLock()
+
+
+def get_pool_security_group(region, rules=SSH_ONLY_RULES):
+    """Return shared Security Group with given canonical CIDR rules.
+
+    Pooled groups are named with :data:`POOL_SG_PREFIX` and fingerprint
+    of `rules`, so every region has at most one group per rules set.
+    Group is looked up once per process and created only if missing.
+    If pooled group was modified, new per-instance group is returned,
+    see :func:`new_security_group`."""
+    fingerprint = get_fingerprint(rules)
+    key = region.name, fingerprint
+    with _pool_lock:
+        if key in _pool:
+            return _pool[key]
+        conn = get_region_conn(region.name)
+        name = POOL_SG_PREFIX + fingerprint[:16]
+        found = conn.get_all_security_groups(filters={'group-name': name})
+        if found:
+            s_g = found[0]
+        else:
+            logger.info('Creating {0} in {1}'.format(name, region))
+            try:
+                s_g = conn.create_security_group(
+                    name, 'Shared by instances with the same rules')
+            except EC2ResponseError as err:
+                if err.error_code != 'InvalidGroup.Duplicate':
+                    raise
+                s_g = conn.get_all_security_groups(
+                    filters={'group-name': name})[0]
+            else:
+                for (ip_protocol, from_port, to_port), cidrs in rules:
+                    for cidr_ip in cidrs:
+                        s_g.authorize(ip_protocol, from_port, to_port,
+                                      cidr_ip)
+        if get_fingerprint(get_canonical_rules(s_g)) != fingerprint:
+            logger.warning('{0} in {1} was modified, creating per-instance '
+                           'group'.format(s_g, region))
+            return new_security_group(region)
+        _pool[key] = s_g
+        return s_g
+
+
+def get_groups_usage(region_name):
+    """Return security groups of region, used names and granted names.
+
+    Usage is collected with one request per DescribeSecurityGroups,
+    DescribeInstances and DescribeNetworkInterfaces. Groups are
+    referenced by names as in other regions names are the same.
+
+    :returns: list of groups, set of names of groups used by instances or
+        network interfaces and dict of group name to set of names of
+        groups granted in its rules."""
+    conn = get_region_conn(region_name)
+    groups = conn.get_all_security_groups()
+    names = dict((s_g.id, s_g.name) for s_g in groups)
+    used = set()
+
+    def use(refs):
+        used.update(names.get(grp.id) or grp.name for grp in refs)
+    for res in conn.get_all_instances():
+        use(res.groups)
+        for inst in res.instances:
+            use(inst.groups)
+            for iface in inst.interfaces:
+                use(iface.groups)
+    for iface in conn.get_all_network_interfaces():
+        use(iface.groups)
+    granted = defaultdict(set)
+    for s_g in groups:
+        for rule in s_g.rules:
+            for grant in rule.grants:
+                if grant.owner_id == s_g.owner_id and (
+                        grant.name or grant.group_id in names):
+                    granted[s_g.name].add(grant.name or
+                                          names[grant.group_id])
+    used.discard(None)
+    return groups, used, granted
+
+
+def _delete_groups(groups, granted):
+    """Delete `groups` of one region granting ones before granted."""
+    remaining = dict((s_g.name, s_g) for s_g in groups)
+    while remaining:
+        referenced = set(chain(*[granted[name] - set([name]) for name in
+                                 remaining]))
+        wave = [s_g for name, s_g in remaining.items() if
+                name not in referenced]
+        if not wave:
+            logger.warning('{0} grant each other in {1} and should be '
+                           'deleted manually'.format(sorted(remaining),
+                                                     groups[0].region))
+            return
+
+        def delete(s_g):
+            logger.info('Deleting {0} in {1}'.format(s_g, s_g.region))
+            try:
+                s_g.delete()
+            except EC2ResponseError as err:
+                logger.error('{0} in {1} not deleted: {2}'.format(
+                    s_g, s_g.region, err))
+        parallel_map(delete, wave)
+        for s_g in wave:
+            del remaining[s_g.name]
+
+
 @task
 def cleanup_security_groups(delete=False):
     """
@@ -36,31 +150,53 @@ def cleanup_security_groups(delete=False):
     :param delete: notify only (i.e. False) by default.
 
     If security group with the same name is used at least in one region,
-    it is treated as used.
+    it is treated as used. Groups granted in rules of used groups and
+    pooled groups (see :func:`get_pool_security_group`) are treated as
+    used too. Usage of all groups in region is fetched at
+    once, see :func:`get_groups_usage`. Regions are cleaned up in
+    parallel, groups are deleted before groups granted in their rules.
     """
+    regions = get_region_conn().get_all_regions()
+    usage = parallel_map(get_groups_usage, [reg.name for reg in regions])
     groups = defaultdict(lambda: {})
     used_groups = set(['default',
                        config.get('DEFAULT', 'HTTPS_SECURITY_GROUP')])
-    regions = get_region_conn().get_all_regions()
-    for reg in regions:
-        for s_g in get_region_conn(reg.name).get_all_security_groups():
+    granted = defaultdict(set)
+    for reg, (reg_groups, reg_used, reg_granted) in zip(regions, usage):
+        for s_g in reg_groups:
             groups[s_g.name][reg] = s_g
-            if s_g.instances():     # Security Group is used by instance.
-                used_groups.add(s_g.name)
-            for rule in s_g.rules:
-                for grant in rule.grants:
-                    if grant.name and grant.owner_id == s_g.owner_id:
-                        used_groups.add(grant.name)     # SG is used by group.
+        used_groups.update(reg_used)
+        for name in reg_granted:
+            granted[name].update(reg_granted[name])
+    counts = dict.fromkeys(['pooled', 'per_instance', 'other'], 0)
+    for name, regs in groups.items():
+        kind = ('pooled' if name.startswith(POOL_SG_PREFIX) else
+                'per_instance' if name.startswith(INST_SPECIFIC_SG_PREFIX)
+                else 'other')
+        counts[kind] += len(regs)
+    logger.info('{0} Security Groups found: {pooled} pooled, {per_instance} '
+                'per-instance, {other} other'.format(
+                    sum(counts.values()), **counts))
+    # Pooled groups are reused by next launches.
+    used_groups.update(name for name in groups if
+                       name.startswith(POOL_SG_PREFIX))
+    # Groups granted by used ones are used too.
+    unchecked = list(used_groups)
+    while unchecked:
+        for name in granted[unchecked.pop()] - used_groups:
+            used_groups.add(name)
+            unchecked.append(name)
     for grp in used_groups:
-        del groups[grp]
-
-    for grp in sorted(groups):
-        if delete:
-            for reg in groups[grp]:
-                s_g = groups[grp][reg]
-                logger.info('Deleting {0} in {1}'.format(s_g, reg))
-                s_g.delete()
-        else:
+        groups.pop(grp, None)
+
+    if delete:
+        def cleanup_region(region_usage):
+            reg, (reg_groups, _used, reg_granted) = region_usage
+            _delete_groups([s_g for s_g in reg_groups if s_g.name in groups],
+                           reg_granted)
+        parallel_map(cleanup_region, zip(regions, usage))
+    else:
+        for grp in sorted(groups):
             msg = '"SecurityGroup:{grp}" should be removed from {regs}'
             logger.info(msg.format(grp=grp, regs=groups[grp].keys()))
 
@@ -76,83 +212,232 @@ def regroup_rules(security_group):
     return grouped_rules
 
 
-def sync_rules(src_grp, dst_grp=None, dst_region=None):
+def get_rules_snapshot(region_names):
+    """Return dict of region name to dict of group name to group.
+
+    Groups of every region are fetched with one request, regions are
+    described in parallel."""
+    def describe(reg_name):
+        conn = get_region_conn(reg_name)
+        return reg_name, dict((s_g.name, s_g) for s_g in
+                              conn.get_all_security_groups())
+    return dict(parallel_map(describe, sorted(set(region_names))))
+
+
+def _get_grant_args(s_g, grant):
+    """Return source group name, owner, CIDR and group ID of `grant`."""
+    if grant.cidr_ip:
+        return None, None, grant.cidr_ip, None
+    if s_g.vpc_id:
+        return None, grant.owner_id, None, grant.group_id
+    return grant.name, grant.owner_id, None, None
+
+
+def change_rules(s_g, action, permissions):
+    """Authorize or revoke all `permissions` of `s_g` with one request.
+
+    :param action: "authorize" or "revoke";
+    :param permissions: list of ``((ip_protocol, from_port, to_port),
+        grants)`` pairs as from :func:`regroup_rules`;
+    :returns: number of requests made."""
+    params = {}
+    if s_g.vpc_id:
+        params['GroupId'] = s_g.id
+    else:
+        params['GroupName'] = s_g.name
+    num = 0
+    for (ip_protocol, from_port, to_port), grants in permissions:
+        if not grants:
+            continue
+        num += 1
+        prefix = 'IpPermissions.{0}.'.format(num)
+        params[prefix + 'IpProtocol'] = ip_protocol
+        if from_port is not None:
+            params[prefix + 'FromPort'] = from_port
+        if to_port is not None:
+            params[prefix + 'ToPort'] = to_port
+        cidrs = groups = 0
+        for grant in grants:
+            name, owner_id, cidr_ip, group_id = _get_grant_args(s_g, grant)
+            if cidr_ip:
+                cidrs += 1
+                params['{0}IpRanges.{1}.CidrIp'.format(prefix, cidrs)] = (
+                    cidr_ip)
+                continue
+            groups += 1
+            grp_prefix = '{0}Groups.{1}.'.format(prefix, groups)
+            for key, val in (('GroupName', name), ('UserId', owner_id),
+                             ('GroupId', group_id)):
+                if val:
+                    params[grp_prefix + key] = val
+    if not num:
+        return 0
+    operation = {'authorize': 'AuthorizeSecurityGroupIngress',
+                 'revoke': 'RevokeSecurityGroupIngress'}[action]
+    s_g.connection.get_status(operation, params, verb='POST')
+    # Update local version of the object as boto does.
+    update = s_g.add_rule if action == 'authorize' else s_g.remove_rule
+    for ports, grants in permissions:
+        for grant in grants:
+            update(*(ports + _get_grant_args(s_g, grant)))
+    return 1
+
+
+def _get_granted_names(s_g):
+    """Return names of groups of the same owner granted in `s_g` rules."""
+    return set(grant.name for grant in chain(*regroup_rules(s_g).values())
+               if grant.name and grant.owner_id == s_g.owner_id)
+
+
+def _order_created(names, sources):
+    """Return `names` ordered granted groups first.
+
+    :param sources: dict of group name to its source group."""
+    ordered = []
+
+    def visit(name, path):
+        if name in ordered or name in path:     # Done or granted in cycle.
+            return
+        for granted in sorted(_get_granted_names(sources[name]) & names):
+            visit(granted, path | set([name]))
+        ordered.append(name)
+    for name in sorted(names):
+        visit(name, set())
+    return ordered
+
+
+def plan_sync(pairs, snapshot):
+    """
+    Return changes making destination groups identical to source ones.
+
+    Nothing is requested or modified, so the plan may be reviewed with
+    :func:`format_plan` before :func:`apply_plan`.
+
+    :param pairs: list of source group and destination region name;
+    :param snapshot: groups of source and destination regions as from
+        :func:`get_rules_snapshot`;
+    :returns: list of ``(region name, action, group name, argument)``
+        tuples, where action is "create" with group description as
+        argument, or "revoke" or "authorize" with permissions for
+        :func:`change_rules`. Changes of every region are ordered: groups
+        are created granted ones first, then rules are revoked and
+        authorized.
+
+    Granted groups of the same owner missing in destination region are
+    planned to be created from their source region. Groups granted by
+    another user can't be copied and their grants are skipped.
+    """
+    sources = defaultdict(dict)     # Destination region to name to source.
+    pending = list(pairs)
+    while pending:
+        src_grp, dst_reg = pending.pop()
+        if src_grp.name in sources[dst_reg]:
+            continue
+        sources[dst_reg][src_grp.name] = src_grp
+        src_groups = snapshot[src_grp.region.name]
+        for name in _get_granted_names(src_grp):
+            if name not in snapshot[dst_reg] and name in src_groups:
+                pending.append((src_groups[name], dst_reg))
+    changes = []
+    for dst_reg in sorted(sources):
+        dst_groups = snapshot[dst_reg]
+        created = set(sources[dst_reg]) - set(dst_groups)
+        for name in _order_created(created, sources[dst_reg]):
+            changes.append((dst_reg, 'create', name,
+                            sources[dst_reg][name].description))
+        revokes, authorizes = [], []
+        for name in sorted(sources[dst_reg]):
+            src_rules = regroup_rules(sources[dst_reg][name])
+            dst_rules = (regroup_rules(dst_groups[name]) if
+                         name in dst_groups else {})
+            # Grants are compared by string: CIDR or name-owner.
+            to_revoke, to_authorize = [], []
+            for ports in sorted(set(src_rules) | set(dst_rules)):
+                src_grants = dict((str(grant), grant) for grant in
+                                  src_rules.get(ports, ()))
+                dst_grants = dict((str(grant), grant) for grant in
+                                  dst_rules.get(ports, ()))
+                revoked = [dst_grants[key] for key in
+                           sorted(set(dst_grants) - set(src_grants))]
+                authorized = [
+                    src_grants[key] for key in
+                    sorted(set(src_grants) - set(dst_grants)) if
+                    not src_grants[key].name or
+                    src_grants[key].name in dst_groups or
+                    src_grants[key].name in created]
+                if revoked:
+                    to_revoke.append((ports, revoked))
+                if authorized:
+                    to_authorize.append((ports, authorized))
+            if to_revoke:
+                revokes.append((dst_reg, 'revoke', name, to_revoke))
+            if to_authorize:
+                authorizes.append((dst_reg, 'authorize', name, to_authorize))
+        changes.extend(revokes + authorizes)
+    return changes
+
+
+def format_plan(changes):
+    """Return human readable lines of changes from :func:`plan_sync`."""
+    lines = []
+    for reg_name, action, name, arg in changes:
+        if action == 'create':
+            lines.append('{0}: create {1}'.format(reg_name, name))
+            continue
+        for (ip_protocol, from_port, to_port), grants in arg:
+            lines.append('{0}: {1} {2} {3} {4}-{5} from {6}'.format(
+                reg_name, action, name, ip_protocol, from_port, to_port,
+                ', '.join(str(grant) for grant in grants)))
+    return lines
+
+
+def apply_plan(changes, snapshot):
+    """Apply changes from :func:`plan_sync` regions in parallel.
+
+    Changes of one region are applied in order with one request each.
+    Created groups are added to `snapshot`, rules of changed groups are
+    updated in place.
+
+    :returns: number of requests made."""
+    by_region = defaultdict(list)
+    for change in changes:
+        by_region[change[0]].append(change)
+
+    def apply_region(reg_changes):
+        num = 0
+        for reg_name, action, name, arg in reg_changes:
+            groups = snapshot[reg_name]
+            if action == 'create':
+                logger.info('Creating {0} in {1}'.format(name, reg_name))
+                groups[name] = get_region_conn(
+                    reg_name).create_security_group(name, arg)
+                num += 1
+            else:
+                num += change_rules(groups[name], action, arg)
+        return num
+    return sum(parallel_map(apply_region, by_region.values()))
+
+
+def sync_rules(src_grp, dst_grp=None, dst_region=None, snapshot=None):
     """
     Copy Security Group rules.
 
     Works across regions as well. The sole exception that won't be
     synced is granted groups, owned by another user - such groups can't
     be copied recursively.
+
+    Changes are planned with :func:`plan_sync` against `snapshot`, which
+    is fetched if not provided, and applied with :func:`apply_plan`.
     """
     assert bool(dst_grp) ^ bool(dst_region), ('Only dst_grp or dst_region '
                                               'should be provided')
-    if dst_region:
-        dst_grp = new_security_group(dst_region, src_grp.name,
-                                                 src_grp.description)
-
-    def is_group_in(region, group_name):
-        try:
-            get_region_conn(region.name).get_all_security_groups([group_name])
-        except EC2ResponseError:
-            return False
-        else:
-            return True
-
-    src_rules = regroup_rules(src_grp)
-    # Assure granted group represented in destination region.
-    src_grants = chain(*src_rules.values())
-    for grant in dict((grant.name, grant) for grant in src_grants).values():
-        if (grant.name and grant.owner_id == src_grp.owner_id and
-                not is_group_in(dst_grp.region, grant.name)):
-            src_conn = get_region_conn(src_grp.region.name)
-            grant_grp = src_conn.get_all_security_groups([grant.name])[0]
-            sync_rules(grant_grp, dst_region=dst_grp.region)
-    dst_rules = regroup_rules(dst_grp)
-    # Remove rules absent in src_grp.
-    for ports in set(dst_rules.keys()) - set(src_rules.keys()):
-        for grant in dst_rules[ports]:
-            args = ports + ((None, grant) if grant.name else (grant, None))
-            dst_grp.revoke(*args)
-    # Add rules absent in dst_grp.
-    for ports in set(src_rules.keys()) - set(dst_rules.keys()):
-        for grant in src_rules[ports]:
-            if grant.name and not is_group_in(dst_grp.region, grant.name):
-                continue    # Absent other's granted group.
-            args = ports + ((None, grant) if grant.name else (grant, None))
-            dst_grp.authorize(*args)
-    # Refresh `dst_rules` from updated `dst_grp`.
-    dst_rules = regroup_rules(dst_grp)
-
-    @contextmanager
-    def patch_grouporcidr():
-        """XXX Patching `boto.ec2.securitygroup.GroupOrCIDR` cmp and hash."""
-        from boto.ec2.securitygroup import GroupOrCIDR
-        original_cmp = getattr(GroupOrCIDR, '__cmp__', None)
-        GroupOrCIDR.__cmp__ = lambda self, other: cmp(str(self), str(other))
-        original_hash = GroupOrCIDR.__hash__
-        GroupOrCIDR.__hash__ = lambda self: hash(str(self))
-        try:
-            yield
-        finally:
-            if original_cmp:
-                GroupOrCIDR.__cmp__ = original_cmp
-            else:
-                del GroupOrCIDR.__cmp__
-            GroupOrCIDR.__hash__ = original_hash
-
-    # Sync grants in common rules.
-    with patch_grouporcidr():
-        for ports in src_rules:
-            # Remove grants absent in src_grp rules.
-            for grant in set(dst_rules[ports]) - set(src_rules[ports]):
-                args = ports + ((None, grant) if grant.name else (grant, None))
-                dst_grp.revoke(*args)
-            # Add grants absent in dst_grp rules.
-            for grant in set(src_rules[ports]) - set(dst_rules[ports]):
-                if grant.name and not is_group_in(dst_grp.region, grant.name):
-                    continue    # Absent other's granted group.
-                args = ports + ((None, grant) if grant.name else (grant, None))
-                dst_grp.authorize(*args)
+    dst_reg_name = (dst_region or dst_grp.region).name
+    if snapshot is None:
+        snapshot = get_rules_snapshot([src_grp.region.name, dst_reg_name])
+    if dst_grp:     # Rules of given object should be updated.
+        snapshot[dst_reg_name][dst_grp.name] = dst_grp
+    return apply_plan(plan_sync([(src_grp, dst_reg_name)], snapshot),
+                      snapshot)
 
 
 @task
@@ -177,8 +462,47 @@ def sync_rules_by_id(src_reg_name, src_grp_id, dst_reg_name, dst_grp_id):
     sync_rules(src_grp, dst_grp)
 
 
+def get_canonical_rules(security_group):
+    """Return rules as sorted tuple of ports and sorted grants strings.
+
+    Granted Security Groups will be respected identical if them belongs
+    to identical owner and identically named irrespectively to region."""
+    return tuple(sorted(
+        (ports, tuple(sorted(str(grant) for grant in grants))) for
+        ports, grants in regroup_rules(security_group).items()))
+
+
+def get_fingerprint(canonical_rules):
+    """Return order-stable hash of canonical rules."""
+    return sha256(repr(canonical_rules)).hexdigest()
+
+
+BLANK_FINGERPRINT = get_fingerprint(SSH_ONLY_RULES)
+
+
+def _get_legacy_hash(s_g):
+    """Return hash of rules written to tags by previous versions."""
+    return sha256(str(regroup_rules(s_g).items())).hexdigest()
+
+
+def _load_replication_state():
+    path = config.get('security_groups', 'STATE_FILE')
+    if path and os.path.exists(path):
+        with open(path) as state_file:
+            return loads(state_file.read())
+    return {}
+
+
+def _save_replication_state(state):
+    path = config.get('security_groups', 'STATE_FILE')
+    if path:
+        with open(path + '.tmp', 'w') as state_file:
+            state_file.write(dumps(state))
+        os.rename(path + '.tmp', path)
+
+
 @task
-def replicate_security_groups(filters=None):
+def replicate_security_groups(filters=None, full=False, dry_run=False):
     """
     Replicate updates of Security Groups among regions.
 
@@ -190,63 +514,116 @@ def replicate_security_groups(filters=None):
     :type filters: dict
 
 
-    Per-instance Security Groups without additional rules won't be
-    replicated.
+    Per-instance Security Groups without additional rules and pooled
+    groups (created in regions on demand) won't be replicated.
+
+    Fingerprints of rules are computed once per group, see
+    :func:`get_fingerprint`.
+
+    :param full: reconcile all groups. Otherwise groups with the same
+        IDs, fingerprints and versions in the same regions as replicated
+        last time (stored in ``STATE_FILE`` of ``[security_groups]``
+        section) are skipped.
+
+    Changes of all groups are planned at once from one snapshot of
+    rules, see :func:`plan_sync`, and applied to regions in parallel.
+
+    :param dry_run: log the plan and number of requests it takes
+        instead of applying it.
 
     Raises warnings about synchronization issues that requires manual
     resolution.
     """
     HASH, TIMESTAMP = 'Hash', 'Version'     # Tag names.
+    fingerprints = {}   # Region name and group ID to fingerprint.
 
     def get_hash(s_g):
-        """
-        Return unique hash for Security Group rules.
-
-        Granted Security Groups will be respected identical if them
-        belongs to identical owner and identically named irrespectively
-        to region.
-        """
-        return sha256(str(regroup_rules(s_g).items())).hexdigest()
+        """Return memoized fingerprint of Security Group rules."""
+        key = s_g.region.name, s_g.id
+        if key not in fingerprints:
+            fingerprints[key] = get_fingerprint(get_canonical_rules(s_g))
+        return fingerprints[key]
 
     def was_updated(s_g):
         """Returns True if Security Group was modified or just created."""
-        return HASH not in s_g.tags or get_hash(s_g) != s_g.tags[HASH]
-
-    regions = get_region_conn().get_all_regions()
-    blank_group = new_security_group(regions[0])
-    security_groups = []
-    for reg in regions:
-        for s_g in get_region_conn(reg.name).get_all_security_groups(
-                filters=filters):
-            security_groups.append(s_g)
+        return HASH not in s_g.tags or (
+            s_g.tags[HASH] != get_hash(s_g) and
+            s_g.tags[HASH] != _get_legacy_hash(s_g))
+
+    def get_marks(grp_in_regions):
+        return dict((s_g.region.name, {'Id': s_g.id, 'Hash': get_hash(s_g),
+                                       'Version': s_g.tags.get(TIMESTAMP)})
+                    for s_g in grp_in_regions)
+
+    state = {} if full else _load_replication_state()
+    regions = [reg.name for reg in get_region_conn().get_all_regions()]
+    snapshot = get_rules_snapshot(regions)
+    if filters:     # Granted groups are planned from complete snapshot.
+        security_groups = []
+        for reg_name in regions:
+            security_groups.extend(
+                snapshot[reg_name][s_g.name] for s_g in get_region_conn(
+                    reg_name).get_all_security_groups(filters=filters))
+    else:
+        security_groups = list(chain(*[grps.values() for grps in
+                                       snapshot.values()]))
     name = attrgetter('name')
     grp_by_name = groupby(sorted(security_groups, key=name), key=name)
+    seen, unchanged = set(), 0
+    pairs, replicated = [], []
     for name, grp_in_regions in grp_by_name:
         grp_in_regions = list(grp_in_regions)
+        seen.add(name)
+        if (state.get(name) == get_marks(grp_in_regions) and
+                all(s_g.tags.get(HASH) == get_hash(s_g) for s_g in
+                    grp_in_regions)):
+            unchanged += 1
+            continue
+        state.pop(name, None)
         versions = set(get_hash(s_g) for s_g in grp_in_regions)
-        old_vers = [s_g for s_g in grp_in_regions if not was_updated(s_g)]
-        if len(set(s_g.tags[HASH] for s_g in old_vers)) > 1:
+        updated = dict((s_g, was_updated(s_g)) for s_g in grp_in_regions)
+        old_vers = [s_g for s_g in grp_in_regions if not updated[s_g]]
+        if len(set(get_hash(s_g) for s_g in old_vers)) > 1:
             warn('Old versions of {0} should be synced manually'.format(name))
             continue
+        source = grp_in_regions[0]
         if len(versions) == 2 and old_vers:  # Update olds to new version.
-            new = [grp for grp in grp_in_regions if was_updated(grp)][0]
-            for prev in old_vers:
-                sync_rules(new, prev)
+            source = [grp for grp in grp_in_regions if updated[grp]][0]
+            pairs.extend((source, prev.region.name) for prev in old_vers)
         elif not len(versions) == 1:
             warn('More than 1 new versions of {0} found. Synchronization '
                  'can\'t be applied.'.format(name))
             continue
         # Clone to all regions if not yet cloned.
         if (len(grp_in_regions) < len(regions) and
+            not name.startswith(POOL_SG_PREFIX) and
             not (name.startswith(INST_SPECIFIC_SG_PREFIX) and
-                 get_hash(grp_in_regions[0]) == get_hash(blank_group))):
+                 get_hash(source) == BLANK_FINGERPRINT)):
             s_g_regions = set(s_g.region.name for s_g in grp_in_regions)
-            for reg_name in set(reg.name for reg in regions) - s_g_regions:
-                region = get_region_conn(reg_name).region
-                sync_rules(grp_in_regions[0], dst_region=region)
-        # Update tags.
-        mark = timestamp()
+            pairs.extend((source, reg_name) for reg_name in
+                         sorted(set(regions) - s_g_regions))
+        replicated.append((name, grp_in_regions))
+    changes = plan_sync(pairs, snapshot)
+    if dry_run:
+        for line in format_plan(changes):
+            logger.info(line)
+        logger.info('{0} requests planned for {1} Security Groups, {2} are '
+                    'unchanged'.format(len(changes), len(replicated),
+                                       unchanged))
+        return changes
+    apply_plan(changes, snapshot)
+    for reg_name, action, name, arg in changes:
+        fingerprints.pop((reg_name, snapshot[reg_name][name].id), None)
+    # Update tags.
+    mark = timestamp()
+    for name, grp_in_regions in replicated:
         for s_g in grp_in_regions:
             s_g.add_tag(HASH, get_hash(s_g))
             s_g.add_tag(TIMESTAMP, mark)
-    blank_group.delete()
+        state[name] = get_marks(grp_in_regions)
+    if not filters:
+        for name in set(state) - seen:
+            del state[name]
+    _save_replication_state(state)
+    logger.info('{0} of {1} Security Groups are unchanged since previous '
+                'replication'.format(unchanged, len(seen)))
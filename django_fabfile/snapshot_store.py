@@ -0,0 +1,206 @@
+"""Check :doc:`README` or :class:`django_fabfile.utils.Config` docstring
+for setup instructions."""
+
+from array import array
+from bisect import bisect_left
+from calendar import timegm
+from datetime import datetime, timedelta
+from itertools import groupby
+from json import dumps
+import logging
+from random import randint, random
+import sys
+from time import time
+
+from boto.ec2.snapshot import Snapshot
+from fabric.api import task
+
+from django_fabfile.utils import get_snap_time, get_snap_vol
+
+
+logger = logging.getLogger(__name__)
+
+
+STATUSES = ('pending', 'completed', 'error')
+PRESERVED = 1   # Flag of snapshots tagged with "preserve_snapshot".
+_VOL_SHIFT = 34     # Bits reserved for epoch seconds in sorting keys.
+
+
+def to_epoch(time_):
+    """Return integer UTC epoch for naive UTC datetime."""
+    return timegm(time_.utctimetuple())
+
+
+def from_epoch(epoch):
+    return datetime.utcfromtimestamp(epoch)
+
+
+class SnapshotStore(object):
+
+    """Columnar storage of snapshot attributes used by planners.
+
+    Every snapshot is kept as a row of flat arrays instead of boto
+    ``Snapshot`` object with tags dictionary and description string:
+
+    * volume IDs are interned and referenced by index;
+    * start time and time from description as integer epochs;
+    * status as index in :data:`STATUSES`;
+    * snapshot ID as offset into single string table.
+
+    Rows are never removed. Group and window operations return indices
+    of rows.
+
+    .. note:: ``array('l')`` is 64-bit on LP64 platforms."""
+
+    def __init__(self):
+        self.volumes = []   # Interned volume IDs.
+        self._vol_index = {}
+        self.vol = array('l')
+        self.start = array('l')
+        self.time = array('l')
+        self.status = array('b')
+        self.flags = array('b')
+        self._ids = array('c')
+        self._offsets = array('l', [0])
+
+    def __len__(self):
+        return len(self.vol)
+
+    def add(self, snap):
+        """Append row for `snap` if it has a volume."""
+        vol_id = get_snap_vol(snap)
+        if not vol_id:
+            return
+        if vol_id not in self._vol_index:
+            self._vol_index[vol_id] = len(self.volumes)
+            self.volumes.append(vol_id)
+        self.vol.append(self._vol_index[vol_id])
+        self.start.append(to_epoch(datetime.strptime(
+            snap.start_time[:19], '%Y-%m-%dT%H:%M:%S')))
+        self.time.append(to_epoch(get_snap_time(snap)))
+        self.status.append(STATUSES.index(snap.status)
+                           if snap.status in STATUSES else -1)
+        self.flags.append(PRESERVED if snap.tags.get('preserve_snapshot')
+                          else 0)
+        self._ids.fromstring(snap.id)
+        self._offsets.append(len(self._ids))
+
+    def extend(self, snaps):
+        for snap in snaps:
+            self.add(snap)
+        return self
+
+    def snapshot_id(self, idx):
+        return self._ids[self._offsets[idx]:self._offsets[idx + 1]].tostring()
+
+    def volume_id(self, idx):
+        return self.volumes[self.vol[idx]]
+
+    def order_by_volume(self):
+        """Return row indices sorted by volume and start time."""
+        keys = array('l', ((vol << _VOL_SHIFT) + start for vol, start in
+                           zip(self.vol, self.start)))
+        return array('l', sorted(xrange(len(keys)), key=keys.__getitem__))
+
+    def group_by_volume(self):
+        """Yield volume ID and array of its rows, oldest first."""
+        vol = self.vol
+        for vol_idx, rows in groupby(self.order_by_volume(),
+                                     key=vol.__getitem__):
+            yield self.volumes[vol_idx], array('l', rows)
+
+    def latest_by_volume(self):
+        """Return dict of volume ID to row with latest time."""
+        latest = {}
+        time_ = self.time
+        for idx, vol_idx in enumerate(self.vol):
+            if vol_idx not in latest or time_[idx] > time_[latest[vol_idx]]:
+                latest[vol_idx] = idx
+        return dict((self.volumes[vol_idx], idx) for vol_idx, idx in
+                    latest.iteritems())
+
+    def window(self, rows, since, until):
+        """Return `rows` with start time in [since, until) epochs.
+
+        :param rows: indices sorted by start time, e.g. volume group."""
+        starts = array('l', (self.start[idx] for idx in rows))
+        return rows[bisect_left(starts, since):bisect_left(starts, until)]
+
+    def nbytes(self):
+        """Return approximate memory used by the store."""
+        arrays = (self.vol, self.start, self.time, self.status, self.flags,
+                  self._ids, self._offsets)
+        return (sum(arr.itemsize * len(arr) for arr in arrays) +
+                sys.getsizeof(self.volumes) + sys.getsizeof(self._vol_index) +
+                sum(sys.getsizeof(vol_id) for vol_id in self.volumes))
+
+
+def _fake_snapshots(count, volumes):
+    now = datetime.utcnow()
+    for i in xrange(count):
+        snap = Snapshot()
+        snap.id = 'snap-{0:08x}'.format(i)
+        snap.volume_id = 'vol-{0:08x}'.format(randint(0, volumes))
+        snap.status = 'completed'
+        snap.progress = '100%'
+        snap.volume_size = 8
+        time_ = now - timedelta(seconds=randint(0, 3 * 365 * 24 * 60 * 60))
+        snap.start_time = time_.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        snap.description = dumps({
+            'Volume': snap.volume_id, 'Region': 'us-east-1',
+            'Device': '/dev/sda1', 'Instance': 'i-{0:08x}'.format(i),
+            'Type': 'm1.small', 'Arch': 'x86_64',
+            'Root_dev_name': '/dev/sda1',
+            'Time': time_.strftime('%Y-%m-%dT%H:%M:%S')})
+        snap.tags = {'Name': 'host-{0}'.format(i % volumes),
+                     'Earmarking': 'production'}
+        if random() < 0.01:
+            snap.tags['preserve_snapshot'] = 'True'
+        yield snap
+
+
+def _deep_sizeof(snap):
+    return (sys.getsizeof(snap) + sys.getsizeof(snap.__dict__) +
+            sum(sys.getsizeof(val) for val in snap.__dict__.values()) +
+            sum(sys.getsizeof(key) + sys.getsizeof(val) for key, val in
+                snap.tags.items()))
+
+
+@task
+def benchmark_snapshot_store(count=100000, volumes=1000):
+    """Compare :class:`SnapshotStore` with list of boto snapshots.
+
+    count
+        number of fake snapshots;
+    volumes
+        number of volumes they belong to.
+
+    Logs memory used and time spent for grouping by volume."""
+    count, volumes = int(count), int(volumes)
+    snaps = list(_fake_snapshots(count, volumes))
+    objects_size = sum(_deep_sizeof(snap) for snap in snaps)
+    started = time()
+    grouped = sorted(snaps, key=lambda snp: (get_snap_vol(snp),
+                                             snp.start_time))
+    latest = [sorted(vol_snaps, key=get_snap_time)[-1] for vol, vol_snaps in
+              groupby(grouped, key=get_snap_vol)]
+    objects_time = time() - started
+
+    started = time()
+    store = SnapshotStore().extend(snaps)
+    load_time = time() - started
+    started = time()
+    groups = sum(1 for group in store.group_by_volume())
+    store.latest_by_volume()
+    store_time = time() - started
+    assert groups == len(latest)
+    info = ('{count} snapshots of {volumes} volumes:\n'
+            ' objects: {obj_mb:.1f} MiB, grouped in {obj_time:.2f} sec\n'
+            ' store:   {store_mb:.1f} MiB, loaded in {load_time:.2f} sec, '
+            'grouped in {store_time:.2f} sec\n'
+            ' memory reduced {ratio:.1f} times')
+    logger.info(info.format(
+        count=count, volumes=groups, obj_mb=objects_size / 2. ** 20,
+        obj_time=objects_time, store_mb=store.nbytes() / 2. ** 20,
+        load_time=load_time, store_time=store_time,
+        ratio=float(objects_size) / store.nbytes()))
@@ -1,64 +1,310 @@
-from fabric.api import env, sudo, settings, task
+import logging
+import re
+from threading import Lock
+from time import time
+
+from fabric.api import env, task
 from fabric.state import output
 
-from django_fabfile.utils import config
+from django_fabfile.remote import (check_sudo, log_timings, opened_sessions,
+                                   run_chains)
+from django_fabfile.utils import config, parallel_map
+
+
+logger = logging.getLogger(__name__)
+
+
+def _get_hosts(option):
+    return filter(None, [host.strip() for host in
+                         config.get('RDBMS', option).split(';')])
 
 
 master = config.get('RDBMS', 'MASTER')
 backup = config.get('RDBMS', 'BACKUP')
+nodes = _get_hosts('NODES') or [master, backup]     # Index is node ID.
+pgpool_hosts = _get_hosts('PGPOOL_HOSTS') or nodes
 username = config.get('DEFAULT', 'USERNAME')
 pcp_password = config.get('RDBMS', 'PCP_PASSWORD')
+data_directory = config.get('RDBMS', 'DATA_DIRECTORY')
 
 env.update({'disable_known_hosts': True, 'user': username, 'warn_only': True})
 output.update({'running': False})
 
+TRIGGER = '/var/log/pgpool/trigger/trigger_file1'
+# Sizes in KiB of data directory entries to be copied one per stream.
+LIST_DATA = (r'cd {data} && du -sk base/* $(ls -A | grep -Ev "^(base|'
+             r'pg_xlog|postmaster\.(pid|opts)|recovery\.(conf|done))$")')
+RSYNC = ('su postgres -c "rsync -az --delete --stats '
+         '-e \'ssh -o StrictHostKeyChecking=no\' '
+         '{primary}:{data}/{path} {data}/{parent}"')
+RECOVERY_CONF = ("standby_mode = 'on'",
+                 "primary_conninfo = '{conninfo}'",
+                 "trigger_file = '{trigger}'",
+                 "recovery_target_timeline = 'latest'")
+
+
+def psql(query):
+    return 'su postgres -c "psql -Atc \'{0}\'"'.format(query)
+
+
+def pcp(action, node_id):
+    """Return labeled command to attach, detach or recover pgpool node."""
+    return ('pcp_{0}_node {1}'.format(action, node_id),
+            'su postgres -c "pcp_{action}_node 60 127.0.0.1 9898 postgres'
+            ' {pcp_password} {node_id}"'.format(
+                action=action, node_id=node_id, pcp_password=pcp_password))
+
+
+def get_node_id(node):
+    """Return pgpool node ID by ID or host of database node."""
+    return nodes.index(node) if node in nodes else int(node)
+
+
+def parse_location(location):
+    """Return WAL location like "16/B374D848" as integer."""
+    high, low = location.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def choose_candidate(sessions, hosts):
+    """Return standby with the lowest replication lag.
+
+    Replayed WAL locations of all `hosts` are queried in parallel,
+    unreachable hosts and hosts not in recovery are skipped."""
+    def get_location(host):
+        try:
+            out = sessions[host].sudo(
+                psql('SELECT pg_last_xlog_replay_location()'),
+                warn_only=False, label='replay location')
+            return parse_location(out.splitlines()[-1])
+        except Exception as err:
+            logger.warning('{0} is not a candidate: {1}'.format(host, err))
+    locations = dict(zip(hosts, parallel_map(get_location, hosts)))
+    candidates = [host for host in hosts if locations[host] is not None]
+    if not candidates:
+        raise ValueError('No standby to promote among {0}'.format(hosts))
+    candidate = max(candidates, key=locations.get)
+    logger.info('{0} is promoted as replayed up to {1:X}'.format(
+        candidate, locations[candidate]))
+    return candidate
+
+
+def return_(node_id):
+    """Attach node to pgpool of all hosts in parallel."""
+    started = time()
+    with opened_sessions(pgpool_hosts) as sessions:
+        check_sudo(sessions)
+        run_chains(sessions, [(host, [pcp('attach', node_id)]) for host in
+                              pgpool_hosts])
+    return log_timings(sessions, started, 'Return of node {0}'.format(
+        node_id))
+
+
+def failover(failed_node_id, candidate=None):
+    """Promote standby and switch pgpool of other hosts to it.
+
+    :param candidate: host to promote, standby with the lowest
+        replication lag by default, see :func:`choose_candidate`. Must be
+        one of other nodes, checked before connecting.
+
+    Sessions to all hosts but failed node are opened in parallel
+    beforehand and sudo is checked on them, see
+    :func:`django_fabfile.remote.check_sudo`. Failed node is skipped
+    entirely, so unreachable host doesn't delay others with connection
+    timeout. Promotion trigger is touched on new primary first and
+    failover is aborted if it failed, then DNS update on new primary and
+    pgpool switch on every host run in parallel. Total time (RTO) is
+    logged and returned.
+
+    Other standbys should be pointed to new primary with
+    :func:`recover`."""
+    started = time()
+    failed = nodes[failed_node_id]
+    if candidate is not None and (candidate not in nodes or
+                                  candidate == failed):
+        raise ValueError('{0} is not a node to promote instead of {1}, '
+                         'nodes are {2}'.format(candidate, failed, nodes))
+    survivors = [host for host in nodes if host != failed]
+    switched = [host for host in pgpool_hosts if host != failed]
+    with opened_sessions(survivors + switched) as sessions:
+        check_sudo(sessions)
+        candidate = candidate or choose_candidate(sessions, survivors)
+        sessions[candidate].sudo('su postgres -c "touch {0}"'.format(
+            TRIGGER), warn_only=False, label='trigger')
+        switch_pgpool = [pcp('detach', failed_node_id),
+                         pcp('attach', nodes.index(candidate))]
+        run_chains(sessions, [
+            (candidate, [
+                ('dns update', 'su postgres -c "/usr/local/etc/'
+                 'dnsmadeeasy-update.sh {0}"'.format(candidate))])] + [
+            (host, switch_pgpool) for host in switched])
+    return log_timings(sessions, started, 'Failover to {0} (RTO)'.format(
+        candidate))
+
+
+def find_primary(sessions, hosts):
+    """Return host not in recovery querying all `hosts` in parallel."""
+    def is_primary(host):
+        try:
+            out = sessions[host].sudo(psql('SELECT pg_is_in_recovery()'),
+                                      warn_only=False, label='is standby')
+            return out.splitlines()[-1] == 'f'
+        except Exception as err:
+            logger.warning('{0} is not checked: {1}'.format(host, err))
+    primaries = [host for host, primary in zip(
+        hosts, parallel_map(is_primary, hosts)) if primary]
+    if not primaries:
+        raise ValueError('No primary found among {0}'.format(hosts))
+    return primaries[0]
+
 
-def return_(master, backup, node_id):
-    with settings(host_string=master):
-        sudo('su postgres -c "pcp_attach_node 60 127.0.0.1 9898 postgres'
-          ' {pcp_password} {node_id}"'.format(node_id=node_id,
-                                                    pcp_password=pcp_password))
-    with settings(host_string=backup):
-        sudo('su postgres -c "pcp_attach_node 60 127.0.0.1 9898 postgres'
-          ' {pcp_password} {node_id}"'.format(node_id=node_id,
-                                                    pcp_password=pcp_password))
-
-
-def failover(new_primary_host, old_primary_host, failed_node_id,
-                                                    master_node_id):
-    trigger = '/var/log/pgpool/trigger/trigger_file1'
-    with settings(host_string=new_primary_host):
-        sudo('su postgres -c "touch {trigger}"'.format(trigger=trigger))
-        sudo('su postgres -c "/usr/local/etc/dnsmadeeasy-update.sh'
-                      ' {new_master}"'.format(new_master=new_primary_host))
-        sudo('su postgres -c "pcp_detach_node 60 127.0.0.1 9898 postgres'
-          ' {pcp_password} {node_id}"'.format(node_id=failed_node_id,
-                                                    pcp_password=pcp_password))
-        sudo('su postgres -c "pcp_attach_node 60 127.0.0.1 9898 postgres'
-          ' {pcp_password} {node_id}"'.format(node_id=master_node_id,
-                                                    pcp_password=pcp_password))
-    with settings(host_string=old_primary_host):
-        sudo('su postgres -c "pcp_detach_node 60 127.0.0.1 9898 postgres'
-          ' {pcp_password} {node_id}"'.format(node_id=failed_node_id,
-                                                    pcp_password=pcp_password))
-        sudo('su postgres -c "pcp_attach_node 60 127.0.0.1 9898 postgres'
-          ' {pcp_password} {node_id}"'.format(node_id=master_node_id,
-                                                    pcp_password=pcp_password))
-
-
-def recover(primary, standby, recover_node_id):
-    with settings(host_string=primary):
-        out = sudo('/etc/init.d/postgresql status | grep -c Running')
-        if out == '1':
-            sudo('/etc/init.d/postgresql stop')
-    with settings(host_string=standby):
-        sudo('su postgres -c "pcp_recovery_node 60 127.0.0.1 9898 postgres'
-          ' {pcp_password} {node_id}"'.format(node_id=recover_node_id,
-                                                    pcp_password=pcp_password))
-    with settings(host_string=primary):
-        sudo('su postgres -c "pcp_attach_node 60 127.0.0.1 9898 postgres'
-          ' {pcp_password} {node_id}"'.format(node_id=recover_node_id,
-                                                    pcp_password=pcp_password))
+def sync_data_directory(sessions, primary, standby,
+                        streams=config.getint('RDBMS', 'RECOVERY_STREAMS')):
+    """Copy changed files of data directory from `primary` to `standby`.
+
+    Top level entries and every database of ``base`` directory are
+    copied by compressed rsync streams of `streams` in parallel, largest
+    first. Progress and network throughput (compressed bytes received
+    by `standby`) are logged as streams finish. Should be called within
+    ``pg_start_backup`` and ``pg_stop_backup``."""
+    listing = sessions[primary].sudo(LIST_DATA.format(data=data_directory),
+                                     warn_only=False, label='list data')
+    entries = sorted(((int(size) * 1024, path) for size, path in
+                      (line.split(None, 1) for line in listing.splitlines())),
+                     reverse=True)
+    total = sum(size for size, path in entries)
+    synced = {'size': 0, 'received': 0}
+    lock = Lock()
+    started = time()
+
+    def rsync(entry):
+        size, path = entry
+        out = sessions[standby].sudo(RSYNC.format(
+            primary=sessions[primary].host, data=data_directory, path=path,
+            parent=path.rpartition('/')[0]), warn_only=False,
+            label='rsync ' + path)
+        match = re.search(r'Total bytes received: ([\d,]+)', out)
+        with lock:
+            synced['size'] += size
+            synced['received'] += (int(match.group(1).replace(',', ''))
+                                   if match else size)
+            elapsed = time() - started
+            logger.info(
+                '{0:.0f} of {1:.0f} MiB ({2:.0%}) synced, {3:.0f} MiB '
+                'received, {4:.1f} MiB/s'.format(
+                    synced['size'] / 2. ** 20, total / 2. ** 20,
+                    float(synced['size']) / (total or 1),
+                    synced['received'] / 2. ** 20,
+                    synced['received'] / 2. ** 20 / (elapsed or 1)))
+    parallel_map(rsync, entries, workers=streams)
+    # Databases dropped since standby failed.
+    databases = ' '.join('-e ' + path.partition('/')[2] for size, path in
+                         entries if path.startswith('base/'))
+    sessions[standby].sudo('cd {0}/base && ls | grep -vxF {1} | '
+                           'xargs -r rm -rf'.format(data_directory, databases),
+                           warn_only=False, label='remove dropped')
+    return synced
+
+
+def rebuild_standby(sessions, primary, standby):
+    """Rebuild stopped `standby` from `primary` with rsync.
+
+    WAL segments left in ``pg_xlog`` of `standby` are removed, it
+    fetches them from `primary` by streaming replication."""
+    # Current time is backup label to avoid nested quotes.
+    sessions[primary].sudo(psql('SELECT pg_start_backup(now()::text, true)'),
+                           warn_only=False, label='pg_start_backup')
+    try:
+        sync_data_directory(sessions, primary, standby)
+    finally:
+        sessions[primary].sudo(psql('SELECT pg_stop_backup()'),
+                               label='pg_stop_backup')
+    conninfo = config.get('RDBMS', 'PRIMARY_CONNINFO').format(
+        primary=sessions[primary].host)
+    lines = ' '.join('"{0}"'.format(line.format(
+        conninfo=conninfo, trigger=TRIGGER)) for line in RECOVERY_CONF)
+    sessions[standby].sudo(
+        "cd {data} && mkdir -p pg_xlog/archive_status && "
+        "find pg_xlog/ -type f -delete && printf '%s\\n' {lines} > "
+        "recovery.conf && chown -R postgres:postgres pg_xlog recovery.conf "
+        "&& /etc/init.d/postgresql start".format(
+            data=data_directory, lines=lines), warn_only=False,
+        label='start standby')
+
+
+def recover(recover_node_id, method='pcp'):
+    """Stop PostgreSQL on failed node, recover and attach it.
+
+    :param method: "pcp" to recover node by pgpool of first reachable
+        other host (``pcp_recovery_node``) and then attach it to pgpool
+        of remaining hosts in parallel, or "rsync" to rebuild node from
+        primary with parallel rsync (see :func:`sync_data_directory`)
+        and attach it to pgpool of all hosts.
+
+    Recovery is aborted if PostgreSQL of failed node was not stopped."""
+    started = time()
+    failed = nodes[recover_node_id]
+    with opened_sessions(set([failed] + nodes + pgpool_hosts)) as sessions:
+        check_sudo(sessions)
+        if not all(run_chains(sessions, [(failed, [
+                ('stop postgresql', 'if /etc/init.d/postgresql status | '
+                 'grep -q Running; then /etc/init.d/postgresql stop; fi')])],
+                warn_only=False)):
+            raise ValueError('PostgreSQL of {0} is not stopped'.format(
+                failed))
+        if method == 'rsync':
+            primary = find_primary(
+                sessions, [host for host in nodes if host != failed])
+            rebuild_standby(sessions, primary, failed)
+            recovering = None
+        else:
+            reachable = [host for host in pgpool_hosts if host != failed and
+                         sessions[host].client]
+            if not reachable:
+                raise ValueError('No pgpool to recover {0}'.format(failed))
+            recovering = reachable[0]
+            run_chains(sessions, [(recovering,
+                                   [pcp('recovery', recover_node_id)])])
+        run_chains(sessions, [(host, [pcp('attach', recover_node_id)]) for
+                              host in pgpool_hosts if host != recovering])
+    return log_timings(sessions, started, 'Recovery of node {0}'.format(
+        recover_node_id))
+
+
+@task
+def failover_node(node, candidate=None):
+    """
+    If database node failed, run this to promote standby with the
+    lowest replication lag and detach failed node from pgpool
+
+    node
+        pgpool node ID or host from NODES option of RDBMS section;
+    candidate
+        host to promote instead of chosen one, one of other nodes.
+    """
+    failover(get_node_id(node), candidate)
+
+
+@task
+def recover_node(node, method='pcp'):
+    """
+    Run this to start recovery of failed node
+    (run this strictly after failover_node)
+
+    method
+        "pcp" for pgpool online recovery or "rsync" to rebuild node
+        with parallel rsync streams copying only changed files.
+    """
+    recover(get_node_id(node), method)
+
+
+@task
+def return_node(node):
+    """
+    Run this after temporary network issues
+    It will reattach node to pgpool on all hosts
+    """
+    return_(get_node_id(node))
 
 
 @task
@@ -67,7 +313,7 @@ def switch_to_backup():
     If master server failed, run this to promote backup server
     from slave to master-role and detach failed node from pgpool
     """
-    failover(backup, master, 0, 1)
+    failover(0, nodes[1])
 
 
 @task
@@ -76,7 +322,7 @@ def recover_master():
     Run this to start recovery of failing master node
     (run this strictly after switching_to_backup)
     """
-    recover(master, backup, 0)
+    recover(0)
 
 
 @task
@@ -85,7 +331,7 @@ def return_master():
     Run this after temporary network issues in us-east-1
     It will reattach master node to pgpool server
     """
-    return_(master, backup, 0)
+    return_(0)
 
 
 @task
@@ -94,7 +340,7 @@ def switch_to_master():
     If backup server failed, run this to promote master server
     from slave to master-role and detach failed node from pgpool
     """
-    failover(master, backup, 1, 0)
+    failover(1, nodes[0])
 
 
 @task
@@ -103,7 +349,7 @@ def recover_backup():
     Run this to start recovery of failing backup node
     (run this strictly after switching_to_master)
     """
-    recover(backup, master, 1)
+    recover(1)
 
 
 @task
@@ -112,4 +358,4 @@ def return_backup():
     Run this after temporary network issues in eu-west-1
     It will reattach backup node to pgpool server
     """
-    return_(master, backup, 1)
+    return_(1)
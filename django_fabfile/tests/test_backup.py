@@ -5,8 +5,21 @@ import fudge
 import random
 import string
 
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from boto.ec2.snapshot import Snapshot
+from boto.exception import EC2ResponseError
+
 from django_fabfile.backup import backup_instance, trim_snapshots
-from django_fabfile.backup import rsync_snapshot
+from django_fabfile.backup import backup_instances_by_tag, pending_snapshots
+from django_fabfile.backup import rsync_snapshot, _is_settled, _plan_trim
+from django_fabfile.backup import _trim_snapshots as trim_region
+from django_fabfile.backup import PendingSnapshotsGovernor
+from django_fabfile.backup import RecentSnapshots, create_consistent_snapshots
+from django_fabfile.backup import create_group_snapshots
+from django_fabfile.backup import freeze_durations, freeze_instance
+from django_fabfile.snapshot_store import SnapshotStore
 
 # Specifying the test package
 test_pkg = 'django_fabfile.backup.'
@@ -81,9 +94,9 @@ class Instance():
         print '>>> Instance.__init__()'
         self.block_device_mapping = {
             'dev-1': fudge.Fake('dev-1').has_attr(
-                volume_id=['vol-11', 'vol-12']),
+                volume_id='vol-11'),
             'dev-2': fudge.Fake('dev-2').has_attr(
-                volume_id=['vol-21', 'vol-22'])}
+                volume_id='vol-21')}
 
 
 class Tags():
@@ -146,7 +159,33 @@ def get_inst_by_id(region_name, instance_id):
     return instance
 
 
-def create_snapshot(vol, synchronously):
+def get_vol_by_id(region_name, vol_id):
+    """
+    Fake - replacement for 'utils.get_vol_by_id()'
+    """
+    print '>>> get_vol_by_id({0}, {1})'.format(region_name, vol_id)
+    return vol_id
+
+
+def get_snap_by_id(region_name, snapshot_id):
+    """
+    Fake - replacement for 'utils.get_snap_by_id()'
+    """
+    _ret_val = Snapshot(RegionInfo(region_name))
+    print '>>> get_snap_by_id({0}, {1})'.format(region_name, snapshot_id)
+    print '... return {0}'.format(_ret_val)
+    return _ret_val
+
+
+def iter_snapshots(conn, owner='self', filters=None, page_size=None):
+    """
+    Fake - replacement for 'utils.iter_snapshots()'
+    """
+    print '>>> iter_snapshots({0}, {1}, {2})'.format(conn, owner, filters)
+    return iter(conn.get_all_snapshots(owner=owner, filters=filters))
+
+
+def create_snapshot(vol, synchronously, consistent=False):
     """
     Fake - replacement for 'backup.create_snapshot'
     """
@@ -163,7 +202,7 @@ def delete_broken_snapshots():
     print '>>> delete_broken_snapshots()'
 
 
-def _trim_snapshots(reg, dry_run):
+def _trim_snapshots(reg, dry_run, state=None):
     """
     Fake - replacement for 'backup._trim_snapshots()'
     """
@@ -189,11 +228,16 @@ def get_snap_device(snap):
 class TestBackup(unittest.TestCase):
 
     @fudge.patch(test_pkg + 'get_region_conn', test_pkg + 'get_inst_by_id',
-        test_pkg + 'create_snapshot')
-    def test_backup_instance(self, fakeMethod1, fakeMethod2, fakeMethod3):
+        test_pkg + 'create_snapshot', test_pkg + 'get_vol_by_id',
+        test_pkg + 'recent_snapshots')
+    def test_backup_instance(self, fakeMethod1, fakeMethod2, fakeMethod3,
+                             fakeMethod4, fakeMethod5):
         fakeMethod1.is_callable().calls(get_region_conn)
         fakeMethod2.is_callable().calls(get_inst_by_id)
         fakeMethod3.is_callable().calls(create_snapshot)
+        fakeMethod4.is_callable().calls(get_vol_by_id)
+        fakeMethod5.provides('filter').calls(lambda vols: vols)
+        fakeMethod5.provides('register')
 
         instance = Instance()
 
@@ -226,11 +270,14 @@ class TestBackup(unittest.TestCase):
             'i-12345678', instance)
 
     @fudge.patch(test_pkg + 'get_region_conn',
-        test_pkg + 'delete_broken_snapshots', test_pkg + '_trim_snapshots')
-    def test_trim_snapshots(self, fakeMethod1, fakeMethod2, fakeMethod3):
+        test_pkg + 'delete_broken_snapshots', test_pkg + '_trim_snapshots',
+        test_pkg + '_save_trim_state')
+    def test_trim_snapshots(self, fakeMethod1, fakeMethod2, fakeMethod3,
+                            fakeMethod4):
         fakeMethod1.is_callable().calls(get_region_conn)
         fakeMethod2.is_callable().calls(delete_broken_snapshots)
         fakeMethod3.is_callable().calls(_trim_snapshots)
+        fakeMethod4.is_callable()
 
         # The methods should remove either specified or all of the old
         # snapsots, and not raise any exception in regular call
@@ -242,10 +289,14 @@ class TestBackup(unittest.TestCase):
         self.assertIsNone(trim_snapshots(),
             'The exception has been raised during testing. Please check')
 
-    @fudge.patch(test_pkg + 'get_region_conn', test_pkg + 'get_snap_device')
-    def test_rsync_snapshot(self, fakeMethod1, fakeMethod2):
+    @fudge.patch(test_pkg + 'get_region_conn', test_pkg + 'get_snap_device',
+        test_pkg + 'get_snap_by_id', test_pkg + 'iter_snapshots')
+    def test_rsync_snapshot(self, fakeMethod1, fakeMethod2, fakeMethod3,
+                            fakeMethod4):
         fakeMethod1.is_callable().calls(get_region_conn)
         fakeMethod2.is_callable().calls(get_snap_device)
+        fakeMethod3.is_callable().calls(get_snap_by_id)
+        fakeMethod4.is_callable().calls(iter_snapshots)
 
         # The method should duplicate the method into another region, and not
         # raise any exception in regular call
@@ -256,5 +307,319 @@ class TestBackup(unittest.TestCase):
             'The exception has been raised during testing. Please check')
 
 
+class TestPlanTrim(unittest.TestCase):
+
+    def record(self, day, hour, preserved=False):
+        time = datetime(2012, 11, day, hour)
+        return time.isoformat(), time, 'snap-{0}-{1}'.format(day, hour), \
+            preserved
+
+    def test_oldest_snapshot_kept_in_every_period(self):
+        targets = [datetime(2012, 11, 2), datetime(2012, 11, 3)]
+        snaps = [self.record(1, 1), self.record(1, 2), self.record(1, 3, True),
+                 self.record(2, 1), self.record(2, 2), self.record(3, 1)]
+        deleted = [rec[2] for rec in _plan_trim(snaps, targets)]
+        self.assertEqual(deleted, ['snap-1-2', 'snap-2-2'])
+
+    def test_newest_snapshot_is_never_deleted(self):
+        targets = [datetime(2012, 11, 2)]
+        snaps = [self.record(1, 1), self.record(1, 2)]
+        self.assertEqual(_plan_trim(snaps, targets), [])
+
+    def test_volume_is_replanned_after_rollover(self):
+        store = SnapshotStore()
+        store.start.extend([100, 200])
+        vol_state = {'watermark': 200, 'kept': [('snap-1', 100, 150)]}
+        self.assertTrue(_is_settled(vol_state, [0, 1], store, [50, 150]))
+        self.assertFalse(_is_settled(vol_state, [0, 1], store, [110, 150]))
+        vol_state['watermark'] = 150    # New snapshot since previous run.
+        self.assertFalse(_is_settled(vol_state, [0, 1], store, [50, 150]))
+
+
+class TestIncrementalTrim(unittest.TestCase):
+
+    def setUp(self):
+        self.snaps = []
+        for day in range(200):
+            snap = Snapshot(None)
+            snap.id, snap.volume_id = 'snap-{0:08x}'.format(day), 'vol-1'
+            snap.start_time = (datetime(2012, 11, 11) - timedelta(days=day)
+                               ).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            snap.status, snap.description, snap.tags = 'completed', '', {}
+            self.snaps.append(snap)
+        self.deleted = []
+
+    def delete_snapshot(self, snap_id):
+        if snap_id == 'fail':
+            raise EC2ResponseError(400, 'Bad Request')
+        self.deleted.append(snap_id)
+
+    def trim(self, state, now):
+        region = fudge.Fake('Region').has_attr(name='us-east-1')
+        conn = fudge.Fake('Connection').provides('delete_snapshot').calls(
+            self.delete_snapshot)
+        with fudge.patched_context(
+                'django_fabfile.backup', 'get_region_conn',
+                fudge.Fake().is_callable().returns(conn)):
+            with fudge.patched_context(
+                    'django_fabfile.backup', 'iter_snapshots',
+                    fudge.Fake().is_callable().returns([
+                        snap for snap in self.snaps if
+                        snap.id not in self.deleted])):
+                trim_region(region, state=state, now=now)
+
+    def test_volume_is_settled_within_day(self):
+        state = {'vol-gone': {'watermark': 0, 'kept': []}}
+        self.trim(state, datetime(2012, 11, 13, 10, 5))
+        self.assertTrue(self.deleted)
+        self.assertEqual(sorted(state), ['vol-1'])
+        with fudge.patched_context('django_fabfile.backup', '_plan_trim',
+                                   fudge.Fake().is_callable(
+                                       ).times_called(0)):
+            self.trim(state, datetime(2012, 11, 13, 14, 30))
+
+    def test_volume_with_failed_deletion_is_not_settled(self):
+        self.snaps[150].id = 'fail'
+        state = {}
+        self.trim(state, datetime(2012, 11, 13, 10, 5))
+        self.assertEqual(state, {})
+
+
+class PendingSnapshot(object):
+
+    def __init__(self, snap_id, vol_id, region_name='us-east-1'):
+        self.id, self.volume_id = snap_id, vol_id
+        self.region = RegionInfo(region_name)
+        self.description = ''
+
+
+class TestPendingSnapshotsGovernor(unittest.TestCase):
+
+    def setUp(self):
+        self.governor = PendingSnapshotsGovernor(
+            max_per_region=2, max_per_volume=1, policy='skip',
+            refresh_period=60)
+        self.governor.refreshed_at['us-east-1'] = 1e20  # Never outdated.
+
+    def test_limits_per_volume_and_region(self):
+        self.assertTrue(self.governor.can_start('us-east-1',
+                                                ['vol-2', 'vol-3', 'vol-4']))
+        self.governor.register(PendingSnapshot('snap-1', 'vol-1'))
+        self.assertFalse(self.governor.can_start('us-east-1', ['vol-1']))
+        self.assertTrue(self.governor.can_start('us-east-1', ['vol-2']))
+        self.assertFalse(self.governor.can_start('us-east-1',
+                                                 ['vol-2', 'vol-3']))
+        vol = fudge.Fake('Volume').has_attr(id='vol-1',
+                                            region=RegionInfo('us-east-1'))
+        self.assertFalse(self.governor.acquire(vol))
+        self.assertEqual(self.governor.skipped, 1)
+
+    @fudge.patch(test_pkg + 'get_region_conn')
+    def test_refresh_releases_completed(self, fakeMethod1):
+        self.governor.register(PendingSnapshot('snap-1', 'vol-1'))
+        self.governor.registered_at['snap-1'] = 0
+        conn = fudge.Fake('Connection').provides('get_all_snapshots').returns(
+            [PendingSnapshot('snap-2', 'vol-2')])
+        fakeMethod1.is_callable().returns(conn)
+        self.governor.refresh('us-east-1', force=True)
+        self.assertEqual(self.governor.pending['us-east-1'],
+                         {'snap-2': 'vol-2'})
+        self.assertFalse('snap-1' in self.governor.registered_at)
+
+    def test_group_is_admitted_as_whole(self):
+        self.governor.register(PendingSnapshot('snap-1', 'vol-1'))
+        vols = [fudge.Fake('Volume').has_attr(
+            id=vol_id, region=RegionInfo('us-east-1')) for vol_id in
+            ('vol-2', 'vol-3')]
+        self.assertTrue(self.governor.acquire(vols[0]))
+        self.assertFalse(self.governor.acquire_all(vols))
+        self.assertEqual(self.governor.skipped, 2)
+
+
+class TestDefaultPendingLimits(unittest.TestCase):
+
+    def setUp(self):
+        self.max_per_region = pending_snapshots.max_per_region
+        self.snapshotted = []
+
+    def tearDown(self):
+        pending_snapshots.max_per_region = self.max_per_region
+        pending_snapshots.pending.pop('us-east-1', None)
+        pending_snapshots.refreshed_at.pop('us-east-1', None)
+
+    def volume(self, vol_id):
+        return fudge.Fake('Volume').has_attr(
+            id=vol_id, region=RegionInfo('us-east-1'), tags={},
+            attach_data=None).provides('create_snapshot').calls(
+            lambda descr: self.snapshotted.append(vol_id) or
+            PendingSnapshot('snap-' + vol_id, vol_id))
+
+    @fudge.patch(test_pkg + 'get_region_conn', test_pkg + 'get_inst_by_id',
+                 test_pkg + 'get_vol_by_id', test_pkg + 'recent_snapshots',
+                 test_pkg + 'instances_batcher', test_pkg + 'volumes_batcher',
+                 test_pkg + 'add_tags')
+    def test_all_volumes_are_snapshotted(self, fake_conn, fake_get_inst,
+                                         fake_get_vol, fake_recent,
+                                         fake_inst_batcher, fake_vol_batcher,
+                                         fake_add_tags):
+        pending_snapshots.max_per_region = PendingSnapshotsGovernor(
+            refresh_period=60).max_per_region    # As in config.
+        inst_ids = ['i-{0}'.format(num) for num in range(8)]
+        conn = fudge.Fake('Connection').has_attr(
+            region=RegionInfo('us-east-1')).provides('get_all_tags').returns(
+            [fudge.Fake('Tag').has_attr(res_id=inst_id) for inst_id in
+             inst_ids]).provides('get_all_snapshots').returns([])
+        fake_conn.is_callable().returns(conn)
+        fake_get_inst.is_callable().calls(
+            lambda reg_name, inst_id: fudge.Fake(inst_id).has_attr(
+                block_device_mapping=dict(
+                    (dev, fudge.Fake(dev).has_attr(
+                        volume_id='vol-{0}{1}'.format(inst_id, dev)))
+                    for dev in ('f', 'g'))))
+        fake_get_vol.is_callable().calls(
+            lambda reg_name, vol_id: self.volume(vol_id))
+        fake_recent.provides('filter').calls(lambda vols: vols)
+        fake_recent.provides('register')
+        fake_recent.has_attr(skipped=0)
+        fake_inst_batcher.provides('prime')
+        fake_vol_batcher.provides('prime')
+        fake_add_tags.is_callable()
+        backup_instances_by_tag('us-east-1')
+        self.assertEqual(len(self.snapshotted), 16)
+
+
+class TestRecentSnapshots(unittest.TestCase):
+
+    @fudge.patch(test_pkg + 'get_region_conn')
+    def test_volumes_with_recent_snapshots_are_skipped(self, fakeMethod1):
+        snap = PendingSnapshot('snap-1', 'vol-1')
+        snap.start_time = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        conn = fudge.Fake('Connection').provides('get_all_snapshots').returns(
+            [snap])
+        fakeMethod1.is_callable().returns(conn)
+        recent = RecentSnapshots(max_age=60 * 60, refresh_period=60)
+        vols = [fudge.Fake('Volume').has_attr(
+            id=vol_id, region=RegionInfo('us-east-1')) for vol_id in
+            ('vol-1', 'vol-2')]
+        self.assertEqual(recent.filter(vols), vols[1:])
+        recent.register(PendingSnapshot('snap-2', 'vol-2'))
+        self.assertEqual(recent.filter(vols), [])
+        self.assertEqual(recent.skipped, 3)
+
+
+class TestConsistentSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def volume(self, vol_id):
+        vol = fudge.Fake('Volume').has_attr(
+            id=vol_id, region=RegionInfo('us-east-1'), tags={},
+            attach_data=fudge.Fake().has_attr(device='/dev/sdf'))
+        snap = PendingSnapshot('snap-' + vol_id, vol_id)
+        return vol.provides('create_snapshot').calls(
+            lambda descr: self.calls.append(vol_id) or snap)
+
+    @contextmanager
+    def freeze_instance(self, inst, vols):
+        self.calls.append('freeze')
+        yield
+        self.calls.append('thaw')
+
+    @fudge.patch(test_pkg + 'freeze_instance', test_pkg + 'add_tags')
+    def test_all_volumes_snapshotted_within_single_freeze(self, fakeMethod1,
+                                                          fakeMethod2):
+        fakeMethod1.is_callable().calls(self.freeze_instance)
+        fakeMethod2.is_callable()
+        inst = fudge.Fake('Instance').has_attr(
+            id='i-1', instance_type='m1.small', architecture='x86_64',
+            root_device_name='/dev/sda1', tags={})
+        snaps = create_consistent_snapshots(
+            inst, [self.volume('vol-1'), self.volume('vol-2')],
+            governor=None)
+        self.assertEqual([snap.id for snap in snaps],
+                         ['snap-vol-1', 'snap-vol-2'])
+        self.assertEqual(self.calls[0], 'freeze')
+        self.assertEqual(sorted(self.calls[1:3]), ['vol-1', 'vol-2'])
+        self.assertEqual(self.calls[3:], ['thaw'])
+
+    @fudge.patch(test_pkg + 'create_instance_snapshots', test_pkg + 'add_tags')
+    def test_group_snapshots_are_tagged_with_own_volume(self, fakeMethod1,
+                                                        fakeMethod2):
+        vols = [self.volume('vol-1'), self.volume('vol-2')]
+        inst = fudge.Fake('Instance').has_attr(
+            id='i-1', region=RegionInfo('us-east-1'), instance_type='m1.small',
+            architecture='x86_64', root_device_name='/dev/sda1', tags={})
+        snaps = []
+        for vol in vols:
+            snap = PendingSnapshot('snap-' + vol.id, vol.id)
+            snap.tags = {'Backup:Instance': 'i-1',
+                         'Backup:Region': 'us-east-1'}
+            snaps.append(snap)
+        fakeMethod1.is_callable().returns(snaps)
+        added = {}
+        fakeMethod2.is_callable().calls(
+            lambda snap, tags: added.update({snap.id: tags}))
+        create_group_snapshots(inst, vols, governor=None)
+        self.assertEqual(added, dict(
+            ('snap-' + vol_id, {'Backup:Volume': vol_id,
+                                'Backup:Device': '/dev/sdf'}) for vol_id in
+            ('vol-1', 'vol-2')))
+
+
+class ExecutionContext(object):
+
+    mounts = ('/dev/xvda1 / ext4 rw 0 0\n'
+              '/dev/xvdf /data xfs rw 0 0\n'
+              '/dev/nvme1n1p2 /logs ext4 rw 0 0\n'
+              '/dev/xvdg /other ext4 rw 0 0\n'
+              'proc /proc proc rw 0 0\n')
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.commands = []
+
+    def run(self, command):
+        return self.mounts
+
+    def sudo(self, command, warn_only=None):
+        self.commands.append(command)
+        if self.fail and 'fsfreeze -f' in command:
+            raise Exception('fsfreeze failed')
+
+
+class TestFreezeInstance(unittest.TestCase):
+
+    def setUp(self):
+        self.inst = fudge.Fake('Instance').has_attr(id='i-1', state='running')
+        self.vols = [fudge.Fake('Volume').has_attr(id=vol_id) for vol_id in
+                     ('vol-1', 'vol-2', 'vol-3')]
+        freeze_durations.clear()
+
+    def freeze(self, ctx):
+        devs = {'vol-1': '/dev/xvda', 'vol-2': '/dev/xvdf',
+                'vol-3': '/dev/nvme1n1'}
+        with fudge.patched_context(
+                'django_fabfile.backup', 'get_vol_dev', lambda vol, ctx:
+                devs[vol.id]):
+            with freeze_instance(self.inst, self.vols, ctx):
+                pass
+
+    def test_only_snapshotted_devices_are_frozen(self):
+        ctx = ExecutionContext()
+        self.freeze(ctx)
+        self.assertEqual(ctx.commands, [
+            'sync && fsfreeze -f /data && fsfreeze -f /logs',
+            'fsfreeze -u /data; fsfreeze -u /logs'])
+        self.assertTrue('i-1' in freeze_durations)
+
+    def test_duration_is_not_recorded_if_freeze_failed(self):
+        ctx = ExecutionContext(fail=True)
+        self.freeze(ctx)
+        self.assertEqual(ctx.commands[1],
+                         'fsfreeze -u /data; fsfreeze -u /logs')
+        self.assertFalse('i-1' in freeze_durations)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,46 @@
+from django.utils import unittest
+
+import fudge
+
+from django_fabfile import instances
+from django_fabfile.instances import find_vol_dev, get_vol_dev, mount_volume
+from django_fabfile.tests.test_remote import fake_context
+
+
+class TestVolumeDevice(unittest.TestCase):
+
+    def volume(self, vol_id='vol-1a2b', device='/dev/sdf'):
+        return fudge.Fake('Volume').has_attr(
+            id=vol_id, region=fudge.Fake('Region').has_attr(name='us-east-1'),
+            attach_data=fudge.Fake('AttachmentSet').has_attr(
+                instance_id='i-1', device=device,
+                attach_time='2012-11-13T10:00:00.000Z'))
+
+    def test_nvme_device_is_found_by_serial(self):
+        listing = 'nvme0n1 vol0ffff\nnvme0n1p1\nnvme1n1 vol1a2b\nxvdf\n'
+        self.assertEqual(find_vol_dev(self.volume(), listing),
+                         '/dev/nvme1n1')
+        self.assertEqual(find_vol_dev(self.volume('vol-3c4d'), listing),
+                         '/dev/xvdf')
+        self.assertEqual(find_vol_dev(self.volume(device='/dev/sdg'),
+                                      'xvda1\nxvdf\n'), None)
+
+    @fudge.patch('django_fabfile.instances.wait_for')
+    def test_device_is_resolved_once_per_attachment(self, fake_wait_for):
+        fake_wait_for.is_callable()
+        instances._vol_devs.clear()
+        vol = self.volume()
+        ctx = fake_context('ubuntu@host', outputs={
+            'list devices': 'xvda1\nxvdf\n'})
+        self.assertEqual(mount_volume(vol, mkfs=True, ctx=ctx),
+                         '/media/xvdf')
+        self.assertEqual(get_vol_dev(vol, ctx), '/dev/xvdf')
+        self.assertEqual([command for command, use_sudo, warn_only in
+                          ctx.commands], [
+            instances.LIST_DEVICES, 'mkdir -p /media/xvdf',
+            'mkfs.ext3 /dev/xvdf', 'mount /dev/xvdf /media/xvdf',
+            'chown -R ubuntu:ubuntu /media/xvdf'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+from django.utils import unittest
+
+import fudge
+from fabric.api import env
+
+from django_fabfile.remote import (CommandResult, ExecutionContext,
+                                   RemoteCommandError, RemoteSession,
+                                   SessionPool, check_sudo, run_chains)
+from django_fabfile.utils import WaitForProper
+
+
+class FakeSession(object):
+
+    def __init__(self, host, fail=(), connected=True, location='',
+                 outputs=None):
+        self.host, self.fail, self.location = host, fail, location
+        self.outputs = outputs or {}
+        self.client = object() if connected else None
+        self.commands = []
+        self.timings = []
+
+    def open(self):
+        if not self.client:
+            raise IOError('Unreachable')
+        return self
+
+    def sudo(self, command, warn_only=None, label=None):
+        if label == 'replay location':
+            return CommandResult(self.location, 0)
+        self.commands.append(label or command)
+        if (label or command) in self.fail:
+            if not warn_only:
+                raise RemoteCommandError(command)
+            return CommandResult('', 1)
+        return CommandResult(self.outputs.get(label, ''), 0)
+
+
+class TestRunChains(unittest.TestCase):
+
+    def test_failed_chains_are_reported(self):
+        sessions = {'a': FakeSession('a', fail=['two']),
+                    'b': FakeSession('b'),
+                    'c': FakeSession('c', connected=False)}
+        chains = [('a', ['one', 'two', 'three']), ('b', ['one']),
+                  ('c', ['one'])]
+        self.assertEqual(run_chains(sessions, chains, warn_only=True),
+                         [False, True, False])
+        self.assertEqual(sessions['a'].commands, ['one', 'two', 'three'])
+        self.assertEqual(sessions['c'].commands, [])
+        sessions['a'].commands = []
+        run_chains(sessions, chains, warn_only=False)
+        self.assertEqual(sessions['a'].commands, ['one', 'two'])
+
+
+class SudoSession(FakeSession):
+
+    password = None
+
+    def sudo(self, command, warn_only=None, label=None):
+        self.commands.append(label)
+        return CommandResult('', 0 if self.password == 'secret' else 1)
+
+
+class TestCheckSudo(unittest.TestCase):
+
+    def setUp(self):
+        self.password = env.password
+        env.password = None
+        self.sessions = {'a': SudoSession('a'), 'b': SudoSession('b'),
+                         'c': SudoSession('c', connected=False)}
+
+    def tearDown(self):
+        env.password = self.password
+
+    @fudge.patch('django_fabfile.remote.prompt_for_password')
+    def test_password_is_prompted_once(self, fake_prompt):
+        fake_prompt.expects_call().returns('secret')
+        check_sudo(self.sessions)
+        self.assertEqual(env.password, 'secret')
+        self.assertEqual(self.sessions['a'].commands, ['check sudo'] * 2)
+        self.assertEqual(self.sessions['c'].commands, [])
+
+    @fudge.patch('django_fabfile.remote.prompt_for_password')
+    def test_wrong_password_aborts(self, fake_prompt):
+        fake_prompt.expects_call().returns('wrong')
+        self.assertRaises(RemoteCommandError, check_sudo, self.sessions)
+
+
+def fake_context(host_string, fail=(), outputs=None, **kwargs):
+    """Return context recording commands in `commands` list instead of
+    running them."""
+    ctx = ExecutionContext(host_string, **kwargs)
+    ctx.commands = []
+
+    def run(command, use_sudo=False, warn_only=None, label=None):
+        ctx.commands.append((command, use_sudo, warn_only))
+        return CommandResult((outputs or {}).get(label, ''),
+                             1 if command in fail else 0)
+    session = fudge.Fake('RemoteSession').provides('run').calls(
+        run).provides('open')
+    ctx.pool = fudge.Fake('SessionPool').provides('get').returns(session)
+    return ctx
+
+
+class TestExecutionContext(unittest.TestCase):
+
+    def test_sudo_policy(self):
+        ctx = fake_context('root@host', fail=['test -e /dev/xvdf'],
+                           use_sudo=False, warn_only=True)
+        self.assertEqual((ctx.user, ctx.host), ('root', 'host'))
+        ctx.sudo('id')
+        self.assertFalse(ctx.exists('/dev/xvdf'))
+        self.assertEqual(ctx.commands, [('id', False, True),
+                                        ('test -e /dev/xvdf', False, True)])
+
+    @fudge.patch('django_fabfile.remote.retried')
+    def test_failed_connection_is_retried(self, fake_retried):
+        fake_retried.is_callable().calls(WaitForProper(attempts=2, pause=0))
+        session = RemoteSession('host')
+        session.error = IOError('Unreachable')
+        transport = fudge.Fake('Transport').provides('is_active').returns(
+            True)
+        session._connect = lambda: fudge.Fake('SSHClient').provides(
+            'get_transport').returns(transport)
+        session.run = lambda command, **kwargs: (
+            session.open() and CommandResult('ok', 0))
+        ctx = ExecutionContext('host')
+        ctx.pool = fudge.Fake('SessionPool').provides('get').returns(session)
+        self.assertEqual(ctx.wait_for_sudo('id'), 'ok')
+        self.assertEqual((session.error, session.connects), (None, 1))
+
+
+class TestSessionPool(unittest.TestCase):
+
+    def test_sessions_are_shared_by_host_user_and_key(self):
+        pool = SessionPool(idle=600)
+        session = pool.get('ubuntu@host', key_filename='a.pem')
+        self.assertTrue(pool.get('host', 'ubuntu', ['a.pem']) is session)
+        self.assertFalse(pool.get('host', 'root', 'a.pem') is session)
+        session.error = IOError('Unreachable')
+        self.assertFalse(pool.get('ubuntu@host', key_filename='a.pem') is
+                         session)
+
+    def test_idle_sessions_are_closed_and_counted(self):
+        pool = SessionPool(idle=0)
+        session = pool.get('host')
+        session.client = fudge.Fake('SSHClient').expects('close')
+        session.connects, session.channels = 1, 5
+        session.last_used -= 1
+        pool.get('other')
+        self.assertEqual(session.client, None)
+        self.assertEqual(pool.stats(), {'hosts': 2, 'connections': 1,
+                                        'commands': 5, 'reused': 4,
+                                        'reconnects': 0})
+
+    def test_lost_connection_is_reopened(self):
+        session = RemoteSession('host')
+        transport = fudge.Fake('Transport').provides('is_active').returns(
+            False)
+        session.client = fudge.Fake('SSHClient').provides(
+            'get_transport').returns(transport).expects('close')
+        client = object()
+        session._connect = lambda: client
+        self.assertTrue(session.open().client is client)
+        self.assertEqual((session.connects, session.reconnects), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
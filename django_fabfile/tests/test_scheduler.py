@@ -0,0 +1,94 @@
+from django.utils import unittest
+
+import fudge
+
+from django_fabfile.scheduler import BackupScheduler, get_offset
+
+
+class FakeGovernor(object):
+
+    max_per_region = 2
+
+    def __init__(self, busy=()):
+        self.busy = busy
+
+    def can_start(self, region_name, vol_ids):
+        return not set(vol_ids) & set(self.busy)
+
+    def refresh(self, region_name):
+        pass
+
+    def count(self):
+        return {}
+
+
+def instance(inst_id, vol_ids, tags=None):
+    bdm = dict(('/dev/sd' + chr(ord('f') + i), fudge.Fake('BDM').has_attr(
+        volume_id=vol_id)) for i, vol_id in enumerate(vol_ids))
+    return fudge.Fake(inst_id).has_attr(
+        id=inst_id, block_device_mapping=bdm,
+        tags=tags if tags is not None else {'Earmarking': 'production'})
+
+
+class TestBackupScheduler(unittest.TestCase):
+
+    def scheduler(self, governor=None):
+        return BackupScheduler(100, ['us-east-1'], 'Earmarking',
+                               'production', governor=governor or
+                               FakeGovernor())
+
+    def test_offset_is_deterministic_within_interval(self):
+        offsets = [get_offset('i-{0:08x}'.format(i), 3600) for i in
+                   range(100)]
+        self.assertEqual(offsets, [get_offset('i-{0:08x}'.format(i), 3600)
+                                   for i in range(100)])
+        self.assertTrue(all(0 <= offset < 3600 for offset in offsets))
+        self.assertTrue(len(set(offsets)) > 90)
+
+    @fudge.patch('django_fabfile.scheduler.get_region_conn',
+                 'django_fabfile.scheduler.get_offset')
+    def test_past_offsets_are_due_in_next_interval(self, fake_conn,
+                                                   fake_offset):
+        tags = [fudge.Fake('Tag').has_attr(res_id=res_id) for res_id in
+                ('i-past', 'i-future')]
+        fake_conn.is_callable().returns(fudge.Fake('Connection').provides(
+            'get_all_tags').returns(tags))
+        fake_offset.is_callable().calls(
+            lambda res_id, interval: {'i-past': 10, 'i-future': 90}[res_id])
+        scheduler = self.scheduler()
+        scheduler.discover(1050)
+        scheduler.discover(1060)    # Already scheduled are kept.
+        self.assertEqual(sorted(scheduler.queue), [
+            (1090, 'us-east-1', 'i-future'), (1110, 'us-east-1', 'i-past')])
+
+    @fudge.patch('django_fabfile.scheduler.get_inst_by_id',
+                 'django_fabfile.scheduler.backup_instance')
+    def test_dispatch(self, fake_get_inst, fake_backup):
+        instances = {'i-1': instance('i-1', ['vol-1']),
+                     'i-busy': instance('i-busy', ['vol-2']),
+                     'i-big': instance('i-big', ['vol-3', 'vol-4', 'vol-5']),
+                     'i-untagged': instance('i-untagged', ['vol-6'], {})}
+        fake_get_inst.is_callable().calls(
+            lambda reg_name, inst_id: instances[inst_id])
+        started = []
+        fake_backup.is_callable().calls(
+            lambda reg_name, instance, consistent: started.append(
+                instance.id))
+        scheduler = self.scheduler(FakeGovernor(busy=['vol-2']))
+        scheduler.queue = sorted([(5, 'us-east-1', inst_id) for inst_id in
+                                  instances] + [(50, 'us-east-1', 'i-1')])
+        scheduler.scheduled = set(('us-east-1', inst_id) for inst_id in
+                                  instances)
+        scheduler.dispatch(10)
+        self.assertEqual(sorted(started), ['i-1', 'i-big'])
+        self.assertEqual(scheduler.oversized, set(['i-big']))
+        self.assertEqual(sorted(scheduler.queue), [
+            (5, 'us-east-1', 'i-busy'), (50, 'us-east-1', 'i-1'),
+            (105, 'us-east-1', 'i-1'), (105, 'us-east-1', 'i-big')])
+        self.assertEqual(scheduler.status(10)['queue_depth'], 1)
+        self.assertEqual((scheduler.started, scheduler.deferred), (2, 1))
+        self.assertFalse(('us-east-1', 'i-untagged') in scheduler.scheduled)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+from django.utils import unittest
+
+from boto.ec2.securitygroup import GroupOrCIDR
+import fudge
+
+from django_fabfile import security_groups
+from django_fabfile.security_groups import (
+    BLANK_FINGERPRINT, SSH_ONLY_RULES, _delete_groups, change_rules,
+    format_plan, get_canonical_rules, get_fingerprint,
+    get_pool_security_group, plan_sync, replicate_security_groups)
+
+
+class TestDeleteGroups(unittest.TestCase):
+
+    def setUp(self):
+        self.deleted = []
+
+    def group(self, name):
+        return fudge.Fake(name).has_attr(name=name, region='us-east-1'
+            ).provides('delete').calls(lambda: self.deleted.append(name))
+
+    def test_granting_groups_are_deleted_first(self):
+        groups = [self.group(name) for name in ('db', 'app', 'web')]
+        granted = {'web': set(['app', 'web']), 'app': set(['db']),
+                   'db': set()}
+        _delete_groups(groups, granted)
+        self.assertEqual(self.deleted, ['web', 'app', 'db'])
+
+    def test_groups_granting_each_other_are_kept(self):
+        groups = [self.group(name) for name in ('a', 'b', 'c')]
+        granted = {'a': set(['b']), 'b': set(['a']), 'c': set()}
+        _delete_groups(groups, granted)
+        self.assertEqual(self.deleted, ['c'])
+
+
+def Grant(cidr_ip=None, name=None, owner_id=None):
+    grant = GroupOrCIDR()
+    grant.cidr_ip, grant.name, grant.owner_id = cidr_ip, name, owner_id
+    return grant
+
+
+class TestChangeRules(unittest.TestCase):
+
+    def test_permissions_are_batched(self):
+        calls, added = [], []
+        conn = fudge.Fake('Connection').provides('get_status').calls(
+            lambda *args, **kwargs: calls.append(args))
+        s_g = fudge.Fake('SecurityGroup').has_attr(
+            name='web', vpc_id=None, connection=conn).provides(
+            'add_rule').calls(lambda *args: added.append(args))
+        permissions = [
+            (('tcp', '22', '22'), [Grant('10.0.0.0/8'), Grant('1.2.3.4/32')]),
+            (('tcp', '80', '80'), [Grant(name='lb', owner_id='123')]),
+            (('udp', '53', '53'), [])]
+        self.assertEqual(change_rules(s_g, 'authorize', permissions), 1)
+        operation, params = calls[0]
+        self.assertEqual(operation, 'AuthorizeSecurityGroupIngress')
+        self.assertEqual(params, {
+            'GroupName': 'web',
+            'IpPermissions.1.IpProtocol': 'tcp',
+            'IpPermissions.1.FromPort': '22',
+            'IpPermissions.1.ToPort': '22',
+            'IpPermissions.1.IpRanges.1.CidrIp': '10.0.0.0/8',
+            'IpPermissions.1.IpRanges.2.CidrIp': '1.2.3.4/32',
+            'IpPermissions.2.IpProtocol': 'tcp',
+            'IpPermissions.2.FromPort': '80',
+            'IpPermissions.2.ToPort': '80',
+            'IpPermissions.2.Groups.1.GroupName': 'lb',
+            'IpPermissions.2.Groups.1.UserId': '123'})
+        self.assertEqual(len(added), 3)
+        self.assertEqual(change_rules(s_g, 'revoke', permissions[2:]), 0)
+
+
+class Rule(object):
+
+    def __init__(self, ip_protocol, from_port, to_port, grants):
+        self.ip_protocol, self.from_port, self.to_port = (ip_protocol,
+                                                          from_port, to_port)
+        self.grants = grants
+
+
+class TestFingerprints(unittest.TestCase):
+
+    def test_fingerprint_does_not_depend_on_order(self):
+        rules = [Rule('tcp', '80', '80', [Grant('1.2.3.4/32'),
+                                          Grant(name='lb', owner_id='1')]),
+                 Rule('tcp', '22', '22', [Grant('0.0.0.0/0')])]
+        s_g = fudge.Fake('SecurityGroup').has_attr(rules=rules)
+        reordered = fudge.Fake('SecurityGroup').has_attr(rules=[
+            rules[1], Rule('tcp', '80', '80', rules[0].grants[::-1])])
+        self.assertEqual(get_fingerprint(get_canonical_rules(s_g)),
+                         get_fingerprint(get_canonical_rules(reordered)))
+
+    def test_blank_fingerprint(self):
+        s_g = fudge.Fake('SecurityGroup').has_attr(rules=[
+            Rule('tcp', '22', '22', [Grant('0.0.0.0/0')])])
+        self.assertEqual(get_fingerprint(get_canonical_rules(s_g)),
+                         BLANK_FINGERPRINT)
+
+
+class TestPlanSync(unittest.TestCase):
+
+    def group(self, region_name, name, rules):
+        region = fudge.Fake('Region').has_attr(name=region_name)
+        return fudge.Fake(name).has_attr(
+            name=name, region=region, owner_id='1', description=name,
+            rules=rules)
+
+    def test_granted_groups_are_created_first(self):
+        db = self.group('us-east-1', 'db', [
+            Rule('tcp', '5432', '5432', [Grant(name='app', owner_id='1')])])
+        app = self.group('us-east-1', 'app', [
+            Rule('tcp', '80', '80', [Grant(name='lb', owner_id='2')]),
+            Rule('tcp', '22', '22', [Grant('0.0.0.0/0')])])
+        old_db = self.group('eu-west-1', 'db', [
+            Rule('tcp', '22', '22', [Grant('0.0.0.0/0')])])
+        snapshot = {'us-east-1': {'db': db, 'app': app},
+                    'eu-west-1': {'db': old_db}}
+        changes = plan_sync([(db, 'eu-west-1')], snapshot)
+        self.assertEqual(format_plan(changes), [
+            'eu-west-1: create app',
+            'eu-west-1: revoke db tcp 22-22 from 0.0.0.0/0',
+            'eu-west-1: authorize app tcp 22-22 from 0.0.0.0/0',
+            'eu-west-1: authorize db tcp 5432-5432 from app-1'])
+        self.assertEqual(sorted(snapshot['eu-west-1']), ['db'])
+
+    def test_identical_groups_are_not_changed(self):
+        rules = [Rule('tcp', '22', '22', [Grant('0.0.0.0/0')])]
+        src = self.group('us-east-1', 'web', rules)
+        snapshot = {'us-east-1': {'web': src},
+                    'eu-west-1': {'web': self.group('eu-west-1', 'web',
+                                                    rules)}}
+        self.assertEqual(plan_sync([(src, 'eu-west-1')], snapshot), [])
+
+
+class TestSecurityGroupPool(unittest.TestCase):
+
+    def setUp(self):
+        security_groups._pool.clear()
+
+    @fudge.patch('django_fabfile.security_groups.get_region_conn')
+    def test_pooled_group_is_created_once(self, fake_get_conn):
+        region = fudge.Fake('Region').has_attr(name='us-east-1')
+        s_g = fudge.Fake('SecurityGroup').has_attr(rules=[])
+
+        def authorize(ip_protocol, from_port, to_port, cidr_ip):
+            s_g.rules.append(Rule(ip_protocol, from_port, to_port,
+                                  [Grant(cidr_ip)]))
+        s_g.provides('authorize').calls(authorize)
+        conn = fudge.Fake('Connection').expects(
+            'get_all_security_groups').returns([]).times_called(1).expects(
+            'create_security_group').returns(s_g).times_called(1)
+        fake_get_conn.is_callable().returns(conn)
+        self.assertTrue(get_pool_security_group(region) is s_g)
+        self.assertTrue(get_pool_security_group(region,
+                                                SSH_ONLY_RULES) is s_g)
+        self.assertEqual(get_fingerprint(get_canonical_rules(s_g)),
+                         BLANK_FINGERPRINT)
+
+
+class TestIncrementalReplication(unittest.TestCase):
+
+    def group(self, region_name, tags):
+        region = fudge.Fake('Region').has_attr(name=region_name)
+        return fudge.Fake('SecurityGroup').has_attr(
+            name='web', id='sg-' + region_name, region=region, tags=tags,
+            rules=[Rule('tcp', '80', '80', [Grant('0.0.0.0/0')])])
+
+    @fudge.patch('django_fabfile.security_groups.get_region_conn',
+                 'django_fabfile.security_groups._load_replication_state',
+                 'django_fabfile.security_groups._save_replication_state')
+    def test_unchanged_groups_are_skipped(self, fake_conn, fake_load,
+                                          fake_save):
+        fingerprint = get_fingerprint(get_canonical_rules(
+            self.group('us-east-1', {})))
+        tags = {'Hash': fingerprint, 'Version': '2012-11-13T10:00:00'}
+        groups = dict((reg, self.group(reg, tags)) for reg in
+                      ('us-east-1', 'eu-west-1'))
+        regions = [grp.region for grp in groups.values()]
+
+        def get_region_conn(region_name=None):
+            return fudge.Fake('Connection').provides(
+                'get_all_regions').returns(regions).provides(
+                'get_all_security_groups').returns([groups.get(region_name)])
+        fake_conn.is_callable().calls(get_region_conn)
+        fake_load.is_callable().returns({'web': dict(
+            (reg, {'Id': 'sg-' + reg, 'Hash': fingerprint,
+                   'Version': '2012-11-13T10:00:00'}) for reg in
+            ('us-east-1', 'eu-west-1'))})
+        saved = []
+        fake_save.is_callable().calls(saved.append)
+        replicate_security_groups()     # Would fail on add_tag call.
+        self.assertEqual(sorted(saved[0]['web']), ['eu-west-1', 'us-east-1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
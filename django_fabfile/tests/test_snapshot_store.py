@@ -0,0 +1,46 @@
+from datetime import datetime
+from django.utils import unittest
+
+from boto.ec2.snapshot import Snapshot
+
+from django_fabfile.snapshot_store import SnapshotStore, to_epoch
+
+
+def snapshot(snap_id, vol_id, start_time, tags=None):
+    snap = Snapshot()
+    snap.id, snap.volume_id, snap.status = snap_id, vol_id, 'completed'
+    snap.start_time = start_time.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    snap.tags = tags or {}
+    return snap
+
+
+class TestSnapshotStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = SnapshotStore().extend([
+            snapshot('snap-3', 'vol-b', datetime(2012, 11, 3)),
+            snapshot('snap-1', 'vol-a', datetime(2012, 11, 2)),
+            snapshot('snap-2', 'vol-a', datetime(2012, 11, 1),
+                     {'preserve_snapshot': 'True'}),
+            snapshot('snap-4', 'vol-a', datetime(2012, 11, 4)),
+        ])
+
+    def test_group_by_volume(self):
+        groups = [(vol_id, [self.store.snapshot_id(idx) for idx in rows])
+                  for vol_id, rows in self.store.group_by_volume()]
+        self.assertEqual(groups, [('vol-b', ['snap-3']),
+                                  ('vol-a', ['snap-2', 'snap-1', 'snap-4'])])
+        self.assertEqual(list(self.store.flags), [0, 0, 1, 0])
+
+    def test_latest_by_volume_and_window(self):
+        latest = self.store.latest_by_volume()
+        self.assertEqual(self.store.snapshot_id(latest['vol-a']), 'snap-4')
+        rows = dict(self.store.group_by_volume())['vol-a']
+        rows = self.store.window(rows, to_epoch(datetime(2012, 11, 2)),
+                                 to_epoch(datetime(2012, 11, 4)))
+        self.assertEqual([self.store.snapshot_id(idx) for idx in rows],
+                         ['snap-1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
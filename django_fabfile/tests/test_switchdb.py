@@ -0,0 +1,95 @@
+from contextlib import contextmanager
+from django.utils import unittest
+
+import fudge
+
+from django_fabfile import switchdb
+from django_fabfile.remote import RemoteCommandError
+from django_fabfile.switchdb import (failover, parse_location, recover,
+                                     sync_data_directory)
+from django_fabfile.tests.test_remote import FakeSession
+
+
+class TestSwitchDB(unittest.TestCase):
+
+    def setUp(self):
+        self.nodes, self.pgpool_hosts = switchdb.nodes, switchdb.pgpool_hosts
+
+    def tearDown(self):
+        switchdb.nodes, switchdb.pgpool_hosts = self.nodes, self.pgpool_hosts
+
+    def opened(self, sessions):
+        @contextmanager
+        def opened_sessions(hosts, lazy=()):
+            self.opened_hosts = set(hosts) | set(lazy)
+            yield sessions
+        return opened_sessions
+
+    def test_parse_location(self):
+        self.assertTrue(parse_location('1/0') > parse_location('0/FFFFFFFF'))
+
+    @fudge.patch('django_fabfile.switchdb.opened_sessions')
+    def test_least_lagging_standby_is_promoted(self, fake_opened):
+        switchdb.nodes = switchdb.pgpool_hosts = ['old', 'near', 'far']
+        sessions = {'old': FakeSession('old', connected=False),
+                    'near': FakeSession('near', location='1/100'),
+                    'far': FakeSession('far', location='0/FFFFFFF0')}
+        fake_opened.expects_call().calls(self.opened(sessions))
+        failover(0)
+        self.assertEqual(sessions['near'].commands[:2],
+                         ['check sudo', 'trigger'])
+        self.assertEqual(sorted(sessions['near'].commands[2:]), [
+            'dns update', 'pcp_attach_node 1', 'pcp_detach_node 0'])
+        self.assertEqual(sessions['far'].commands, [
+            'check sudo', 'pcp_detach_node 0', 'pcp_attach_node 1'])
+        self.assertEqual(sessions['old'].commands, [])
+        self.assertEqual(self.opened_hosts, set(['near', 'far']))
+
+    @fudge.patch('django_fabfile.switchdb.opened_sessions')
+    def test_candidate_is_validated_before_connecting(self, fake_opened):
+        switchdb.nodes = switchdb.pgpool_hosts = ['old', 'new']
+        fake_opened.is_callable().times_called(0)
+        self.assertRaises(ValueError, failover, 0, 'old')
+        self.assertRaises(ValueError, failover, 0, 'other')
+
+    @fudge.patch('django_fabfile.switchdb.opened_sessions')
+    def test_failover_is_aborted_if_trigger_failed(self, fake_opened):
+        switchdb.nodes = switchdb.pgpool_hosts = ['old', 'new']
+        sessions = {'old': FakeSession('old', connected=False),
+                    'new': FakeSession('new', fail=['trigger'])}
+        fake_opened.expects_call().calls(self.opened(sessions))
+        self.assertRaises(RemoteCommandError, failover, 0, 'new')
+        self.assertEqual(sessions['new'].commands,
+                         ['check sudo', 'trigger'])
+
+    def test_data_directory_is_synced_in_parallel(self):
+        listing = '\n'.join(['8\tPG_VERSION', '2048\tbase/1',
+                             '4096\tbase/16384', '512\tglobal'])
+        sessions = {
+            'primary': FakeSession('primary', outputs={'list data': listing}),
+            'standby': FakeSession('standby', outputs=dict(
+                ('rsync ' + path, 'Total bytes received: 1,024')
+                for path in ('base/1', 'base/16384', 'global')))}
+        synced = sync_data_directory(sessions, 'primary', 'standby', 2)
+        commands = sessions['standby'].commands
+        self.assertEqual(sorted(commands[:-1]), [
+            'rsync PG_VERSION', 'rsync base/1', 'rsync base/16384',
+            'rsync global'])
+        self.assertEqual(commands[-1], 'remove dropped')
+        self.assertEqual(synced, {'size': 6664 * 1024,
+                                  'received': 3 * 1024 + 8 * 1024})
+
+    @fudge.patch('django_fabfile.switchdb.opened_sessions')
+    def test_recovery_is_aborted_if_not_stopped(self, fake_opened):
+        switchdb.nodes = switchdb.pgpool_hosts = ['old', 'new']
+        sessions = {'old': FakeSession('old', fail=['stop postgresql']),
+                    'new': FakeSession('new')}
+        fake_opened.expects_call().calls(self.opened(sessions))
+        self.assertRaises(ValueError, recover, 0, 'rsync')
+        self.assertEqual(sessions['old'].commands,
+                         ['check sudo', 'stop postgresql'])
+        self.assertEqual(sessions['new'].commands, ['check sudo'])
+
+
+if __name__ == '__main__':
+    unittest.main()
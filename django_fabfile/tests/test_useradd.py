@@ -0,0 +1,74 @@
+from django.utils import unittest
+
+from fabric.api import env
+import fudge
+
+from django_fabfile.useradd import (_get_account_script, fan_out,
+                                    get_tagged_contexts)
+
+
+class TestAccountScript(unittest.TestCase):
+
+    def test_passwordless_sudo_account(self):
+        script = _get_account_script('john', 'ssh-rsa AAAA john@host\n',
+                                     passwordless=True, sudo=True)
+        lines = script.splitlines()
+        self.assertEqual(lines[:4], [
+            'set -e', 'rm -f "$0"', 'if ! id -u john >/dev/null 2>&1; then',
+            '    adduser --disabled-password --gecos "" john'])
+        self.assertTrue('adduser john sudo' in lines)
+        key_start = lines.index("cat > /home/john/.ssh/authorized_keys "
+                                "<<'AUTHORIZED_KEYS'")
+        self.assertEqual(lines[key_start + 1:key_start + 3],
+                         ['ssh-rsa AAAA john@host', 'AUTHORIZED_KEYS'])
+
+    def test_account_without_sudo(self):
+        script = _get_account_script('john', 'ssh-rsa AAAA', None, None)
+        self.assertTrue('    adduser john\n' in script)
+        self.assertFalse('sudoers' in script or 'adduser john ' in script)
+
+
+class TestFanOut(unittest.TestCase):
+
+    def setUp(self):
+        self.key_filename = env.key_filename
+
+    @fudge.patch('django_fabfile.useradd.get_region_conn')
+    def test_tagged_hosts_are_described_once_per_region(self, fake_conn):
+        regions = [fudge.Fake('Region').has_attr(name=name) for name in
+                   ('us-east-1', 'eu-west-1')]
+        calls = []
+
+        def get_all_instances(region_name, filters):
+            calls.append((region_name, filters))
+            inst = fudge.Fake('Instance').has_attr(
+                public_dns_name='{0}.example.com'.format(region_name),
+                region=fudge.Fake('Region').has_attr(name=region_name))
+            return [fudge.Fake('Reservation').has_attr(instances=[inst])]
+
+        def get_region_conn(region_name=None):
+            return fudge.Fake('Connection').provides('get_all_regions'
+                ).returns(regions).provides('get_all_instances').calls(
+                lambda filters: get_all_instances(region_name, filters))
+        fake_conn.is_callable().calls(get_region_conn)
+        contexts = get_tagged_contexts('Role', 'web')
+        self.assertEqual(sorted(ctx.host for ctx in contexts), [
+            'eu-west-1.example.com', 'us-east-1.example.com'])
+        self.assertEqual(env.key_filename, self.key_filename)
+        self.assertEqual(sorted(calls), [
+            (name, {'tag:Role': 'web', 'instance-state-name': 'running'})
+            for name in ('eu-west-1', 'us-east-1')])
+
+    def test_failures_are_summarized(self):
+        contexts = [fudge.Fake(host).has_attr(host=host).expects('close')
+                    for host in ('good', 'bad')]
+
+        def step(ctx):
+            if ctx.host == 'bad':
+                raise IOError('Unreachable')
+        self.assertEqual(fan_out(contexts, step, workers=2),
+                         {'good': None, 'bad': 'Unreachable'})
+
+
+if __name__ == '__main__':
+    unittest.main()
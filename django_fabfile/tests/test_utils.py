@@ -0,0 +1,125 @@
+from django.utils import unittest
+from json import dumps, loads
+from threading import Thread
+
+from boto.exception import EC2ResponseError
+import fudge
+
+from django_fabfile.utils import (
+    DescribeBatcher, ThrottledEC2Connection, get_snap_device,
+    get_throttling_stats, get_volume_description, with_metadata_tags)
+
+
+def ec2_error(code):
+    body = ('<Response><Errors><Error><Code>{0}</Code><Message></Message>'
+            '</Error></Errors></Response>'.format(code))
+    return EC2ResponseError(503, 'Service Unavailable', body)
+
+
+class TestDescribeBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        def describe(region_name, ids):
+            self.calls.append((region_name, ids))
+            return dict((id_, id_.upper()) for id_ in ids if id_ != 'i-gone')
+        self.batcher = DescribeBatcher(describe, window=0.1)
+
+    def test_concurrent_lookups_are_coalesced(self):
+        results = {}
+
+        def load(id_):
+            results[id_] = self.batcher.load('us-east-1', id_)
+        threads = [Thread(target=load, args=(id_, ))
+                   for id_ in ('i-1', 'i-2', 'i-gone')]
+        with self.batcher.planning():
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(results, {'i-1': 'I-1', 'i-2': 'I-2', 'i-gone': None})
+
+    def test_primed_ids_are_cached_while_planning(self):
+        with self.batcher.planning():
+            self.batcher.prime('us-east-1', ['i-1', 'i-2'])
+            self.assertEqual(self.batcher.load('us-east-1', 'i-1'), 'I-1')
+            self.assertEqual(self.batcher.load('us-east-1', 'i-2'), 'I-2')
+        self.assertEqual(self.calls, [('us-east-1', ['i-1', 'i-2'])])
+        self.batcher.load('us-east-1', 'i-2')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_ids_cached_by_earlier_batch_are_resolved(self):
+        with self.batcher.planning():
+            self.batcher.load('us-east-1', 'i-1')
+            batch = self.batcher._open['us-east-1'] = DescribeBatcher._Batch()
+            batch.ids.update(['i-1', 'i-2'])
+            self.batcher._flush('us-east-1', batch)
+        self.assertEqual(batch.found, {'i-1': 'I-1', 'i-2': 'I-2'})
+        self.assertEqual(self.calls[-1], ('us-east-1', ['i-2']))
+
+    @fudge.patch('django_fabfile.utils.sleep')
+    def test_lookups_are_not_delayed_outside_planning(self, fake_sleep):
+        fake_sleep.is_callable().times_called(0)
+        self.assertEqual(self.batcher.load('us-east-1', 'i-1'), 'I-1')
+
+
+class TestThrottledEC2Connection(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = ThrottledEC2Connection('AKIA', 'SECRET')
+        self.errors = []
+
+    def request(self, conn, action):
+        if self.errors:
+            raise self.errors.pop(0)
+        return action
+
+    @fudge.patch('django_fabfile.utils.sleep')
+    def test_throttled_calls_are_retried(self, fake_sleep):
+        fake_sleep.is_callable()
+        self.errors = [ec2_error('RequestLimitExceeded'),
+                       ec2_error('Throttling')]
+        self.assertEqual(self.conn._throttled(self.request, 'DescribeTags'),
+                         'DescribeTags')
+        stats = get_throttling_stats()[self.conn.region.name]
+        self.assertTrue(stats['throttled'] >= 2)
+
+    def test_other_errors_are_raised(self):
+        self.errors = [ec2_error('InvalidVolume.NotFound')]
+        self.assertRaises(EC2ResponseError, self.conn._throttled,
+                          self.request, 'CreateSnapshot')
+
+
+class TestGroupDescription(unittest.TestCase):
+
+    def test_group_snapshot_described_as_single_volume(self):
+        snap = fudge.Fake('Snapshot').has_attr(
+            volume_id='vol-2', description=dumps({
+                'Devices': {'vol-1': '/dev/sda1', 'vol-2': '/dev/sdf'},
+                'Instance': 'i-1', 'Time': '2012-11-13T10:00:00'}))
+        self.assertEqual(get_snap_device(snap), '/dev/sdf')
+        self.assertEqual(loads(get_volume_description(snap)), {
+            'Volume': 'vol-2', 'Device': '/dev/sdf', 'Instance': 'i-1',
+            'Time': '2012-11-13T10:00:00'})
+        snap.has_attr(description='{"Volume": "vol-2"}')
+        self.assertEqual(get_volume_description(snap), '{"Volume": "vol-2"}')
+
+
+class TestMetadataTags(unittest.TestCase):
+
+    def test_metadata_tags_replaced_from_description(self):
+        description = dumps({'Volume': 'vol-2', 'Region': 'us-east-1',
+                             'Device': '/dev/sdf', 'Time': '2012-11-13'})
+        tags = {'Name': 'db', 'Backup:Volume': 'vol-1',
+                'Backup:Instance': 'i-1'}
+        self.assertEqual(with_metadata_tags(tags, description), {
+            'Name': 'db', 'Backup:Volume': 'vol-2',
+            'Backup:Region': 'us-east-1', 'Backup:Device': '/dev/sdf'})
+        self.assertEqual(with_metadata_tags(tags, 'Not JSON'),
+                         {'Name': 'db'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,16 @@
-from fabric.api import env, settings, sudo, abort, put, task
+from fabric.api import env, sudo, abort, put, settings, task
+from itertools import chain
+import logging
 from os.path import isfile as _isfile
+import re
+from StringIO import StringIO
 
-from django_fabfile.utils import config, get_inst_by_id
+from django_fabfile.remote import ExecutionContext, with_session_pool
+from django_fabfile.utils import (config, get_inst_by_id, get_region_conn,
+                                  parallel_map)
+
+
+logger = logging.getLogger(__name__)
 
 
 try:
@@ -21,65 +30,165 @@ def _sudo(cmd):
     sudo(cmd, shell=False, pty=True)
 
 
-def _create_account(username, region, instance_ids, passwordless, sudo):
+USERNAME_REGEXP = re.compile(r'^[a-z_][a-z0-9_-]*$')
+
+
+def _get_account_script(username, ssh_key, passwordless, sudo):
+    """Return idempotent shell script creating account with `ssh_key`.
+
+    Existing account is updated: groups are added and authorized keys
+    are replaced."""
+    home = '/home/{0}'.format(username)
+    lines = ['set -e', 'rm -f "$0"',
+             'if ! id -u {0} >/dev/null 2>&1; then'.format(username)]
+    if passwordless:
+        lines.append('    adduser --disabled-password --gecos "" '
+                     '{0}'.format(username))
+        groups = ['sudo'] if sudo else []
+    else:
+        lines.append('    adduser {0}'.format(username))
+        groups = ['adm', 'admin', 'staff'] if sudo else []
+    lines.append('fi')
+    if passwordless and sudo:
+        lines.append('sed -i "s/# %sudo ALL=NOPASSWD: ALL/'
+                     '%sudo ALL=NOPASSWD: ALL/" /etc/sudoers')
+    for group in groups:
+        lines.append('adduser {0} {1}'.format(username, group))
+    lines.extend([
+        'mkdir -p {0}/.ssh'.format(home),
+        "cat > {0}/.ssh/authorized_keys <<'AUTHORIZED_KEYS'".format(home),
+        ssh_key.strip(),
+        'AUTHORIZED_KEYS',
+        'chown -R {0}: {1}/.ssh'.format(username, home),
+        'chmod 700 {0}/.ssh'.format(home),
+        'chmod 600 {0}/.ssh/authorized_keys'.format(home)])
+    return '\n'.join(lines) + '\n'
+
+
+def _run_script(name, script):
+    """Upload `script` to home directory and run it with one sudo call.
+
+    Script removes itself. Interaction is allowed, e.g. to enter new
+    password."""
+    put(StringIO(script), name, mode=0700)
+    _sudo('sh ' + name)
+
+
+def _read_account_script(username, passwordless, sudo):
     if not _isfile(username + '.pub'):
         abort("%s.pub does not exist" % username)
-    env.ssh_key = username + '.pub'
-    env.username = username     # Own attribute for string formatting.
-    if passwordless:
-        _sudo('adduser --disabled-password %(username)s' % env)
-        if sudo:
-            _sudo('sed -i "s/# %sudo ALL=NOPASSWD: ALL/'
-                            '%sudo ALL=NOPASSWD: ALL/" /etc/sudoers')
-            for group in ['sudo']:
-                with settings(group=group):
-                    _sudo('adduser %(username)s %(group)s' % env)
+    if not USERNAME_REGEXP.match(username):
+        abort("%s is not valid username" % username)
+    with open(username + '.pub') as ssh_key:
+        return _get_account_script(username, ssh_key.read(), passwordless,
+                                   sudo)
+
+
+def _create_account(username, passwordless, sudo):
+    script = _read_account_script(username, passwordless, sudo)
+    _run_script('adduser-{0}.sh'.format(username), script)
+
+
+def _get_removal_command(username):
+    if not USERNAME_REGEXP.match(username):
+        abort("%s is not valid username" % username)
+    return ('sh -c "if id -u {0} >/dev/null 2>&1; then deluser {0}; fi"'
+            .format(username))
+
+
+def _remove_account(username):
+    _sudo(_get_removal_command(username))
+
+
+def get_instance_contexts(region, instance_ids):
+    """Return execution contexts of "inst1;inst2" list in `region`.
+
+    ``env.key_filename`` is used if set instead of region key."""
+    return [ExecutionContext.for_instance(
+        get_inst_by_id(region, inst_id), env.user,
+        key_filename=env.key_filename or None) for inst_id in
+        unicode(instance_ids).split(';') if inst_id]
+
+
+def get_tagged_contexts(tag_name, tag_value, region=None):
+    """Return execution contexts of running instances tagged with value.
+
+    Instances are described with one request per region, regions are
+    described in parallel. Key file of instance region is used unless
+    ``env.key_filename`` is set."""
+    if region:
+        regions = [region]
     else:
-        _sudo('adduser %(username)s' % env)
-        if sudo:
-            for group in ['adm', 'admin', 'staff']:
-                with settings(group=group):
-                    _sudo('adduser %(username)s %(group)s' % env)
-    _sudo('mkdir -p /home/%(username)s/.ssh' % env)
-    _sudo('touch /home/%(username)s/.ssh/authorized_keys' % env)
-    _sudo('chown -R %(username)s: /home/%(username)s/.ssh' % env)
-    _sudo('chmod 700 /home/%(username)s/.ssh' % env)
-    put(env.ssh_key, '/home/%(username)s/.ssh/authorized_keys'
-                                      % env, use_sudo=True)
-    _sudo('chown -R %(username)s: /home/%(username)s/.'
-                                    'ssh/authorized_keys' % env)
-    _sudo('chmod 600 /home/%(username)s/.ssh/authorized_keys' % env)
+        regions = [reg.name for reg in get_region_conn().get_all_regions()]
+    filters = {'tag:' + tag_name: tag_value,
+               'instance-state-name': 'running'}
+
+    def describe(reg_name):
+        reservations = get_region_conn(reg_name).get_all_instances(
+            filters=filters)
+        return [ExecutionContext.for_instance(
+            inst, env.user, key_filename=env.key_filename or None) for inst
+            in chain(*[res.instances for res in reservations])]
+    return list(chain(*parallel_map(describe, regions)))
+
+
+def fan_out(contexts, step, workers=None):
+    """Call `step` with every :class:`django_fabfile.remote.ExecutionContext`
+    in parallel and log summary.
+
+    :param workers: hosts processed at once, ``USERADD_CONCURRENCY``
+        option by default;
+    :returns: dict of host to error message or None if succeeded."""
+    workers = int(workers or config.getint('DEFAULT', 'USERADD_CONCURRENCY'))
+
+    def process(ctx):
+        try:
+            step(ctx)
+        except Exception as err:
+            return str(err) or repr(err)
+        finally:
+            ctx.close()
+    errors = dict(zip([ctx.host for ctx in contexts],
+                      parallel_map(process, contexts, workers)))
+    for host in sorted(errors):
+        if errors[host]:
+            logger.error('{0}: failed: {1}'.format(host, errors[host]))
+        else:
+            logger.info('{0}: succeeded'.format(host))
+    logger.info('{0} of {1} hosts succeeded'.format(
+        sum(1 for err in errors.values() if not err), len(errors)))
+    return errors
 
 
 @task
-def deluser(name, region=None, instance_ids=None):
+@with_session_pool
+def deluser(name, region=None, instance_ids=None, tag_name=None,
+            tag_value=None, workers=None):
     """
     Removes user <name> with deluser from "host1;host2" list in <region>
     If region and instance_ids not set - script takes hosts amd key values
     from command line (-H and -i).
+    If <tag_name> and <tag_value> set - removes user from all running
+    instances with the tag in <region> or in all regions.
+    Instances are processed <workers> hosts in parallel
+    (USERADD_CONCURRENCY by default).
     """
-    if instance_ids and region:
-        instances_ids = list(unicode(instance_ids).split(';'))
-        for inst in instances_ids:
-            if inst:
-                _instance = get_inst_by_id(region, inst)
-                if not env.key_filename:
-                    key_filename = config.get(_instance.region.name,
-                                                      'KEY_FILENAME')
-                    env.update({'key_filename': key_filename,
-                                                  'warn_only': True})
-                env.update({'host_string': _instance.public_dns_name})
-                env.username = name
-                _sudo('deluser %(username)s' % env)
+    command = _get_removal_command(name)
+    if tag_name and tag_value:
+        contexts = get_tagged_contexts(tag_name, tag_value, region)
+    elif instance_ids and region:
+        contexts = get_instance_contexts(region, instance_ids)
     else:
-        env.update({'warn_only': True})
-        env.username = name
-        _sudo('deluser %(username)s' % env)
+        with settings(warn_only=True):
+            return _remove_account(name)
+    return fan_out(contexts, lambda ctx: ctx.sudo(command), workers)
 
 
 @task
+@with_session_pool
 def adduser(username, region=None, instance_ids=None,
-                                passwordless=None, sudo=None):
+                                passwordless=None, sudo=None, tag_name=None,
+                                tag_value=None, workers=None):
     """
     creates new <username> with public SSH key on "host1;host2" list in
     <region>. If you want to create passwordless account - set any value to
@@ -94,18 +203,31 @@ def adduser(username, region=None, instance_ids=None,
     2. With aws api keys and config entries:
     :<username>,<region>,"instance1;instance2",<passwordless>,<sudo>
     Extracts IP's from instance description.
+    3. With tag instead of instances list:
+    :<username>,<region>,,<passwordless>,<sudo>,<tag_name>,<tag_value>
+    Processes all running instances with the tag in <region> or in all
+    regions, <workers> hosts in parallel (USERADD_CONCURRENCY by default).
+    Only passwordless accounts may be created this way. Passwordless
+    accounts are created on instances of the list in parallel as well,
+    others one by one to enter password.
     """
-    if instance_ids and region:
-        instances_ids = list(unicode(instance_ids).split(';'))
-        for inst in instances_ids:
-            if inst:
-                _instance = get_inst_by_id(region, inst)
-                if not env.key_filename:
-                    key_filename = config.get(_instance.region.name,
-                                                      'KEY_FILENAME')
-                    env.update({'key_filename': key_filename})
-                env.update({'host_string': _instance.public_dns_name})
-                _create_account(username, region, instance_ids, passwordless,
-                                                                    sudo)
+    if tag_name and tag_value:
+        if not passwordless:
+            abort("Password can't be entered for many hosts in parallel")
+        contexts = get_tagged_contexts(tag_name, tag_value, region)
+    elif instance_ids and region:
+        contexts = get_instance_contexts(region, instance_ids)
     else:
-        _create_account(username, region, instance_ids, passwordless, sudo)
+        return _create_account(username, passwordless, sudo)
+    if passwordless:
+        script = _read_account_script(username, passwordless, sudo)
+        name = 'adduser-{0}.sh'.format(username)
+
+        def create(ctx):
+            ctx.put(script, name, mode=0700)
+            ctx.sudo('sh ' + name)
+        return fan_out(contexts, create, workers)
+    for ctx in contexts:
+        with settings(host_string=ctx.session.host_string, user=ctx.user,
+                      key_filename=ctx.session.key_filename):
+            _create_account(username, passwordless, sudo)
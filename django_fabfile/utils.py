@@ -1,18 +1,24 @@
 """Check :doc:`README` or :class:`django_fabfile.utils.Config` docstring
 for setup instructions."""
 
+from collections import defaultdict
 from ConfigParser import SafeConfigParser
-from contextlib import contextmanager
+from contextlib import contextmanager, nested
 from datetime import datetime
-from json import loads
+from json import dumps, loads
 import logging
+from multiprocessing.pool import ThreadPool
 import os
+from random import random
 import re
-from time import sleep
+from threading import Event, Lock, RLock
+from time import sleep, time
 from traceback import format_exc
 
-from boto import BotoConfigLocations, connect_ec2
+from boto import BotoConfigLocations
 from boto.ec2 import regions
+from boto.ec2.connection import EC2Connection
+from boto.ec2.snapshot import Snapshot
 from boto.exception import EC2ResponseError
 from fabric.api import sudo, task
 from fabric.contrib.files import exists
@@ -106,23 +112,163 @@ class Config(object):
 config = Config()
 
 
-def get_region_conn(region_name=None):
+class TokenBucket(object):
+
+    """Thread-safe token bucket.
+
+    :param rate: tokens added per second;
+    :param capacity: maximal burst of tokens."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time()
+        self._lock = Lock()
+
+    def consume(self, tokens=1):
+        """Block until `tokens` are available and take them."""
+        while True:
+            with self._lock:
+                now = time()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                lack = (tokens - self.tokens) / self.rate
+            sleep(lack)
+
+
+THROTTLING_ERRORS = ('RequestLimitExceeded', 'Throttling')
+
+
+class RegionThrottle(object):
+
+    """API call budgets and counters shared by all threads for region.
+
+    Describe calls and mutating calls are limited separately. Rates may
+    be configured per region, falling back to DEFAULT section."""
+
+    def __init__(self, region_name):
+        self.region_name = region_name
+        self.describe = TokenBucket(
+            config.getfloat(region_name, 'EC2_DESCRIBE_RATE'),
+            config.getint(region_name, 'EC2_DESCRIBE_BURST'))
+        self.mutate = TokenBucket(
+            config.getfloat(region_name, 'EC2_MUTATE_RATE'),
+            config.getint(region_name, 'EC2_MUTATE_BURST'))
+        self.stats = defaultdict(int)
+        self._lock = Lock()
+
+    def count(self, counter):
+        with self._lock:
+            self.stats[counter] += 1
+
+
+_throttles = {}
+_throttles_lock = Lock()
+
+
+def get_region_throttle(region_name):
+    with _throttles_lock:
+        if region_name not in _throttles:
+            _throttles[region_name] = RegionThrottle(region_name)
+        return _throttles[region_name]
+
+
+def get_throttling_stats():
+    """Return dict of API call counters by region name."""
+    with _throttles_lock:
+        return dict((name, dict(throttle.stats)) for name, throttle in
+                    _throttles.items())
+
+
+def log_throttling_stats():
+    for name, stats in sorted(get_throttling_stats().items()):
+        logger.info('API calls in {0}: {1}'.format(name, ', '.join(
+            '{0}={1}'.format(*item) for item in sorted(stats.items()))))
+
+
+class ThrottledEC2Connection(EC2Connection):
+
+    """Respect region budgets and retry throttled requests.
+
+    Only throttling errors are retried, with exponential backoff and
+    full jitter. Resources fetched through the connection keep it, so
+    their own requests (e.g. ``update()``) are throttled as well."""
+
+    def _throttled(self, request, action, *args, **kwargs):
+        throttle = get_region_throttle(self.region.name)
+        if action.startswith('Describe'):
+            bucket, counter = throttle.describe, 'describe_calls'
+        else:
+            bucket, counter = throttle.mutate, 'mutate_calls'
+        retries = config.getint('DEFAULT', 'EC2_THROTTLE_RETRIES')
+        backoff = config.getfloat('DEFAULT', 'EC2_BACKOFF_BASE')
+        backoff_cap = config.getfloat('DEFAULT', 'EC2_BACKOFF_CAP')
+        attempt = 0
+        while True:
+            bucket.consume()
+            throttle.count(counter)
+            try:
+                return request(self, action, *args, **kwargs)
+            except EC2ResponseError as err:
+                if err.error_code not in THROTTLING_ERRORS:
+                    raise
+                throttle.count('throttled')
+                if attempt >= retries:
+                    throttle.count('gave_up')
+                    raise
+                pause = random() * min(backoff_cap, backoff * 2 ** attempt)
+                attempt += 1
+                logger.warning('{0} throttled in {1}, retrying in {2:.1f} sec '
+                               '({3} times left)'.format(
+                                   action, self.region.name, pause,
+                                   retries - attempt + 1))
+                sleep(pause)
+
+    def get_list(self, action, *args, **kwargs):
+        return self._throttled(EC2Connection.get_list, action, *args,
+                               **kwargs)
+
+    def get_object(self, action, *args, **kwargs):
+        return self._throttled(EC2Connection.get_object, action, *args,
+                               **kwargs)
+
+    def get_status(self, action, *args, **kwargs):
+        return self._throttled(EC2Connection.get_status, action, *args,
+                               **kwargs)
+
+
+_regions = []
+_regions_lock = Lock()
+
+
+def get_region_conn(region_name=None, api_version=None):
     """Connect to partially spelled `region_name`.
 
     Return connection to default boto region if called without
-    arguments.
+    arguments. Returned connection is a :class:`ThrottledEC2Connection`.
 
-    :param region_name: may be spelled partially."""
+    :param region_name: may be spelled partially;
+    :param api_version: override EC2 API version used by boto."""
     creds = config.get_creds()
+    if api_version:
+        creds['api_version'] = api_version
     if region_name:
-        matched = [reg for reg in regions(**creds) if re.match(region_name,
-                                                               reg.name)]
+        with _regions_lock:
+            if not _regions:    # Regions list is static, fetch it once.
+                _regions.extend(regions(**creds))
+        matched = [reg for reg in _regions if re.match(region_name,
+                                                       reg.name)]
         assert len(matched) > 0, 'No region matches {0}'.format(region_name)
         assert len(matched) == 1, 'Several regions matches {0}'.format(
             region_name)
-        return matched[0].connect(**creds)
+        return ThrottledEC2Connection(region=matched[0], **creds)
     else:
-        return connect_ec2(**creds)
+        return ThrottledEC2Connection(**creds)
 
 
 class StateNotChangedError(Exception):
@@ -230,15 +376,43 @@ wait_for_sudo = WaitForProper(attempts=ssh_timeout_attempts,
                               pause=ssh_timeout_interval)(sudo)
 
 
+def _user_tags(tags):
+    return dict((key, val) for key, val in tags.items() if
+                val and not re.match(r'^aws:.+', key))
+
+
 def add_tags(res, tags):
-    for tag in tags:
-        if re.match(r'^aws:.+', tag):
-            continue
-        elif tags[tag]:
-            res.add_tag(tag, tags[tag])
+    """Add `tags` to `res` with single request."""
+    tags = _user_tags(tags)
+    if tags:
+        res.connection.create_tags([res.id], tags)
+        res.tags.update(tags)
     logger.debug('Tags added to {0}'.format(res))
 
 
+METADATA_TAG = 'Backup:{0}'     # Key of tag mirroring description attr.
+METADATA_ATTRS = ('Volume', 'Region', 'Instance', 'Device')
+
+
+def get_metadata_tags(description):
+    """Return tags mirroring attributes of snapshot JSON description."""
+    try:
+        descr = loads(description)
+    except:
+        return {}
+    return dict((METADATA_TAG.format(attr), descr[attr]) for attr in
+                METADATA_ATTRS if descr.get(attr))
+
+
+def with_metadata_tags(tags, description):
+    """Return `tags` with metadata tags replaced from `description`."""
+    metadata_keys = [METADATA_TAG.format(attr) for attr in METADATA_ATTRS]
+    tags = dict((key, val) for key, val in tags.items() if
+                key not in metadata_keys)
+    tags.update(get_metadata_tags(description))
+    return tags
+
+
 def get_descr_attr(resource, attr):
     try:
         return loads(resource.description)[attr]
@@ -255,7 +429,24 @@ def get_snap_instance(snap):
 
 
 def get_snap_device(snap):
-    return get_descr_attr(snap, 'Device')
+    return (get_descr_attr(snap, 'Device') or
+            (get_descr_attr(snap, 'Devices') or {}).get(snap.volume_id))
+
+
+def get_volume_description(snap):
+    """Return description of `snap` as of single volume snapshot.
+
+    Snapshots started with :func:`create_instance_snapshots` share
+    description with ``Devices`` map instead of ``Volume`` and
+    ``Device`` fields."""
+    try:
+        descr = loads(snap.description)
+        devices = descr.pop('Devices')
+    except:
+        return snap.description
+    descr.update({'Volume': snap.volume_id,
+                  'Device': devices.get(snap.volume_id)})
+    return dumps(descr, sort_keys=True)
 
 
 def get_snap_time(snap):
@@ -268,27 +459,217 @@ def get_snap_time(snap):
     return datetime.strptime(snap.start_time, '%Y-%m-%dT%H:%M:%S.000Z')
 
 
+class DescribeBatcher(object):
+
+    """Coalesce single-ID lookups into one multi-ID Describe per region.
+
+    Lookups issued from concurrent threads within `window` seconds inside
+    :meth:`planning` block are sent together, lookups outside of it are
+    not delayed. IDs announced beforehand with :meth:`prime` join the
+    next request for their region. Results are kept only inside
+    :meth:`planning` block, so lookups outside of it always see fresh
+    state of resource.
+
+    :param describe: callable accepting region name and list of IDs and
+        returning dict of found resources by ID. Absent IDs should be
+        just omitted from the dict. Called with :attr:`max_ids` IDs at
+        most."""
+
+    max_ids = 200   # Limit of values for single filter.
+
+    class _Batch(object):
+
+        def __init__(self):
+            self.ids = set()
+            self.done = Event()
+            self.found = {}
+            self.error = None
+
+    def __init__(self, describe, window=0):
+        self.describe = describe
+        self.window = window
+        self._lock = RLock()
+        self._open = {}     # Batches collecting IDs, by region name.
+        self._primed = defaultdict(set)
+        self._cache = None
+        self._depth = 0
+
+    def prime(self, region_name, ids):
+        """Queue `ids` to be fetched along with the next lookup."""
+        with self._lock:
+            self._primed[region_name].update(ids)
+
+    @contextmanager
+    def planning(self):
+        """Reuse fetched resources until the block is left."""
+        with self._lock:
+            if not self._depth:
+                self._cache = {}
+            self._depth += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._depth -= 1
+                if not self._depth:
+                    self._cache = None
+                    self._primed.clear()
+
+    def load(self, region_name, res_id):
+        """Return resource or None if it was not found."""
+        with self._lock:
+            key = region_name, res_id
+            if self._cache is not None and key in self._cache:
+                return self._cache[key]
+            batch = self._open.get(region_name)
+            is_leader = batch is None
+            if is_leader:
+                batch = self._open[region_name] = self._Batch()
+            batch.ids.add(res_id)
+        if is_leader:
+            self._flush(region_name, batch)
+        else:
+            batch.done.wait()
+        if batch.error:
+            raise batch.error
+        return batch.found.get(res_id)
+
+    def _flush(self, region_name, batch):
+        if self.window and self._depth:
+            sleep(self.window)  # Let other threads join the batch.
+        with self._lock:
+            del self._open[region_name]
+            batch.ids.update(self._primed.pop(region_name, ()))
+            if self._cache is not None:
+                # Cached by earlier batch after waiters joined this one.
+                for res_id in list(batch.ids):
+                    if (region_name, res_id) in self._cache:
+                        batch.found[res_id] = self._cache[region_name, res_id]
+                        batch.ids.discard(res_id)
+        ids = sorted(batch.ids)
+        try:
+            for i in range(0, len(ids), self.max_ids):
+                batch.found.update(self.describe(region_name,
+                                                 ids[i:i + self.max_ids]))
+        except Exception as err:
+            batch.error = err
+        else:
+            with self._lock:
+                if self._cache is not None:
+                    for res_id in batch.ids:
+                        self._cache[region_name, res_id] = batch.found.get(
+                            res_id)
+        finally:
+            batch.done.set()
+
+
+def _describe_instances(region_name, ids):
+    res = get_region_conn(region_name).get_all_instances(
+        filters={'instance-id': ids})
+    return dict((inst.id, inst) for rsv in res for inst in rsv.instances)
+
+
+def _describe_volumes(region_name, ids):
+    vols = get_region_conn(region_name).get_all_volumes(
+        filters={'volume-id': ids})
+    return dict((vol.id, vol) for vol in vols)
+
+
+def _describe_snapshots(region_name, ids):
+    snaps = get_region_conn(region_name).get_all_snapshots(
+        filters={'snapshot-id': ids})
+    return dict((snap.id, snap) for snap in snaps)
+
+
+describe_batch_window = config.getfloat('DEFAULT', 'DESCRIBE_BATCH_WINDOW')
+instances_batcher = DescribeBatcher(_describe_instances, describe_batch_window)
+volumes_batcher = DescribeBatcher(_describe_volumes, describe_batch_window)
+snapshots_batcher = DescribeBatcher(_describe_snapshots, describe_batch_window)
+
+
+@contextmanager
+def describe_planning():
+    """Share fetched instances, volumes and snapshots within the block.
+
+    Use it around planning steps which look up the same resources
+    several times, and :meth:`DescribeBatcher.prime` IDs known in
+    advance to fetch them with a single request."""
+    with nested(instances_batcher.planning(), volumes_batcher.planning(),
+                snapshots_batcher.planning()):
+        yield
+
+
+# Supports MaxResults/NextToken, CreateSnapshots and TagSpecification.
+API_VERSION = '2016-11-15'
+
+
+def iter_snapshots(conn, owner='self', filters=None, page_size=None):
+    """Yield snapshots fetched page by page.
+
+    Unlike ``get_all_snapshots`` whole list of snapshots is never held
+    in memory, so consumers should group snapshots on the fly.
+
+    :param conn: connection to region;
+    :param page_size: number of snapshots per request, will be fetched
+        from SNAPSHOTS_PAGE_SIZE option by default."""
+    pager = get_region_conn(conn.region.name,
+                            api_version=API_VERSION)
+    params = {'MaxResults': page_size or config.getint(
+        'DEFAULT', 'SNAPSHOTS_PAGE_SIZE')}
+    if owner:
+        params['Owner'] = owner
+    if filters:
+        pager.build_filter_params(params, filters)
+    while True:
+        page = pager.get_list('DescribeSnapshots', params,
+                              [('item', Snapshot)], verb='POST')
+        for snap in page:
+            yield snap
+        token = page.next_token or getattr(page, 'nextToken', None)
+        if not token:
+            break
+        params['NextToken'] = token
+
+
+def create_instance_snapshots(inst, description='', tags=None):
+    """Return snapshots of all EBS volumes of `inst` started in one call.
+
+    Multi-volume CreateSnapshots API is used. Snapshots are tagged with
+    `tags` at creation."""
+    conn = get_region_conn(inst.region.name, api_version=API_VERSION)
+    params = {'InstanceSpecification.InstanceId': inst.id}
+    if description:
+        params['Description'] = description
+    tags = sorted(_user_tags(tags or {}).items())
+    if tags:
+        params['TagSpecification.1.ResourceType'] = 'snapshot'
+    for num, (key, val) in enumerate(tags, 1):
+        params['TagSpecification.1.Tag.{0}.Key'.format(num)] = key
+        params['TagSpecification.1.Tag.{0}.Value'.format(num)] = val
+    snaps = conn.get_list('CreateSnapshots', params, [('item', Snapshot)],
+                          verb='POST')
+    for snap in snaps:
+        snap.status = snap.status or getattr(snap, 'state', None)
+    return list(snaps)
+
+
 def get_inst_by_id(region_name, instance_id):
     """Return Instance or None.
 
-    Raise AssertionError if more that one Instance returned."""
-    try:
-        res = get_region_conn(region_name).get_all_instances([instance_id, ])
-    except EC2ResponseError, err:
-        if err.error_code == 'InvalidInstanceID.NotFound':
-            return
-        else:
-            raise
-    else:
-        if not res:
-            return
-    tpl = 'Returned {res} instead of 1 {type_} for {id_}'
-    assert len(res) == 1, tpl.format(res=res, type_='reservation',
-                                     id_=instance_id)
-    instances = res[0].instances
-    assert len(instances) == 1, tpl.format(res=instances, type_='instance',
-                                           id_=instance_id)
-    return instances[0]
+    Lookups are coalesced with :data:`instances_batcher`. Filter is used
+    instead of list of IDs, so absent instance doesn't fail lookups of
+    other instances in the same batch."""
+    return instances_batcher.load(region_name, instance_id)
+
+
+def get_vol_by_id(region_name, vol_id):
+    """Return Volume or None. Coalesced like :func:`get_inst_by_id`."""
+    return volumes_batcher.load(region_name, vol_id)
+
+
+def get_snap_by_id(region_name, snapshot_id):
+    """Return Snapshot or None. Coalesced like :func:`get_inst_by_id`."""
+    return snapshots_batcher.load(region_name, snapshot_id)
 
 
 @task
@@ -301,12 +682,17 @@ def update_volumes_tags(filters=None):
     for region in regions():
         reservations = get_region_conn(region.name).get_all_instances(
             filters=filters)
-        for res in reservations:
-            inst = res.instances[0]
-            for bdm in inst.block_device_mapping.keys():
-                vol_id = inst.block_device_mapping[bdm].volume_id
-                vol = inst.connection.get_all_volumes([vol_id])[0]
-                add_tags(vol, inst.tags)
+        with describe_planning():
+            for res in reservations:
+                volumes_batcher.prime(region.name, [
+                    bdm.volume_id for inst in res.instances
+                    for bdm in inst.block_device_mapping.values()])
+            for res in reservations:
+                inst = res.instances[0]
+                for bdm in inst.block_device_mapping.keys():
+                    vol_id = inst.block_device_mapping[bdm].volume_id
+                    vol = get_vol_by_id(region.name, vol_id)
+                    add_tags(vol, inst.tags)
 
 
 @contextmanager
@@ -322,3 +708,17 @@ def config_temp_ssh(conn):
     finally:
         key_pair.delete()
         os.remove(key_filename)
+
+
+def parallel_map(func, items, workers=None):
+    """Return list of `func` results for `items` computed in threads.
+
+    :param workers: number of threads, one per item by default."""
+    items = list(items)
+    if len(items) < 2:
+        return map(func, items)
+    pool = ThreadPool(min(workers or len(items), len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()